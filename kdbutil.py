@@ -12,6 +12,8 @@ import code
 
 import libkeepass
 import libkeepass.utils
+import libkeepass.utils.batch
+import libkeepass.utils.convert
 from libkeepass.utils.merge import KDB4Merge
 
 
@@ -140,6 +142,11 @@ def kdbfile_shell(args):
         code.interact(local=dict(kdbfiles=kdbfiles))
 
 def kdbfile_convert4(args):
+    if args.batch:
+        return kdbfile_convert4_batch(args)
+    if not args.kdbinfile or not args.kdboutfile:
+        print("convert4 needs kdbinfile and kdboutfile, or --batch.", file=sys.stderr)
+        sys.exit(2)
     kdbinfile = args.kdbinfile
     kdboutfile = args.kdboutfile
     
@@ -148,8 +155,13 @@ def kdbfile_convert4(args):
         with libkeepass.open(os.path.expanduser(kdbinfile), password=pwd) as kdb3:
             assert isinstance(kdb3, libkeepass.kdb3.KDB3File)
             with open(kdboutfile, 'wb') as wf:
-                kdb4 = libkeepass.utils.convert_kdb3_to_kdb4(kdb3)
-                kdb4.write_to(wf)
+                if args.debugfile or args.debug:
+                    # keep the element tree to look at
+                    kdb4 = libkeepass.utils.convert.convert_kdb3_to_kdb4(kdb3)
+                    kdb4.write_to(wf, compact=args.compact)
+                else:
+                    kdb4 = libkeepass.utils.convert.write_kdb3_as_kdb4(
+                        kdb3, wf, compact=args.compact)
             if args.debugfile:
                 with open(args.debugfile, 'wb') as wf:
                     wf.write(kdb4.pretty_print())
@@ -158,6 +170,38 @@ def kdbfile_convert4(args):
     except OSError as ex:
         print(ex)
 
+def kdbfile_convert4_batch(args):
+    with open(args.batch) as f:
+        jobs = libkeepass.utils.batch.read_manifest(f)
+    
+    if args.keyfile and not args.password_stdin:
+        print("convert4 --batch needs a password, KDB3 files can not be "
+              "opened with only a keyfile.", file=sys.stderr)
+        sys.exit(2)
+    
+    # the same credentials are used for all files, ask only once
+    credentials = {}
+    if args.keyfile:
+        credentials['keyfile'] = args.keyfile
+    if args.password_stdin:
+        credentials['password'] = sys.stdin.readline().rstrip('\r\n')
+    else:
+        credentials['password'] = getpass.getpass()
+    
+    results = []
+    for result in libkeepass.utils.batch.convert_batch(
+            jobs, workers=args.workers, **credentials):
+        results.append(result)
+        if result.error is None:
+            status = 'ok {} entries in {:.3f}s'.format(result.entries, result.seconds)
+        else:
+            status = 'FAILED {}'.format(result.error)
+        print('[{}/{}] {} -> {}: {}'.format(len(results), len(jobs),
+              result.input, result.output, status), file=sys.stderr)
+    print(libkeepass.utils.batch.format_report(results))
+    if any(result.error is not None for result in results):
+        sys.exit(1)
+
 def kdbfile_merge(args):
     kdbfiles = args.kdbfiles
     kdboutfile = args.kdboutfile
@@ -175,7 +219,7 @@ def kdbfile_merge(args):
                 kdb = kdbs[i]
                 if isinstance(kdb, libkeepass.kdb3.KDB3File):
                     print("Warning: using converted KDB3 file, may get unexpected behavior.", file=sys.stderr, flush=True)
-                    kdbs[i] = libkeepass.utils.convert_kdb3_to_kdb4(kdb)
+                    kdbs[i] = libkeepass.utils.convert.convert_kdb3_to_kdb4(kdb)
             
             for kdb_src in kdbs[1:]:
                 kdbm = kdbs[0].merge(kdb_src, **merge_opts)
@@ -184,7 +228,7 @@ def kdbfile_merge(args):
                     print(kdbm.mm_ops)
             
             with open(kdboutfile, 'wb') as wf:
-                kdb.write_to(wf)
+                kdb.write_to(wf, compact=args.compact)
             if args.debug:
                 code.interact(local=dict(kdb=kdb, kdbs=kdbs))
     except OSError as ex:
@@ -202,6 +246,8 @@ def main(argv):
                         help='show passwords')
     parser.add_argument('-k', '--keyfile', default=None,
                         help='use keyfile')
+    parser.add_argument('-c', '--compact', action='store_true', default=False,
+                        help='write xml without indentation')
     parser.set_defaults(func=kdbfile_help)
     
     dump_sparser = subparsers.add_parser('dump')
@@ -216,8 +262,17 @@ def main(argv):
     convert4_sparser = subparsers.add_parser('convert4')
     convert4_sparser.add_argument('--debugfile', action='store',
                                   help='write internal xml to file')
-    convert4_sparser.add_argument('kdbinfile', help='keepass v3 database file')
-    convert4_sparser.add_argument('kdboutfile', help='output file')
+    convert4_sparser.add_argument('--batch', metavar='MANIFEST', action='store',
+                                  help='convert the files listed in MANIFEST, '
+                                  'one "input<TAB>output" per line, all opened '
+                                  'with the same password (keyfiles are not '
+                                  'supported for KDB3 files)')
+    convert4_sparser.add_argument('-j', '--workers', type=int, default=None,
+                                  help='worker processes for --batch (default: one per CPU)')
+    convert4_sparser.add_argument('--password-stdin', action='store_true', default=False,
+                                  help='read the password of --batch files from the first line of stdin')
+    convert4_sparser.add_argument('kdbinfile', nargs='?', help='keepass v3 database file')
+    convert4_sparser.add_argument('kdboutfile', nargs='?', help='output file')
     convert4_sparser.set_defaults(func=kdbfile_convert4)
     
     modes = ('OVERWRITE_IF_NEWER', 'SYNCHRONIZE', 'SYNCHRONIZE_3WAY')
@@ -45,12 +45,14 @@ def open_stream(stream, **credentials):
     Create a keepass database reader object from a `stream`.
     
     Files are identified using their signature and a reader suitable for 
-    the file format is intialized and returned.
+    the file format is intialized and returned. The start of the file is
+    read once, the reader gets it as `common.HeaderBuffer` of `stream`.
     """
     assert isinstance(stream, io.IOBase) or isinstance(stream, file)
-    signature = common.read_signature(stream)
+    header = common.HeaderBuffer(stream)
+    signature = common.read_signature(header)
     cls = get_kdb_reader(signature)
-    kdb = cls(stream, **credentials)
+    kdb = cls(header, **credentials)
     return kdb
 
 
@@ -84,3 +86,6 @@ def get_kdb_reader(signature):
 
     return _kdb_readers[signature[1]]
 
+
+
+from libkeepass.utils.probe import probe, scan
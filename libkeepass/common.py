@@ -2,6 +2,7 @@
 
 import sys
 import codecs
+import struct
 
 IS_PYTHON_3 = sys.hexversion >= 0x3000000
 
@@ -85,30 +86,8 @@ class HeaderDictionary(dict):
             dict.__setitem__(self, self.fields[key], val)
 
     def __getattr__(self, key):
-        class wrap(object):
-            def __init__(self, d):
-                object.__setattr__(self, 'd', d)
-
-            def __getitem__(self, key):
-                fmt = self.d.fmt.get(self.d.fields.get(key, key))
-                if fmt:
-                    return struct.pack(fmt, self.d[key])
-                else:
-                    return self.d[key]
-
-            __getattr__ = __getitem__
-
-            def __setitem__(self, key, val):
-                fmt = self.d.fmt.get(self.d.fields.get(key, key))
-                if fmt:
-                    self.d[key] = struct.unpack(fmt, val)[0]
-                else:
-                    self.d[key] = val
-
-            __setattr__ = __setitem__
-
         if key == 'b':
-            return wrap(self)
+            return _BinaryView(self)
         try:
             return self.__getitem__(key)
         except KeyError:
@@ -121,6 +100,146 @@ class HeaderDictionary(dict):
             return dict.__setattr__(self, key, val)
 
 
+_structs = {}
+
+
+def compiled_struct(fmt):
+    "Return the `struct.Struct` for the format string `fmt`, compiled once."
+    try:
+        return _structs[fmt]
+    except KeyError:
+        return _structs.setdefault(fmt, struct.Struct(fmt))
+
+
+class _BinaryView(object):
+    """
+    The `b` attribute of headers, gets and sets the values of fields with a
+    format in their packed form.
+    """
+    __slots__ = ('_header',)
+
+    def __init__(self, header):
+        object.__setattr__(self, '_header', header)
+
+    def _struct(self, key):
+        header = self._header
+        fmt = header.fmt.get(header.fields.get(key, key))
+        return compiled_struct(fmt) if fmt else None
+
+    def __getitem__(self, key):
+        packer = self._struct(key)
+        if packer:
+            return packer.pack(self._header[key])
+        else:
+            return self._header[key]
+
+    __getattr__ = __getitem__
+
+    def __setitem__(self, key, val):
+        packer = self._struct(key)
+        if packer:
+            self._header[key] = packer.unpack(val)[0]
+        else:
+            self._header[key] = val
+
+    __setattr__ = __setitem__
+
+
+class HeaderRecord(object):
+    """
+    The header of a KeePass file, with the interface of `HeaderDictionary`.
+
+    Unlike a `HeaderDictionary` the `fields` and `fmt` of a record are fixed
+    for its class, subclasses define them as class attributes next to an
+    empty `__slots__`. Instances only hold the field values by field id, so
+    creating and filling them is cheap when many headers are read.
+    """
+    __slots__ = ('_values',)
+    fields = {}
+    fmt = {}
+
+    def __init__(self, *args):
+        object.__setattr__(self, '_values', {})
+        if args:
+            for key, val in dict(*args).items():
+                self[key] = val
+
+    def _field_id(self, key):
+        if isinstance(key, int):
+            return key
+        return self.fields[key]
+
+    def __getitem__(self, key):
+        return self._values[self._field_id(key)]
+
+    def __setitem__(self, key, val):
+        self._values[self._field_id(key)] = val
+
+    def __delitem__(self, key):
+        del self._values[self._field_id(key)]
+
+    def __contains__(self, key):
+        try:
+            return self._field_id(key) in self._values
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, HeaderRecord):
+            other = other._values
+        return self._values == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._values)
+
+    def keys(self):
+        return self._values.keys()
+
+    def items(self):
+        return self._values.items()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getattr__(self, key):
+        if key == 'b':
+            return _BinaryView(self)
+        # private names are never fields, `_values` is missing while
+        # unpickling
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __getstate__(self):
+        return self._values
+
+    def __setstate__(self, state):
+        object.__setattr__(self, '_values', dict(state))
+
+    def __setattr__(self, key, val):
+        if key in self.fields:
+            self[key] = val
+        else:
+            object.__setattr__(self, key, val)
+
+
 # file baseclass
 
 import io
@@ -165,12 +284,26 @@ class KDBFile(object):
         return False
 
     def read_from(self, stream):
+        """
+        Read the file in `stream`, or in the stream of a `HeaderBuffer` with
+        the start of the file already read, like `open_stream` passes.
+        """
+        if isinstance(stream, HeaderBuffer):
+            header, stream = stream, stream.stream
+        else:
+            header = None
         if not self._is_file(stream):
             raise TypeError('Stream does not have the buffer interface.')
-        self._read_header(stream)
+        if header is None:
+            header = HeaderBuffer(stream)
+        self._read_header(header)
         self._decrypt(stream)
 
-    def _read_header(self, stream):
+    def _read_header(self, header):
+        """
+        Parse the header from the `HeaderBuffer` `header`, set
+        self.header_length.
+        """
         raise NotImplementedError('The _read_header method was not '
                                   'implemented propertly.')
 
@@ -303,9 +436,7 @@ def load_plain_keyfile(filename):
         return sha256(key)
     raise IOError('Could not read keyfile.')
 
-#
-
-import struct
+# reading headers
 
 
 def stream_unpack(stream, offset, length, typecode='I'):
@@ -315,10 +446,54 @@ def stream_unpack(stream, offset, length, typecode='I'):
     return struct.unpack('<' + typecode, data)[0]
 
 
-def read_signature(stream):
-    sig1 = stream_unpack(stream, 0, 4)
-    sig2 = stream_unpack(stream, None, 4)
-    # ver_minor = stream_unpack(stream, None, 2, 'h')
-    # ver_major = stream_unpack(stream, None, 2, 'h')
-    #return (sig1, sig2, ver_major, ver_minor)
-    return sig1, sig2
+# both signatures at the start of the file
+SIGNATURE = struct.Struct('<II')
+# bytes read at once when parsing a header, enough for most KDB4 headers
+HEADER_READ_SIZE = 4096
+
+
+def read_signature(header):
+    "Return both signatures at the start of the `HeaderBuffer` `header`."
+    return header.unpack(SIGNATURE, 0)
+
+
+class HeaderBuffer(object):
+    """
+    The start of a file, read in chunks of `HEADER_READ_SIZE` bytes and
+    parsed with precompiled `struct.Struct` objects::
+
+        >>> buf = HeaderBuffer(stream)
+        >>> sig1, sig2 = buf.unpack(SIGNATURE, 0)
+
+    More data is only read from `stream` when unpacking beyond the data read
+    so far, headers are usually parsed from a single read. `open_stream`
+    identifies the file by the signature in the buffer and passes it on to
+    the reader, which parses the header from the same data.
+    """
+    __slots__ = ('stream', 'data', 'view')
+
+    def __init__(self, stream, size=HEADER_READ_SIZE):
+        stream.seek(0)
+        self.stream = stream
+        self.data = stream.read(size)
+        self.view = memoryview(self.data)
+
+    def need(self, end):
+        "Make sure the first `end` bytes of the file are read."
+        if end > len(self.data):
+            more = self.stream.read(max(end - len(self.data),
+                                        HEADER_READ_SIZE))
+            self.data += more
+            self.view = memoryview(self.data)
+            if end > len(self.data):
+                raise IOError('Unexpected end of file in header.')
+
+    def unpack(self, packer, offset):
+        "Unpack the `struct.Struct` `packer` at `offset`."
+        self.need(offset + packer.size)
+        return packer.unpack_from(self.view, offset)
+
+    def read(self, offset, length):
+        "Return `length` bytes at `offset`."
+        self.need(offset + length)
+        return self.data[offset:offset + length]
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
+import io
 import hashlib
 import struct
 from Crypto.Cipher import AES, ChaCha20, Salsa20
+from Crypto.Util.strxor import strxor
 from libkeepass.twofish import Twofish
 
 AES_BLOCK_SIZE = 16
@@ -12,6 +14,11 @@ def sha256(s):
     return bytes(hashlib.sha256(s).digest())
 
 
+def sha512(s):
+    """Return SHA512 digest of the string `s`."""
+    return bytes(hashlib.sha512(s).digest())
+
+
 def transform_key(key, seed, rounds):
     """Transform `key` with `seed` `rounds` times using AES ECB."""
     # create transform cipher with transform seed
@@ -35,6 +42,21 @@ def aes_cbc_encrypt(data, key, enc_iv):
     return cipher.encrypt(data)
 
 
+def aes_cbc_cipher(key, enc_iv):
+    """Return an AES CBC cipher object for incremental use."""
+    return AES.new(key, AES.MODE_CBC, enc_iv)
+
+
+def chacha20_cipher(key, enc_iv):
+    """Return a ChaCha20 cipher object for incremental use."""
+    return ChaCha20.new(key=key, nonce=enc_iv)
+
+
+def twofish_cbc_cipher(key, enc_iv):
+    """Return a Twofish CBC cipher object for incremental use."""
+    return Twofish.new(key, Twofish.MODE_CBC, enc_iv)
+
+
 def chacha20_cbc_decrypt(data, key, enc_iv):
     """Decrypt and return `data` with ChaCha20."""
     cipher = ChaCha20.new(key=key, nonce=enc_iv)
@@ -71,4 +93,230 @@ def pad(s):
 
 def xor(aa, bb):
     """Return a bytearray of a bytewise XOR of `aa` and `bb`."""
-    return bytearray([a ^ b for a, b in zip(bytearray(aa), bytearray(bb))])
+    length = min(len(aa), len(bb))
+    if not length:
+        return bytearray()
+    return bytearray(strxor(bytes(aa[:length]), bytes(bb[:length])))
+
+
+class CipherWriter(io.RawIOBase):
+    """
+    Writable stream encrypting everything written to it with `cipher` (an
+    object keeping its chaining state between `encrypt` calls, eg. from
+    `aes_cbc_cipher`) in chunks of whole blocks, which are written to
+    `stream`. With `padded` PKCS7 padding is added on `close`, stream ciphers
+    are written with `padded=False`. The underlying `stream` is not closed.
+    """
+
+    # plaintext is collected to be encrypted in chunks of about this size
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream, cipher, padded=True):
+        io.RawIOBase.__init__(self)
+        self.stream = stream
+        self.cipher = cipher
+        self.padded = padded
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed stream.')
+        self._buffer.extend(data)
+        if len(self._buffer) >= self.CHUNK_SIZE:
+            length = len(self._buffer) - len(self._buffer) % AES_BLOCK_SIZE
+            self.stream.write(self.cipher.encrypt(bytes(self._buffer[:length])))
+            del self._buffer[:length]
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            data = bytes(self._buffer)
+            if self.padded:
+                data = pad(data)
+            if data:
+                self.stream.write(self.cipher.encrypt(data))
+            self._buffer = bytearray()
+        io.RawIOBase.close(self)
+
+
+class CipherReader(io.RawIOBase):
+    """
+    Readable stream of the data in `stream` decrypted with `cipher` (an
+    object keeping its chaining state between `decrypt` calls) in chunks of
+    whole blocks, the counterpart of `CipherWriter`. With `padded` the PKCS7
+    padding is removed, the last block is held back until the end of
+    `stream` is reached for that. Stream ciphers are read with
+    `padded=False`.
+    """
+
+    # ciphertext is read and decrypted in chunks of about this size
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream, cipher, padded=True):
+        io.RawIOBase.__init__(self)
+        self.stream = stream
+        self.cipher = cipher
+        self.padded = padded
+        self._encrypted = bytearray()
+        self._buffer = bytearray()
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        data = self.stream.read(self.CHUNK_SIZE)
+        if not data:
+            self._eof = True
+            if self._encrypted:
+                data = self.cipher.decrypt(bytes(self._encrypted))
+                self._buffer.extend(unpad(data) if self.padded else data)
+                self._encrypted = bytearray()
+            elif self.padded:
+                raise IOError('Missing padding at end of encrypted data.')
+            return
+        self._encrypted.extend(data)
+        length = len(self._encrypted)
+        if self.padded:
+            # keep the last, possibly padded block
+            length -= length % AES_BLOCK_SIZE or AES_BLOCK_SIZE
+        if length > 0:
+            self._buffer.extend(self.cipher.decrypt(
+                bytes(self._encrypted[:length])))
+            del self._encrypted[:length]
+
+    def readinto(self, b):
+        while not self._buffer and not self._eof:
+            self._fill()
+        length = min(len(b), len(self._buffer))
+        b[:length] = self._buffer[:length]
+        del self._buffer[:length]
+        return length
+
+
+def xor_many(chunks, keystream):
+    """
+    XOR the concatenation of the byte strings in `chunks` with `keystream` in
+    a single call. Returns the list of results, split like `chunks`.
+    """
+    data = b''.join(chunks)
+    if not data:
+        return [b'' for chunk in chunks]
+    mixed = strxor(data, bytes(keystream[:len(data)]))
+    result = []
+    pos = 0
+    for chunk in chunks:
+        end = pos + len(chunk)
+        result.append(mixed[pos:end])
+        pos = end
+    return result
+
+
+def _rotl32(v, c):
+    return ((v << c) & 0xffffffff) | (v >> (32 - c))
+
+
+def _salsa20_quarterround(x, a, b, c, d):
+    x[b] ^= _rotl32((x[a] + x[d]) & 0xffffffff, 7)
+    x[c] ^= _rotl32((x[b] + x[a]) & 0xffffffff, 9)
+    x[d] ^= _rotl32((x[c] + x[b]) & 0xffffffff, 13)
+    x[a] ^= _rotl32((x[d] + x[c]) & 0xffffffff, 18)
+
+
+def salsa20_block(key, nonce, counter):
+    """
+    Return the 64 byte Salsa20/20 keystream block number `counter` for a 32
+    byte `key` and 8 byte `nonce`. This allows to seek in the keystream,
+    which the pycryptodome Salsa20 does not.
+    """
+    c = struct.unpack('<4I', b'expand 32-byte k')
+    k = struct.unpack('<8I', key)
+    n = struct.unpack('<2I', nonce)
+    state = [c[0], k[0], k[1], k[2], k[3], c[1], n[0], n[1],
+             counter & 0xffffffff, counter >> 32, c[2], k[4], k[5], k[6], k[7],
+             c[3]]
+    x = list(state)
+    for _ in range(10):
+        # column round
+        _salsa20_quarterround(x, 0, 4, 8, 12)
+        _salsa20_quarterround(x, 5, 9, 13, 1)
+        _salsa20_quarterround(x, 10, 14, 2, 6)
+        _salsa20_quarterround(x, 15, 3, 7, 11)
+        # row round
+        _salsa20_quarterround(x, 0, 1, 2, 3)
+        _salsa20_quarterround(x, 5, 6, 7, 4)
+        _salsa20_quarterround(x, 10, 11, 8, 9)
+        _salsa20_quarterround(x, 15, 12, 13, 14)
+    return struct.pack('<16I', *[(a + b) & 0xffffffff for a, b in zip(x, state)])
+
+
+def chacha20_block(key, nonce, counter):
+    "Return the 64 byte ChaCha20 keystream block with number `counter`."
+    cipher = ChaCha20.new(key=key, nonce=nonce)
+    cipher.seek(counter * 64)
+    return cipher.encrypt(bytes(bytearray(64)))
+
+
+class KeyStream(object):
+    """
+    The keystream of a stream cipher (eg. Salsa20), generated in large chunks
+    and handed out by offset.
+
+    `new_cipher` is a callable returning a freshly initialized cipher object
+    with an `encrypt` method. The generated keystream is kept, so rewinding
+    and reading it again (eg. to protect values that were unprotected
+    before) does not run the cipher again.
+
+    If `block_at` is given, it is a callable returning the 64 byte keystream
+    block with the given number. `get` then uses it to seek to sections
+    beyond the generated keystream instead of generating everything before.
+    """
+
+    # keystream is generated in multiples of this
+    CHUNK_SIZE = 64 * 1024
+    BLOCK_SIZE = 64
+
+    def __init__(self, new_cipher, block_at=None):
+        self._cipher = new_cipher()
+        self._block_at = block_at
+        self._buffer = bytearray()
+        self.offset = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def reserve(self, length):
+        """
+        Make sure at least `length` bytes of keystream are available with a
+        single call to the cipher.
+        """
+        missing = length - len(self._buffer)
+        if missing > 0:
+            missing += -missing % self.CHUNK_SIZE
+            self._buffer.extend(self._cipher.encrypt(bytes(bytearray(missing))))
+
+    def get(self, offset, length):
+        "Return `length` bytes of keystream starting at `offset`."
+        end = offset + length
+        if end > len(self._buffer) and self._block_at is not None:
+            first = offset // self.BLOCK_SIZE
+            last = (end - 1) // self.BLOCK_SIZE
+            data = b''.join(self._block_at(i) for i in range(first, last + 1))
+            start = offset - first * self.BLOCK_SIZE
+            return bytearray(data[start:start + length])
+        self.reserve(end)
+        return self._buffer[offset:end]
+
+    def read(self, length):
+        "Return the next `length` bytes of keystream."
+        self.reserve(self.offset + length)
+        data = self._buffer[self.offset:self.offset + length]
+        self.offset += length
+        return data
+
+    def rewind(self):
+        "Start reading at offset 0 again."
+        self.offset = 0
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import io
+import hmac
 import struct
 import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 # default from KeePass2 source
 BLOCK_LENGTH = 1024 * 1024
@@ -107,3 +110,204 @@ class HashedBlockIO(io.BytesIO):
                 stream.write(struct.pack('<I', 0))
                 break
 
+
+class HashedBlockWriter(io.RawIOBase):
+    """
+    Writable stream formatting everything written to it in hashed blocks like
+    `HashedBlockIO.write_block_stream`, but without keeping all the data.
+    Complete blocks are written to `stream` as soon as they are filled, the
+    last block and the terminating empty block are written on `close`. The
+    underlying `stream` is not closed.
+    """
+
+    def __init__(self, stream, block_length=BLOCK_LENGTH):
+        io.RawIOBase.__init__(self)
+        self.stream = stream
+        self.block_length = block_length
+        self.index = 0
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed stream.')
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_length:
+            self._write_block(bytes(self._buffer[:self.block_length]))
+            del self._buffer[:self.block_length]
+        return len(data)
+
+    def _write_block(self, data):
+        self.stream.write(struct.pack('<I', self.index))
+        if data:
+            self.stream.write(hashlib.sha256(data).digest())
+        else:
+            self.stream.write(b'\x00' * 32)
+        self.stream.write(struct.pack('<I', len(data)))
+        self.stream.write(data)
+        self.index += 1
+
+    def close(self):
+        if not self.closed:
+            if self._buffer:
+                self._write_block(bytes(self._buffer))
+                self._buffer = bytearray()
+            self._write_block(b'')
+        io.RawIOBase.close(self)
+
+
+# block index and length authenticated with the data of HMAC blocks
+HMAC_BLOCK_INDEX = struct.Struct('<Q')
+HMAC_BLOCK_LENGTH = struct.Struct('<i')
+
+
+def hmac_block_key(key, index):
+    """
+    Return the HMAC-SHA256 key of the block with `index` in a HMAC block
+    stream with the 64 byte `key`.
+    """
+    return hashlib.sha512(HMAC_BLOCK_INDEX.pack(index) + key).digest()
+
+
+def _block_hmac(key, index, length, data):
+    mac = hmac.new(hmac_block_key(key, index), digestmod=hashlib.sha256)
+    mac.update(HMAC_BLOCK_INDEX.pack(index))
+    mac.update(length)
+    mac.update(data)
+    return mac.digest()
+
+
+def _verify_block(key, index, bhmac, length, data):
+    if not hmac.compare_digest(_block_hmac(key, index, length, data), bhmac):
+        raise IOError('Block HMAC mismatch error.')
+    return data
+
+
+class HmacBlockIO(io.RawIOBase):
+    """
+    Readable stream of the data in a HMAC block stream (KDBX 4). Each block
+    consists of a HMAC-SHA256 (32 bytes) and the block length (4 bytes),
+    followed by the block data. The HMAC covers the block index (8 bytes,
+    counting from 0), the length and the data, its key is derived from `key`
+    and the index with `hmac_block_key`. An empty block ends the stream.
+
+    Unlike `HashedBlockIO` the blocks are read from `block_stream` and
+    verified lazily as the data is read, so only a few blocks are in memory
+    at any time. With `workers` > 1 that many consecutive blocks are read
+    ahead and verified in parallel on a thread pool. An IOError is raised
+    when reaching a block that does not verify.
+    """
+
+    def __init__(self, block_stream, key, workers=1):
+        io.RawIOBase.__init__(self)
+        self.block_stream = block_stream
+        self.key = key
+        self.workers = workers
+        self.index = 0
+        self._executor = None
+        # blocks read ahead, futures if verified on the thread pool
+        self._pending = collections.deque()
+        self._last_read = False
+        self._eof = False
+        self._buffer = b''
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def _read_block(self):
+        bhmac = self.block_stream.read(32)
+        length = self.block_stream.read(HMAC_BLOCK_LENGTH.size)
+        if len(bhmac) != 32 or len(length) != HMAC_BLOCK_LENGTH.size:
+            raise IOError('Unexpected end of block stream.')
+        size, = HMAC_BLOCK_LENGTH.unpack(length)
+        if size < 0:
+            raise IOError('Invalid block length.')
+        data = self.block_stream.read(size) if size else b''
+        if len(data) != size:
+            raise IOError('Unexpected end of block stream.')
+        args = (self.key, self.index, bhmac, length, data)
+        self.index += 1
+        self._last_read = not data
+        if self.workers > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._pending.append(self._executor.submit(_verify_block, *args))
+        else:
+            self._pending.append(_verify_block(*args))
+
+    def _next_block(self):
+        while not self._last_read and len(self._pending) < self.workers:
+            self._read_block()
+        data = self._pending.popleft()
+        if not isinstance(data, bytes):
+            data = data.result()
+        if not data:
+            self._eof = True
+            self._shutdown()
+        return data
+
+    def readinto(self, b):
+        while self._pos >= len(self._buffer):
+            if self._eof:
+                return 0
+            self._buffer, self._pos = self._next_block(), 0
+        length = min(len(b), len(self._buffer) - self._pos)
+        b[:length] = self._buffer[self._pos:self._pos + length]
+        self._pos += length
+        return length
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._pending.clear()
+
+    def close(self):
+        self._shutdown()
+        io.RawIOBase.close(self)
+
+
+class HmacBlockWriter(io.RawIOBase):
+    """
+    Writable stream formatting everything written to it in HMAC blocks for
+    `HmacBlockIO`, like `HashedBlockWriter` does for hashed blocks. The
+    underlying `stream` is not closed.
+    """
+
+    def __init__(self, stream, key, block_length=BLOCK_LENGTH):
+        io.RawIOBase.__init__(self)
+        self.stream = stream
+        self.key = key
+        self.block_length = block_length
+        self.index = 0
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed stream.')
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.block_length:
+            self._write_block(bytes(self._buffer[:self.block_length]))
+            del self._buffer[:self.block_length]
+        return len(data)
+
+    def _write_block(self, data):
+        length = HMAC_BLOCK_LENGTH.pack(len(data))
+        self.stream.write(_block_hmac(self.key, self.index, length, data))
+        self.stream.write(length)
+        self.stream.write(data)
+        self.index += 1
+
+    def close(self):
+        if not self.closed:
+            if self._buffer:
+                self._write_block(bytes(self._buffer))
+                self._buffer = bytearray()
+            self._write_block(b'')
+        io.RawIOBase.close(self)
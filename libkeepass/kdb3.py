@@ -8,13 +8,17 @@ import base64
 import random
 import datetime
 import warnings
+from array import array
+from codecs import utf_8_decode
+from collections.abc import MutableMapping
+from sys import intern
 from binascii import * # for entry id
 
 from libkeepass.crypto import xor, sha256, aes_cbc_decrypt, twofish_cbc_decrypt
 from libkeepass.crypto import transform_key, unpad
 
-from libkeepass.common import IS_PYTHON_3, load_keyfile, stream_unpack, read_signature
-from libkeepass.common import KDBFile, HeaderDictionary
+from libkeepass.common import IS_PYTHON_3, load_keyfile
+from libkeepass.common import KDBFile, HeaderRecord, SIGNATURE
 
 
 KDB3_SIGNATURE = (0x9AA2D903, 0xB54BFB65)
@@ -30,7 +34,9 @@ def parse_null_turminated(a_string):
     return a_string.decode('utf8')
 
 
-class KDB3Header(HeaderDictionary):
+class KDB3Header(HeaderRecord):
+    __slots__ = ()
+
     fields = {
         # encryption type/flag
         'Flags': 0,
@@ -63,30 +69,342 @@ class KDB3Header(HeaderDictionary):
     }
 
 
+# the whole fixed length header, signatures followed by the fields in the
+# order of their ids
+KDB3_HEADER = struct.Struct(SIGNATURE.format + ''.join(
+    KDB3Header.fmt[field_id].lstrip('<') if field_id in KDB3Header.fmt
+    else '{}s'.format(length)
+    for field_id, length in enumerate(KDB3Header.lengths)))
+
+
+# type and size of a field in the body, fields of type END_OF_RECORD end a
+# group or entry
+FIELD_HEAD = struct.Struct('<HI')
+END_OF_RECORD = 0xFFFF
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+DATE = struct.Struct('<5B')
+# the 5 date bytes read as one big endian number
+PACKED_DATE = struct.Struct('>IB')
+# group id and expanded flag of the KPX_GROUP_TREE_STATE metastream
+GROUP_STATE = struct.Struct('<IB')
+
+
+# decoded dates by their packed value and the packed values, most dates of a
+# file are the same
+_dates = {}
+_packed_dates = {}
+DATE_CACHE_SIZE = 4096
+
+
+def unpack_date(packed):
+    "Decode a date packed into a 40 bit number as stored in KDB3 files."
+    date = _dates.get(packed)
+    if date is None:
+        if len(_dates) >= DATE_CACHE_SIZE:
+            _dates.clear()
+        date = _dates[packed] = datetime.datetime(
+            (packed >> 26) & 0x3fff, (packed >> 22) & 0xf,
+            (packed >> 17) & 0x1f, (packed >> 12) & 0x1f,
+            (packed >> 6) & 0x3f, packed & 0x3f)
+    return date
+
+
+def parse_date(buf, pos=0):
+    "Decode the packed 5 byte date at `pos` of `buf`."
+    high, low = PACKED_DATE.unpack_from(buf, pos)
+    return unpack_date((high << 8) | low)
+
+
+# field decoders, called with the body, field position and size
+
+def _uint16(buf, pos, size):
+    return UINT16.unpack_from(buf, pos)[0]
+
+
+def _uint32(buf, pos, size):
+    return UINT32.unpack_from(buf, pos)[0]
+
+
+def _text(buf, pos, size):
+    return utf_8_decode(buf[pos:pos + size])[0].replace(u'\x00', u'')
+
+
+def _interned_text(buf, pos, size):
+    "Decode text most records share, like group titles and user names."
+    return intern(_text(buf, pos, size))
+
+
+def _date(buf, pos, size):
+    "Read a date as packed number, it is decoded when the field is read."
+    high, low = PACKED_DATE.unpack_from(buf, pos)
+    packed = (high << 8) | low
+    # equal dates share one number
+    shared = _packed_dates.get(packed)
+    if shared is None:
+        if len(_packed_dates) >= DATE_CACHE_SIZE:
+            _packed_dates.clear()
+        shared = _packed_dates[packed] = packed
+    return shared
+
+
+def _hex(buf, pos, size):
+    return b2a_hex(buf[pos:pos + size]).decode('ascii')
+
+
+def _bytes(buf, pos, size):
+    return buf[pos:pos + size].tobytes()
+
+
+# fields kept packed until they are read, in slots named with a leading '_'
+DATE_NAMES = ('created', 'modified', 'accessed', 'expires')
+
+
+_UNSET = object()
+
+
+def _slot_pairs(names):
+    "Return the pairs of field name and slot name of `names`."
+    return tuple((name, '_' + name if name in DATE_NAMES else name)
+                 for name in names)
+
+
+def _date_field(slot):
+    "Property of a date kept packed in `slot` until it is read."
+    def get(self):
+        value = getattr(self, slot)
+        if value.__class__ is int:
+            return unpack_date(value)
+        return value
+
+    def set(self, value):
+        setattr(self, slot, value)
+
+    def delete(self):
+        delattr(self, slot)
+    return property(get, set, delete)
+
+
+class KDB3Record(MutableMapping):
+    """
+    Base of the groups and entries of KDB3 files. The fields are slots
+    instead of dict items and dates stay packed until they are read, but
+    records can be used like the dicts the reader returned before:
+    ``entry['title']``, ``'groups' in group``, ``entry.get('binary')`` and
+    ``'{title}'.format(**entry)``. Keys that are not fields (eg. unknown
+    fields of the file) are kept in an extra dict. `copy` returns a dict.
+    """
+    __slots__ = ('_extra',)
+
+    # field names in iteration order, their slots and the pairs of both
+    names = ()
+    _names = frozenset()
+    _slots = {}
+    _slot_names = ()
+    # slot name and decoder by field type, fields with slot None are skipped
+    fields = {}
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self._names:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._names:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._names:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self._names:
+            return hasattr(self, self._slots[key])
+        return self._extra is not None and key in self._extra
+
+    def keys(self):
+        "Return the keys that are set as list, fields first."
+        # presence is checked on the slots, dates are not decoded
+        keys = [name for name, slot in self._slot_names
+                if hasattr(self, slot)]
+        if self._extra is not None:
+            keys.extend(self._extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.copy())
+
+    def copy(self):
+        "Return the fields as dict, dates decoded."
+        record = {}
+        for name in self.names:
+            value = getattr(self, name, _UNSET)
+            if value is not _UNSET:
+                record[name] = value
+        if self._extra is not None:
+            record.update(self._extra)
+        return record
+
+
+class KDB3Group(KDB3Record):
+    __slots__ = ('group_id', 'title', '_created', '_modified', '_accessed',
+                 '_expires', 'icon', 'level', 'groups', 'expanded', 'path')
+
+    names = ('group_id', 'title', 'created', 'modified', 'accessed',
+             'expires', 'icon', 'level', 'groups', 'expanded', 'path')
+    _names = frozenset(names)
+    _slot_names = _slot_pairs(names)
+    _slots = dict(_slot_names)
+
+    fields = {
+        1: ('group_id', _uint32),
+        2: ('title', _interned_text),
+        3: ('_created', _date),
+        4: ('_modified', _date),
+        5: ('_accessed', _date),
+        6: ('_expires', _date),
+        7: ('icon', _uint32),
+        8: ('level', _uint16),
+        # flags are ignored
+        9: (None, None),
+    }
+
+    created = _date_field('_created')
+    modified = _date_field('_modified')
+    accessed = _date_field('_accessed')
+    expires = _date_field('_expires')
+
+
+class KDB3Entry(KDB3Record):
+    __slots__ = ('id', 'group_id', 'group', 'icon', 'title', 'url',
+                 'username', 'password', 'notes', '_created', '_modified',
+                 '_accessed', '_expires', 'bin_desc', 'binary')
+
+    names = ('id', 'group_id', 'group', 'icon', 'title', 'url', 'username',
+             'password', 'notes', 'created', 'modified', 'accessed',
+             'expires', 'bin_desc', 'binary')
+    _names = frozenset(names)
+    _slot_names = _slot_pairs(names)
+    _slots = dict(_slot_names)
+
+    fields = {
+        1: ('id', _hex),
+        2: ('group_id', _uint32),
+        3: ('icon', _uint32),
+        4: ('title', _text),
+        5: ('url', _text),
+        6: ('username', _interned_text),
+        7: ('password', _text),
+        8: ('notes', _text),
+        9: ('_created', _date),
+        0xA: ('_modified', _date),
+        0xB: ('_accessed', _date),
+        0xC: ('_expires', _date),
+        0xD: ('bin_desc', _interned_text),
+        0xE: ('binary', _bytes),
+    }
+
+    created = _date_field('_created')
+    modified = _date_field('_modified')
+    accessed = _date_field('_accessed')
+    expires = _date_field('_expires')
+
+
+def iter_records(buf, pos, count, record_type, kind):
+    """
+    Decode `count` records of `record_type` (`KDB3Group` or `KDB3Entry`, as
+    named by `kind`) from `pos` of the body in the memoryview `buf`. Yields
+    each record with the position after it. Unknown fields are kept as bytes
+    under 'unknown_<type>'.
+    """
+    unpack_head = FIELD_HEAD.unpack_from
+    head_size = FIELD_HEAD.size
+    fields = record_type.fields
+    end = len(buf)
+    record = record_type()
+    while count:
+        try:
+            field_type, size = unpack_head(buf, pos)
+        except struct.error:
+            raise ValueError("%s header offset is out of range. (%d)" %
+                             (kind, pos))
+        pos += head_size
+        field_end = pos + size
+        if field_end > end:
+            raise ValueError("%s header offset is out of range. (%d, %d)" %
+                             (kind, pos, size))
+        if field_type == END_OF_RECORD:
+            count -= 1
+            yield record, field_end
+            record = record_type()
+        else:
+            field = fields.get(field_type)
+            if field is None:
+                record['unknown_%x' % field_type] = buf[pos:field_end].tobytes()
+            elif field[0] is not None:
+                setattr(record, field[0], field[1](buf, pos, size))
+        pos = field_end
+
+
+METASTREAM_TITLE = b'Meta-Info'
+
+
+def is_metastream(entry):
+    "Whether `entry` is a metastream entry storing data of the application."
+    return entry.get('title') == 'Meta-Info' and \
+        entry.get('username') == 'SYSTEM' and entry.get('url') == '$'
+
+
 class KDB3File(KDBFile):
     def __init__(self, stream=None, **credentials):
         self.header = KDB3Header()
         KDBFile.__init__(self, stream, **credentials)
 
-    def _read_header(self, stream):
+    def _read_header(self, buf):
         """
-        Parses the header and write the values into self.header. Also sets
-        self.header_length.
+        Parses the header in the `HeaderBuffer` `buf` and write the values
+        into self.header. Also sets self.header_length.
         """
         # kdb3 has a fixed header length
         self.header_length = 124
+        if self.header_length != KDB3_HEADER.size:
+            raise IOError('Unexpected header length! What did you do!?')
+
+        values = buf.unpack(KDB3_HEADER, 0)
 
         # verify the file signature
-        signature = read_signature(stream)
+        signature = values[:2]
         assert signature == KDB3_SIGNATURE, signature
 
-        for field_id, length in enumerate(self.header.lengths):
-            data = stream_unpack(stream, None, length, '{}s'.format(length))
-            self.header.b[field_id] = data
-
-        # this is impossible, as long as noone messes with self.header.lengths
-        if self.header_length != stream.tell():
-            raise IOError('Unexpected header length! What did you do!?')
+        for field_id, value in enumerate(values[2:]):
+            self.header[field_id] = value
 
     def _decrypt(self, stream):
         super(KDB3File, self)._decrypt(stream)
@@ -129,295 +447,382 @@ class KDB3File(KDBFile):
         self.master_key = sha256(self.header.MasterSeed + tkey)
 
 
-from xml.sax.saxutils import escape
 from lxml import etree
 
+XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8' standalone='yes'?>\n"
+XML_TIME = '%Y-%m-%dT%H:%M:%S'
+# formatted times by date, like the decoded dates most are the same
+_xml_times = {}
+PWENTRY_INDENT = '\n        '
+# expiry date of entries that do not expire
+NEVER_EXPIRES = datetime.datetime(2999, 12, 28, 23, 59, 59)
+
+
+def format_xml_time(date):
+    "Format `date` as time of the KeePass 1.x XML export."
+    text = _xml_times.get(date)
+    if text is None:
+        if len(_xml_times) >= DATE_CACHE_SIZE:
+            _xml_times.clear()
+        text = _xml_times[date] = date.strftime(XML_TIME)
+    return text
+
+
+def xml_text(value):
+    """
+    Return the text of an element for `value`: None for empty values, which
+    are written as ``<notes/>``, line breaks as the XML parser reads them.
+    """
+    if not value:
+        return None
+    if '\r' in value:
+        value = value.replace('\r\n', '\n').replace('\r', '\n')
+    return value
+
+
 class KDBExtension:
     """
     The KDB3 payload is a binary blob of groups followed by entries.
+
+    The groups are decoded on load. Entries are decoded from the decrypted
+    buffer when `entries` is first used, or one at a time by `iter_entries`,
+    which keeps none of them.
     """
     # Liberally copied from https://github.com/shirou/kptool/blob/master/kptool/keepassdb/keepassdb.py
 
     def __init__(self):
         self.in_buffer.seek(0)
-        self.entries_by_id = {}
-        self.groups_by_id = {}
-        self.icons = []
-        self.metainfo = []
-        self.groups, self.entries = self._parse_body()
+        self._groups_by_id = {}
+        self._entries = None
+        self._entries_by_id = None
+        # set by _scan_entries: metastreams and custom entry icons by id
+        self._scanned = False
+        self._icons = []
+        self._metainfo = []
+        self._entry_icons = {}
+        self._entry_offsets = None
+        self._groups, self._entries_pos = self._parse_groups(
+            self._body(), self.header.Groups)
+
+    @property
+    def groups(self):
+        "The groups, with the *Orphaned* group if entries need it."
+        self._scan_entries()
+        return self._groups
+
+    @property
+    def groups_by_id(self):
+        self._scan_entries()
+        return self._groups_by_id
+
+    @property
+    def entries(self):
+        "All entries, decoded on first use."
+        if self._entries is None:
+            entries = list(self.iter_entries())
+            self._entries_by_id = dict((entry['id'], entry)
+                                       for entry in entries)
+            self._entries = entries
+        return self._entries
+
+    @property
+    def entries_by_id(self):
+        self.entries
+        return self._entries_by_id
+
+    @property
+    def icons(self):
+        "Custom icons of the KPX_CUSTOM_ICONS_4 metastream."
+        self._scan_entries()
+        return self._icons
+
+    @property
+    def metainfo(self):
+        "Metastream entries not handled by the reader."
+        self._scan_entries()
+        return self._metainfo
+
+    def iter_groups(self):
+        "Yield the groups in file order."
+        return iter(self.groups)
+
+    def iter_entries(self, group_id=None):
+        """
+        Yield the entries in file order, each decoded from the decrypted
+        buffer when it is reached. Unless `entries` was used before, the
+        entries are not kept, so large files can be exported with little
+        memory. With `group_id` only the entries of that group (-1 for the
+        *Orphaned* group) are decoded and yielded.
+        """
+        if self._entries is not None:
+            for entry in self._entries:
+                if group_id is None or entry['group_id'] == group_id:
+                    yield entry
+            return
+        self._scan_entries()
+        buf = self._body()
+        if group_id is None:
+            records = (entry for entry, pos in iter_records(
+                buf, self._entries_pos, self.header.Entries, KDB3Entry,
+                'Entry'))
+        else:
+            records = (next(iter_records(buf, start, 1, KDB3Entry, 'Entry'))[0]
+                       for start in self._entry_offsets.get(group_id, ()))
+        entry_icons = self._entry_icons
+        for entry in records:
+            if is_metastream(entry):
+                continue
+            self._resolve_group(entry)
+            if entry_icons and entry.get('id') in entry_icons:
+                entry['icon'] = entry_icons[entry['id']]
+            yield entry
+
+    def write_xml(self, stream):
+        """
+        Write the entries as KeePass 1.x XML (``<pwlist>``) to the binary
+        `stream`. The entries are decoded and written one at a time, so the
+        memory used does not grow with the database.
+        """
+        stream.write(XML_DECLARATION)
+        with etree.xmlfile(stream, encoding='utf-8') as xf:
+            with xf.element('pwlist'):
+                xf.write('\n')
+                for i, entry in enumerate(self.iter_entries()):
+                    if i:
+                        xf.write('\n')
+                    xf.write(self._pwentry(entry))
+                xf.write('\n')
+        stream.write(b'\n')
 
     def pretty_print(self, print_=False):
-        """Return a serialization of the element tree."""
-        pwentries = []
-        for entry in self.entries:
-            entry = entry.copy()
-            for field in ('title', 'username', 'url', 'password', 'notes'):
-                entry[field] = escape(entry[field])
-            entry['group'] = escape(entry['group'])
-            entry['grp_tree_attr'] = ''
-            if 'groups' in self.groups_by_id[entry['group_id']]:
-                parent_group_id = self.groups_by_id[entry['group_id']]['groups']
-                entry['grp_tree_attr'] = ' tree="{}"'.format(escape(self._get_group_path(parent_group_id)))
-            entry['expire_valid'] = (entry['expires'] != datetime.datetime(2999, 12, 28, 23, 59, 59))
-            
-            pwentries.append(u"""\
-<pwentry>
-        <group{grp_tree_attr}>{group}</group>
-        <title>{title}</title>
-        <username>{username}</username>
-        <url>{url}</url>
-        <password>{password}</password>
-        <notes>{notes}</notes>
-        <uuid>{id}</uuid>
-        <image>{icon}</image>
-        <creationtime>{created:%Y-%m-%dT%H:%M:%S}</creationtime>
-        <lastmodtime>{modified:%Y-%m-%dT%H:%M:%S}</lastmodtime>
-        <lastaccesstime>{accessed:%Y-%m-%dT%H:%M:%S}</lastaccesstime>
-        <expiretime expires="{expire_valid}">{expires:%Y-%m-%dT%H:%M:%S}</expiretime>
-</pwentry>""".format(**entry))
-        
-        self.obj_root = etree.fromstring(u"""\
-<pwlist>
-{pwentries}
-</pwlist>""".format(pwentries='\n'.join(pwentries)))
-        
-        pp = etree.tostring(self.obj_root, pretty_print=True,
-                            encoding='utf-8', standalone=True)
+        """Return the entries as KeePass 1.x XML, see `write_xml`."""
+        out = io.BytesIO()
+        self.write_xml(out)
+        pp = out.getvalue()
         if print_ and IS_PYTHON_3:
             pp = str(pp, encoding='utf-8')
         return pp
 
+    def _pwentry(self, entry):
+        "Return the ``<pwentry>`` element of `entry`."
+        pwentry = etree.Element('pwentry')
+        pwentry.text = PWENTRY_INDENT
+        group = self.groups_by_id[entry.group_id]
+        child = etree.SubElement(pwentry, 'group')
+        if 'groups' in group:
+            child.set('tree', self._get_group_path(group['groups']))
+        child.text = entry.group
+        child.tail = PWENTRY_INDENT
+        for tag, value in (
+                ('title', entry.title),
+                ('username', entry.username),
+                ('url', entry.url),
+                ('password', entry.password),
+                ('notes', entry.notes),
+                ('uuid', entry.id),
+                ('image', str(entry.icon)),
+                ('creationtime', format_xml_time(entry.created)),
+                ('lastmodtime', format_xml_time(entry.modified)),
+                ('lastaccesstime', format_xml_time(entry.accessed))):
+            child = etree.SubElement(pwentry, tag)
+            child.text = xml_text(value)
+            child.tail = PWENTRY_INDENT
+        expires = entry.expires
+        child = etree.SubElement(pwentry, 'expiretime',
+                                 expires=str(expires != NEVER_EXPIRES))
+        child.text = format_xml_time(expires)
+        child.tail = '\n'
+        return pwentry
+
     def write_to(self, stream):
         """Serialize the element tree to the out-buffer."""
         if self.out_buffer is None:
             self.out_buffer = io.BytesIO(self.pretty_print())
 
-    def _parse_body(self):
-        groups, pos = self._parse_groups(self.in_buffer.getbuffer().tobytes(), self.header.Groups)
-        entries = self._parse_entries(self.in_buffer.getbuffer().tobytes(), self.header.Entries, pos, groups)
-        return (groups, entries)
+    def _body(self):
+        """
+        Return a memoryview of the decrypted body. It views the bytes of the
+        in-buffer, so the buffer can be closed while views are in use.
+        """
+        return memoryview(self.in_buffer.getvalue())
 
     def _parse_groups(self, buf, n_groups):
+        """
+        Decode the `n_groups` groups at the start of the body `buf` and link
+        them to their parents. Returns the groups and the end position.
+        """
         pos = 0
         previous_level = 0
         group_stack = []
         groups = []
-        group = {}
-        while(n_groups):
-            m_type = struct.unpack("<H", buf[pos:pos+2])[0]
-            pos += 2
-            if pos >= len(buf):
-                raise ValueError("Group header offset is out of range. ($pos)")
-            size = struct.unpack("<L", buf[pos:pos+4])[0]
-            pos += 4
-            if (pos + size) > len(buf):
-                raise ValueError("Group header offset is out of range. ($pos, $size)")
-            if (m_type == 1):
-                group['group_id'] = struct.unpack("<L", buf[pos:pos+4])[0]
-            elif (m_type == 2):
-                group['title'] = parse_null_turminated(buf[pos:pos+size])
-            elif (m_type == 3):
-                group['created'] = self._parse_date(buf, pos, size)
-            elif (m_type == 4):
-                group['modified'] = self._parse_date(buf, pos, size)
-            elif (m_type == 5):
-                group['accessed'] = self._parse_date(buf, pos, size)
-            elif (m_type == 6):
-                group['expires'] = self._parse_date(buf, pos, size)
-            elif (m_type == 7):
-                group['icon'] = struct.unpack("<L", buf[pos:pos+4])[0]
-            elif (m_type == 8):
-                group['level'] = struct.unpack("<H", buf[pos:pos+2])[0]
-            elif (m_type == 9):
-                # flags ignore
-                pass
-            elif (m_type == 0xFFFF): # end of a group
-                n_groups -= 1
-                if ('level' in group):
-                    level = group['level']
-                else:
-                    level = 0
-                
-                if not group_stack:
-                    assert level < 1, group
-                    group_stack.append(group)
-                elif previous_level < level:
-                    assert previous_level == level-1, (previous_level, level)
-                    group['groups'] = group_stack[-1]['group_id']
-                    group_stack.append(group)
-                elif previous_level == level:
-                    if level > 0:
-                        group['groups'] = group_stack[-1]['groups']
-                    group_stack[-1] = group
-                elif previous_level > level:
-                    group_stack[level-previous_level:] = []
-                    if level > 0:
-                        group['groups'] = group_stack[-1]['groups']
-                    group_stack[-1] = group
-                previous_level = level
-                assert group['level'] <= 0 or 'groups' in group, group
-                
-                self.groups_by_id[group['group_id']] = group
-                groups.append(group)
-                group = {}
-            else:
-                group['unknown_%x'%m_type] = buf[pos:pos+size]
-                
-            pos += size;
+        for group, pos in iter_records(buf, 0, n_groups, KDB3Group,
+                                       'Group'):
+            level = group.get('level', 0)
+            if not group_stack:
+                assert level < 1, group
+                group_stack.append(group)
+            elif previous_level < level:
+                assert previous_level == level-1, (previous_level, level)
+                group['groups'] = group_stack[-1]['group_id']
+                group_stack.append(group)
+            elif previous_level == level:
+                if level > 0:
+                    group['groups'] = group_stack[-1]['groups']
+                group_stack[-1] = group
+            elif previous_level > level:
+                group_stack[level-previous_level:] = []
+                if level > 0:
+                    group['groups'] = group_stack[-1]['groups']
+                group_stack[-1] = group
+            previous_level = level
+            assert level <= 0 or 'groups' in group, group
+
+            self._groups_by_id[group['group_id']] = group
+            groups.append(group)
 
         return groups, pos
 
-    def _parse_entries(self, buf, n_entries, pos, groups):
-        entry = {}
-        entries = []
-        while(n_entries):
-            m_type = struct.unpack("<H", buf[pos:pos+2])[0]
-            pos += 2;
-            if pos >= len(buf):
-                raise ValueError("Entry header offset is out of range. ($pos)")
-            size = struct.unpack('<L', buf[pos:pos+4])[0]
-            pos += 4
-            if (pos + size) > len(buf):
-                raise ValueError("Entry header offset is out of range. ($pos, $size)" )
-            if (m_type == 1):
-                entry['id'] = parse_null_turminated(b2a_hex(buf[pos:pos+size]))
-            elif (m_type == 2):
-                entry['group_id'] = struct.unpack('<L', buf[pos:pos+4])[0]
-                entry['group'] = self.groups_by_id[entry['group_id']]['title']
-            elif (m_type == 3):
-                entry['icon'] = struct.unpack('<L', buf[pos:pos+4])[0]
-            elif (m_type == 4):
-                entry['title'] = parse_null_turminated(buf[pos:pos+size])
-            elif (m_type == 5):
-                entry['url'] = parse_null_turminated(buf[pos:pos+size])
-            elif (m_type == 6):
-                entry['username'] = parse_null_turminated(buf[pos:pos+size])
-            elif (m_type == 7):
-                entry['password'] = parse_null_turminated(buf[pos:pos+size])
-            elif (m_type == 8):
-                entry['notes'] = parse_null_turminated(buf[pos:pos+size])
-            elif (m_type == 9):
-                entry['created'] = self._parse_date(buf, pos, size)
-            elif (m_type == 0xA):
-                entry['modified'] = self._parse_date(buf, pos, size)
-            elif (m_type == 0xB):
-                entry['accessed'] = self._parse_date(buf, pos, size)
-            elif (m_type == 0xC):
-                entry['expires'] = self._parse_date(buf, pos, size)
-            elif (m_type == 0xD):
-                entry['bin_desc'] = parse_null_turminated(buf[pos:pos+size])
-            elif (m_type == 0xE):
-                entry['binary'] = buf[pos:pos+size]
-            elif (m_type == 0xFFFF): # end of a entry
-                n_entries -= 1
-                
-                # orphaned nodes go into the special group
-                if not self._is_group_exists(groups, entry['group_id']):
-                    if (not self._is_group_exists(groups, -1)):
-                        group = {}
-                        group['group_id'] = -1
-                        group['title'] = "*Orphaned*"
-                        group['icon']    = 0
-                        groups.append(group)
-                    entry['group_id'] = -1
-
-                if entry['title'] == 'Meta-Info' and entry['username'] == 'SYSTEM' and entry['url'] == '$':
-                    if ('notes' in entry and entry['notes'] == 'KPX_GROUP_TREE_STATE'):
-                        if (not 'binary' in entry or len(entry['binary']) < 4):
-                                raise ValueError("Discarded metastream KPX_GROUP_TREE_STATE because of a parsing error.")
-                        n = struct.unpack('<L', entry['binary'][:4])[0]
-                        if (n * 5 != len(entry['binary']) - 4):
-                            raise ValueError("Discarded metastream KPX_GROUP_TREE_STATE because of a parsing binary error.")
-                        else:
-                            for i in range(0,n):
-                                s = 4+i*5
-                                e = 4+i*5 + 4
-                                group_id = struct.unpack('<L', entry['binary'][s:e])[0]
-                                s = 8+i*5
-                                e = 8+i*5 + 1
-                                is_expanded = struct.unpack('B', entry['binary'][s:e])[0]
-                                for g in groups:
-                                    if (g['group_id'] == group_id):
-                                        g['expanded'] = is_expanded
-                    elif ('notes' in entry and entry['notes'] == 'KPX_CUSTOM_ICONS_4'):
-                        if entry['bin_desc'] != 'bin-stream':
-                            raise ValueError("Discarded metastream KPX_CUSTOM_ICONS_4 because not a binary stream.")
-                        data = entry['binary']
-                        if len(data) < 12:
-                            raise ValueError("Discarded metastream KPX_CUSTOM_ICONS_4 because format not valid.")
-                        
-                        # format: https://github.com/keepassx/keepassx/blob/master/src/format/KeePass1Reader.cpp#L855
-                        nIcons, nEntries, nGroups = struct.unpack('<LLL', data[:12])
-                        ipos = 12
-                        for i in range(nIcons):
-                            size = struct.unpack('<L', data[ipos:ipos+4])
-                            icon = data[ipos+4:ipos+4+size]
-                            self.icons.append(dict(id=random.getrandbits(32), data=icon))
-                            ipos += size + 4
-                        
-                        if len(data) < (ipos + (nEntries * 20)):
-                            raise ValueError("Custom icon entries truncated.")
-                        for i in range(nEntries):
-                            entryid = b2a_hex(data[ipos:ipos+16])
-                            iconid = struct.unpack('<L', data[ipos+16:ipos+16+4])
-                            if entryid in self.entries_by_id:
-                                self.entries_by_id[entryid]['icon'] = iconid
-                            ipos += 20
-                        
-                        if len(data) < (ipos + (nGroups * 8)):
-                            raise ValueError("Custom icon groups truncated.")
-                        for i in range(nEntries):
-                            groupid, iconid = struct.unpack('<L', data[ipos:ipos+4+4])
-                            if groupid in self.groups_by_id:
-                                self.groups_by_id[groupid]['icon'] = iconid
-                            ipos += 8
-                    elif entry['title'] == 'Meta-Info' and entry['username'] == 'SYSTEM' and entry['url'] == '$':
-                        # This is an unparsed metadata entry, save so we can 
-                        # parse later
-                        self.metainfo.append(entry)
-                else:
-                    self.entries_by_id[entry['id']] = entry
-                    entries.append(entry)
-                entry = {}
+    def _scan_entries(self):
+        """
+        Walk the field headers of all entries once, without decoding them.
+        The *Orphaned* group is added if an entry refers to a missing group,
+        metastream entries are decoded and applied. The positions of the
+        entries are recorded by group id in `_entry_offsets`.
+        """
+        if self._scanned:
+            return
+        buf = self._body()
+        unpack_head = FIELD_HEAD.unpack_from
+        head_size = FIELD_HEAD.size
+        end = len(buf)
+        groups_by_id = self._groups_by_id
+        metastreams = []
+        offsets = {}
+        pos = self._entries_pos
+        for _ in range(self.header.Entries):
+            start = pos
+            meta = False
+            group_id = None
+            field_type = None
+            while field_type != END_OF_RECORD:
+                if pos + head_size > end:
+                    raise ValueError("Entry header offset is out of range. "
+                                     "(%d)" % pos)
+                field_type, size = unpack_head(buf, pos)
+                pos += head_size
+                if pos + size > end:
+                    raise ValueError("Entry header offset is out of range. "
+                                     "(%d, %d)" % (pos, size))
+                if field_type == 2:
+                    group_id = UINT32.unpack_from(buf, pos)[0]
+                elif field_type == 4:
+                    meta = buf[pos:pos + size].tobytes().rstrip(b'\x00') == \
+                        METASTREAM_TITLE
+                pos += size
+            if group_id not in groups_by_id:
+                self._add_orphaned_group()
+                group_id = -1
+            if group_id not in offsets:
+                offsets[group_id] = array('Q')
+            offsets[group_id].append(start)
+            if meta:
+                metastreams.append(start)
+        self._entry_offsets = offsets
+        for start in metastreams:
+            entry = next(iter_records(buf, start, 1, KDB3Entry, 'Entry'))[0]
+            if is_metastream(entry):
+                self._resolve_group(entry)
+                self._parse_metastream(entry)
+        self._scanned = True
+
+    def _resolve_group(self, entry):
+        "Set the group title of `entry`, orphans go into the special group."
+        group = self._groups_by_id.get(entry.get('group_id'))
+        if group is None:
+            entry['group_id'] = -1
+            group = self._groups_by_id[-1]
+        entry['group'] = group['title']
+
+    def _add_orphaned_group(self):
+        if -1 not in self._groups_by_id:
+            group = KDB3Group(group_id=-1, title="*Orphaned*", icon=0,
+                              level=0)
+            self._groups.append(group)
+            self._groups_by_id[-1] = group
+
+    def _parse_metastream(self, entry):
+        groups_by_id = self._groups_by_id
+        if ('notes' in entry and entry['notes'] == 'KPX_GROUP_TREE_STATE'):
+            if (not 'binary' in entry or len(entry['binary']) < 4):
+                    raise ValueError("Discarded metastream KPX_GROUP_TREE_STATE because of a parsing error.")
+            data = entry['binary']
+            n = UINT32.unpack_from(data)[0]
+            if (n * 5 != len(data) - 4):
+                raise ValueError("Discarded metastream KPX_GROUP_TREE_STATE because of a parsing binary error.")
             else:
-                entry['unknown_%x'%m_type] = buf[pos:pos+size]
-                
-            pos += size;
-
-        return entries
-
-    def _parse_date(self, buf, pos, size):
-        b = struct.unpack('<5B', buf[pos:pos+size])
-        year = (b[0] << 6) | (b[1] >> 2);
-        mon    = ((b[1] & 0b11)         << 2) | (b[2] >> 6);
-        day    = ((b[2] & 0b111111) >> 1);
-        hour = ((b[2] & 0b1)            << 4) | (b[3] >> 4);
-        min    = ((b[3] & 0b1111)     << 2) | (b[4] >> 6);
-        sec    = ((b[4] & 0b111111));
-
-        return datetime.datetime(year, mon, day, hour, min, sec)
-        # return "%04d-%02d-%02d %02d:%02d:%02d" % (year, mon, day, hour, min, sec)
-
-    def _is_group_exists(self, groups, group_id):
-        for g in groups:
-            if (g['group_id'] == group_id):
-                return True
-        return False
+                for group_id, is_expanded in GROUP_STATE.iter_unpack(data[4:]):
+                    group = groups_by_id.get(group_id)
+                    if group is not None:
+                        group['expanded'] = is_expanded
+        elif ('notes' in entry and entry['notes'] == 'KPX_CUSTOM_ICONS_4'):
+            if entry.get('bin_desc') != 'bin-stream':
+                raise ValueError("Discarded metastream KPX_CUSTOM_ICONS_4 because not a binary stream.")
+            data = entry.get('binary', b'')
+            if len(data) < 12:
+                raise ValueError("Discarded metastream KPX_CUSTOM_ICONS_4 because format not valid.")
+            
+            # format: https://github.com/keepassx/keepassx/blob/master/src/format/KeePass1Reader.cpp#L855
+            nIcons, nEntries, nGroups = struct.unpack_from('<LLL', data)
+            ipos = 12
+            for i in range(nIcons):
+                if len(data) < ipos + 4:
+                    raise ValueError("Custom icons truncated.")
+                size = UINT32.unpack_from(data, ipos)[0]
+                icon = data[ipos+4:ipos+4+size]
+                self._icons.append(dict(id=random.getrandbits(32), data=icon))
+                ipos += size + 4
+            
+            if len(data) < (ipos + (nEntries * 20)):
+                raise ValueError("Custom icon entries truncated.")
+            for i in range(nEntries):
+                # applied to the entries as they are decoded
+                entryid = b2a_hex(data[ipos:ipos+16]).decode('ascii')
+                self._entry_icons[entryid] = UINT32.unpack_from(data, ipos+16)[0]
+                ipos += 20
+            
+            if len(data) < (ipos + (nGroups * 8)):
+                raise ValueError("Custom icon groups truncated.")
+            for i in range(nGroups):
+                groupid, iconid = struct.unpack_from('<LL', data, ipos)
+                if groupid in groups_by_id:
+                    groups_by_id[groupid]['icon'] = iconid
+                ipos += 8
+        else:
+            # This is an unparsed metadata entry, save so we can 
+            # parse later
+            self._metainfo.append(entry)
 
     def _get_group_path(self, group_id):
-        if 'path' in self.groups_by_id[group_id]:
-            return self.groups_by_id[group_id]['path']
-        
+        """
+        Return the titles of the group and its parents joined by '\\'. The
+        paths of the group and its parents are memoised in their 'path'.
+        """
         group = self.groups_by_id[group_id]
-        group_path = [group['title']]
-        while 'groups' in group:
-            if 'path' in self.groups_by_id[group['groups']]:
-                group_path.insert(0, self.groups_by_id[group['groups']]['path'])
-                break
-            group = self.groups_by_id[group['groups']]
-            group_path.insert(0, group['title'])
-        gpath = self.groups_by_id[group_id]['path'] = '\\'.join(group_path)
-        return gpath
+        path = group.get('path')
+        if path is None:
+            # walk up to the first group with a known path
+            chain = []
+            while path is None:
+                chain.append(group)
+                if 'groups' not in group:
+                    break
+                group = self.groups_by_id[group['groups']]
+                path = group.get('path')
+            for group in reversed(chain):
+                path = group['title'] if path is None else \
+                    path + '\\' + group['title']
+                group['path'] = path
+        return path
 
 
 class KDB3Reader(KDB3File, KDBExtension):
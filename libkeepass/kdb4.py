@@ -1,31 +1,68 @@
 # -*- coding: utf-8 -*-
 import io
+import hmac
 import uuid
 import zlib
 import gzip
+import shutil
 import struct
 import hashlib
 import base64
 import codecs
-
-from libkeepass.crypto import (xor, sha256, aes_cbc_decrypt, aes_cbc_encrypt,
-    chacha20_cbc_decrypt, chacha20_cbc_encrypt,
-    twofish_cbc_decrypt, twofish_cbc_encrypt,
-    transform_key, pad, unpad)
-
-from libkeepass.common import IS_PYTHON_3, load_keyfile, stream_unpack, read_signature
-
-from libkeepass.common import KDBFile, HeaderDictionary
-from libkeepass.hbio import HashedBlockIO
+import binascii
+from copy import deepcopy
+from collections import OrderedDict
+
+from libkeepass.crypto import (xor, sha256, sha512, aes_cbc_decrypt,
+    aes_cbc_cipher, chacha20_cbc_decrypt, chacha20_cipher, chacha20_block,
+    twofish_cbc_decrypt, twofish_cbc_cipher,
+    transform_key, unpad, xor_many, KeyStream, salsa20_block, CipherWriter,
+    CipherReader)
+
+from libkeepass.common import IS_PYTHON_3, load_keyfile
+
+from libkeepass.common import KDBFile, HeaderRecord, SIGNATURE
+from libkeepass.hbio import HashedBlockIO, HashedBlockWriter, HmacBlockIO
+from libkeepass.hbio import HmacBlockWriter, hmac_block_key
+from libkeepass.kdf import argon2_kdf, ARGON2D, ARGON2ID
 from libkeepass.utils.merge import KDB4UUIDMerge
+from libkeepass.utils.query import EntryIndex
+from libkeepass.utils.search import FullTextIndex
+from libkeepass.utils.urls import DomainTrie, MATCH_DOMAIN
+from libkeepass.utils.save import AsyncSaver
+from libkeepass.utils.binaries import BinaryPool
+from libkeepass.utils.bulk import BulkInserter, PROTECTED_FIELDS
+from libkeepass.utils.bulk import read_csv, read_xml
 
 
 KDB4_SALSA20_IV = bytes(bytearray.fromhex('e830094b97205d2a'))
 KDB4_SIGNATURE = (0x9AA2D903, 0xB54BFB67)
+FILEVERSION_3_1 = 0x00030001
 FILEVERSION_4 = 0x00040000
 
+UINT32 = struct.Struct('<I')
+# field id and data length of a header field, before and since version 4
+FIELD_HEAD = struct.Struct('<bH')
+FIELD_HEAD_4 = struct.Struct('<bI')
+# field id and data length of an inner header field
+INNER_FIELD_HEAD = struct.Struct('<bi')
+
+# index of the block key used for the header HMAC of KDBX 4 files
+HEADER_HMAC_INDEX = 0xFFFFFFFFFFFFFFFF
+# threads verifying consecutive HMAC blocks of KDBX 4 files in parallel
+HMAC_VERIFY_WORKERS = 2
+
+# inner random stream ids
+SALSA20_STREAM = 2
+CHACHA20_STREAM = 3
+
+# serialized XML is collected to be written on in chunks of about this size
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class KDB4Header(HeaderRecord):
+    __slots__ = ()
 
-class KDB4Header(HeaderDictionary):
     fields = {
         'EndOfHeader': 0,
         'Comment': 1,
@@ -58,6 +95,7 @@ class KDB4Header(HeaderDictionary):
     protected_streams = {
         1: 'ArcFourVariant',
         2: 'Salsa20',
+        3: 'ChaCha20',
     }
     
     ciphers = {
@@ -66,10 +104,157 @@ class KDB4Header(HeaderDictionary):
         codecs.decode(b'd6038a2b8b6f4cb5a524339a31dbb59a', 'hex'): 'Chacha20',
     }
 
+    # key derivation functions by the $UUID in KdfParameters
+    kdfs = {
+        codecs.decode(b'c9d9f39a628a4460bf740d08c18a4fea', 'hex'): 'AES-KDF',
+        codecs.decode(b'7c02bb8279a74ac0927d114a00648238', 'hex'): 'AES-KDF',
+        codecs.decode(b'ef636ddf8c29444b91f7a9a403e30a0c', 'hex'): 'Argon2d',
+        codecs.decode(b'9e298b1956db4773b23dfc3ec6f0a1e6', 'hex'): 'Argon2id',
+    }
+
+
+class KDB4InnerHeader(HeaderRecord):
+    """
+    The header at the start of the decrypted payload of KDBX 4 files.
+    """
+    __slots__ = ()
+
+    fields = {
+        'EndOfHeader': 0,
+        # cipher used to protect data in xml (Salsa20 or ChaCha20)
+        'InnerRandomStreamID': 1,
+        # key used to protect data in xml
+        'InnerRandomStreamKey': 2,
+        # an attachment, the only field occurring more than once, the
+        # attachments are kept in the `binaries` list of the reader
+        'Binary': 3,
+    }
+
+    fmt = {1: '<I'}
+
+
+class VariantDictionary(OrderedDict):
+    """
+    The typed name/value map of KDBX 4 headers, used for the KdfParameters
+    and PublicCustomData fields. Values are ints, bools, text or bytes, the
+    type each value is stored as is kept in `types`. It is guessed for new
+    values, use `set` to give it.
+    """
+
+    VERSION = 0x0100
+
+    UINT32 = 0x04
+    UINT64 = 0x05
+    BOOL = 0x08
+    INT32 = 0x0C
+    INT64 = 0x0D
+    STRING = 0x18
+    BYTES = 0x42
+
+    _structs = {
+        UINT32: struct.Struct('<I'),
+        UINT64: struct.Struct('<Q'),
+        BOOL: struct.Struct('<?'),
+        INT32: struct.Struct('<i'),
+        INT64: struct.Struct('<q'),
+    }
+    _version = struct.Struct('<H')
+    _type = struct.Struct('<B')
+    _length = struct.Struct('<i')
+
+    def __init__(self, *args, **kwargs):
+        self.types = {}
+        OrderedDict.__init__(self, *args, **kwargs)
+
+    def __setitem__(self, name, value):
+        if name not in self.types:
+            self.types[name] = self._guess_type(value)
+        OrderedDict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        OrderedDict.__delitem__(self, name)
+        del self.types[name]
+
+    def set(self, name, value, value_type):
+        "Set `value` to be stored as `value_type`."
+        self.types[name] = value_type
+        self[name] = value
+
+    def _guess_type(self, value):
+        if isinstance(value, bool):
+            return self.BOOL
+        elif isinstance(value, int):
+            return self.UINT64 if value >= 0 else self.INT64
+        elif isinstance(value, bytes):
+            return self.BYTES
+        return self.STRING
+
+    @classmethod
+    def parse(cls, data):
+        "Return the variant dictionary serialized in `data`."
+        view = memoryview(data)
+        result = cls()
+        try:
+            version, = cls._version.unpack_from(view, 0)
+            if version & 0xff00 > cls.VERSION & 0xff00:
+                raise IOError('Unsupported variant dictionary version %x.'
+                              % version)
+            pos = cls._version.size
+            while True:
+                value_type, = cls._type.unpack_from(view, pos)
+                pos += cls._type.size
+                if value_type == 0:
+                    return result
+                items = []
+                for _ in range(2):
+                    length, = cls._length.unpack_from(view, pos)
+                    pos += cls._length.size
+                    if length < 0 or pos + length > len(view):
+                        raise IOError('Unexpected end of variant dictionary.')
+                    items.append(view[pos:pos + length].tobytes())
+                    pos += length
+                name, raw = items
+                if value_type in cls._structs:
+                    value, = cls._structs[value_type].unpack(raw)
+                elif value_type == cls.STRING:
+                    value = raw.decode('utf-8')
+                else:
+                    value = raw
+                result.set(name.decode('utf-8'), value, value_type)
+        except struct.error:
+            raise IOError('Unexpected end of variant dictionary.')
+
+    def dump(self):
+        "Return the serialized variant dictionary."
+        data = bytearray(self._version.pack(self.VERSION))
+        for name, value in self.items():
+            value_type = self.types[name]
+            if value_type in self._structs:
+                raw = self._structs[value_type].pack(value)
+            elif value_type == self.STRING:
+                raw = value.encode('utf-8')
+            else:
+                raw = bytes(value)
+            name = name.encode('utf-8')
+            data.extend(self._type.pack(value_type))
+            data.extend(self._length.pack(len(name)))
+            data.extend(name)
+            data.extend(self._length.pack(len(raw)))
+            data.extend(raw)
+        data.extend(self._type.pack(0))
+        return bytes(data)
+
 
 class KDB4File(KDBFile):
     def __init__(self, stream=None, **credentials):
         self.header = KDB4Header()
+        # new files are version 3.1 files
+        self.file_version = FILEVERSION_3_1
+        # KDBX 4 inner header and attachments from it
+        self.inner_header = KDB4InnerHeader()
+        self.binaries = BinaryPool()
+        # ((composite, KDF settings), transformed key) of the last derivation
+        self._transformed_key = None
         KDBFile.__init__(self, stream, **credentials)
 
     def set_compression(self, flag=1):
@@ -89,24 +274,32 @@ class KDB4File(KDBFile):
             containing a KeePass file.
         """
         super(KDB4File, self).read_from(stream)
-        if self.header.CompressionFlags == 1:
+        # KDBX 4 payloads are decompressed while decrypting
+        if self.file_version < FILEVERSION_4 and \
+                self.header.CompressionFlags == 1:
             self._unzip()
 
-    def write_to(self, stream):
+    def write_to(self, stream, compact=False):
         """
         Write the KeePass database back to a KeePass2 compatible file.
         
         :arg stream: A writeable file-like object or IO buffer.
+        :arg compact: Write the XML without indentation.
         """
         if not self._is_file(stream):
             raise TypeError('Stream does not have the buffer interface.')
 
-        self._write_header(stream)
+        self._write_header(stream, compact)
+
+    def close(self):
+        "Close the in-buffer and drop the attachments."
+        self.binaries.close()
+        KDBFile.close(self)
 
-    def _read_header(self, stream):
+    def _read_header(self, buf):
         """
-        Parse the header and write the values into self.header. Also sets
-        self.header_length.
+        Parse the header in the `HeaderBuffer` `buf` and write the values
+        into self.header. Also sets self.header_length.
         """
         # KeePass 2.07 has version 1.01,
         # 2.08 has 1.02,
@@ -118,93 +311,146 @@ class KDB4File(KDBFile):
         # TODO implement version check
 
         # verify the file signature
-        signature = read_signature(stream)
+        signature = buf.unpack(SIGNATURE, 0)
         assert signature == KDB4_SIGNATURE, signature
 
         # read the file version
-        self.file_version = stream_unpack(stream, None, 4, 'I')
+        self.file_version, = buf.unpack(UINT32, SIGNATURE.size)
 
+        # field_id is a single byte, followed by the length of field data,
+        # two bytes (short) before version 4
+        if self.file_version < FILEVERSION_4:
+            field_head = FIELD_HEAD
+        else:
+            field_head = FIELD_HEAD_4
+        field_ids = set(self.header.fields.values())
+        binary = self.header.b
+        pos = SIGNATURE.size + UINT32.size
         while True:
-            # field_id is a single byte
-            field_id = stream_unpack(stream, None, 1, 'b')
+            field_id, length = buf.unpack(field_head, pos)
+            pos += field_head.size
 
             # field_id >10 is undefined
-            if not field_id in self.header.fields.values():
+            if not field_id in field_ids:
                 raise IOError('Unknown header field %x found.' % field_id)
 
-            # two byte (short) length of field data
-            if self.file_version < FILEVERSION_4:
-                length = stream_unpack(stream, None, 2, 'H')
-            else:
-                length = stream_unpack(stream, None, 4, 'I')
             if length > 0:
-                data = stream_unpack(stream, None, length, '{}s'.format(length))
-                self.header.b[field_id] = data
+                binary[field_id] = buf.read(pos, length)
+                pos += length
 
             # set position in data stream of end of header
             if field_id == 0:
-                self.header_length = stream.tell()
+                self.header_length = pos
                 break
 
         if self.file_version >= FILEVERSION_4:
-            raise NotImplementedError("File version 4 support currently unimplemented.")
+            # the header is followed by its SHA-256 hash and its HMAC, which
+            # can only be checked with the master key
+            self._header_data = buf.read(0, pos)
+            if sha256(self._header_data) != buf.read(pos, 32):
+                raise IOError('Header hash mismatch.')
+            self._header_hmac = buf.read(pos + 32, 32)
+            self.header_length = pos + 64
+
+    @property
+    def kdf_parameters(self):
+        """
+        The KdfParameters header field of KDBX 4 files parsed into a
+        `VariantDictionary`. Store changes with
+        `header.KdfParameters = params.dump()`.
+        """
+        return VariantDictionary.parse(self.header.KdfParameters)
 
     def _header(self):
         # serialize header to stream
         header = bytearray()
         # write file signature
-        header.extend(struct.pack('<II', *KDB4_SIGNATURE))
+        header.extend(SIGNATURE.pack(*KDB4_SIGNATURE))
         # and version
-        header.extend(struct.pack('<I', self.file_version))
+        header.extend(UINT32.pack(self.file_version))
 
+        if self.file_version < FILEVERSION_4:
+            field_head = FIELD_HEAD
+        else:
+            field_head = FIELD_HEAD_4
         field_ids = list(self.header.keys())
         field_ids.sort()
         field_ids.append(field_ids.pop(0))  # field_id 0 must be last
         for field_id in field_ids:
             value = self.header.b[field_id]
-            length = len(value)
-            header.extend(struct.pack('<b', field_id))
-            if self.file_version < FILEVERSION_4:
-                header.extend(struct.pack('<H', length))
-            else:
-                header.extend(struct.pack('<I', length))
-            header.extend(struct.pack('{}s'.format(length), value))
+            header.extend(field_head.pack(field_id, len(value)))
+            header.extend(value)
 
-        if self.file_version >= FILEVERSION_4:
-            raise NotImplementedError("File version 4 support currently unimplemented.")
-
-        return header
+        return bytes(header)
 
-    def _write_header(self, stream):
+    def _write_header(self, stream, compact=False):
         """Serialize the header fields from self.header into a byte stream, prefix
-        with file signature and version before writing header and out-buffer
-        to `stream`.
+        with file signature and version before writing header and the
+        serialized element tree to `stream`, see `_write_payload`. With
+        `compact` the XML is written without indentation.
 
         Note, that `stream` is flushed, but not closed!"""
         header = self._header()
+        if self.file_version < FILEVERSION_4:
+            # create HeaderHash if it does not exist, set the text only so no
+            # objectify type annotation is written
+            headerHash = self.obj_root.Meta.find('HeaderHash')
+            if headerHash is None:
+                headerHash = etree.SubElement(self.obj_root.Meta, "HeaderHash")
+            headerHash._setText(base64.b64encode(sha256(header)).decode('ascii'))
+        # values are protected while serializing
+        self._write_payload(stream, header,
+                            self.serialize(pretty_print=not compact))
+
+    def _write_payload(self, stream, header, chunks):
+        """
+        Write the serialized `header` and the XML document in the byte string
+        `chunks` to `stream`.
 
+        The payload is streamed: the chunks are compressed, split in hashed
+        blocks and encrypted on the way to `stream`, so the whole document is
+        never held in memory.
+
+        KDBX 4 files are compressed before encrypting and splitting in HMAC
+        blocks instead, the payload starts with the inner header.
+        """
         # write header to stream
         stream.write(header)
 
-        headerHash = base64.b64encode(sha256(header))
-        self.obj_root.Meta.HeaderHash = headerHash
-
-        # create HeaderHash if it does not exist
-        if len(self.obj_root.Meta.xpath("HeaderHash")) < 1:
-            etree.SubElement(self.obj_root.Meta, "HeaderHash")
-
-        # reload out_buffer because we just changed the HeaderHash
-        self.protect()
-        self.out_buffer = io.BytesIO(self.pretty_print())
-
+        # writers of the payload, closed in this order
+        if self.file_version >= FILEVERSION_4:
+            # the header is followed by its hash and HMAC
+            self._make_master_key()
+            stream.write(sha256(header))
+            stream.write(hmac.new(
+                hmac_block_key(self.hmac_key, HEADER_HMAC_INDEX), header,
+                hashlib.sha256).digest())
+            blocks = HmacBlockWriter(stream, self.hmac_key)
+            cipher, padded = self._cipher()
+            writers = [CipherWriter(blocks, cipher, padded), blocks]
+        else:
+            encrypted = self._encrypted_writer(stream)
+            writers = [HashedBlockWriter(encrypted), encrypted]
         # zip or not according to header setting
         if self.header.CompressionFlags == 1:
-            self._zip()
-
-        self._encrypt();
-
-        # write encrypted block to stream
-        stream.write(self.out_buffer)
+            # note: compresslevel=6 seems to be important for kdb4!
+            writers.insert(0, gzip.GzipFile(fileobj=writers[0], mode='wb',
+                                            compresslevel=6))
+        payload = writers[0]
+        if self.file_version >= FILEVERSION_4:
+            self._write_inner_header(payload)
+
+        pending, size = [], 0
+        for chunk in chunks:
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= WRITE_CHUNK_SIZE:
+                payload.write(b''.join(pending))
+                pending, size = [], 0
+        payload.write(b''.join(pending))
+
+        for writer in writers:
+            writer.close()
         stream.flush()
 
     def _decrypt(self, stream):
@@ -216,6 +462,8 @@ class KDB4File(KDBFile):
         in-buffer.
         """
         super(KDB4File, self)._decrypt(stream)
+        if self.file_version >= FILEVERSION_4:
+            return self._decrypt_blocks(stream)
 
         ciphername = self.header.ciphers.get(self.header.CipherID, self.header.CipherID)
         if ciphername == 'AES':
@@ -242,44 +490,109 @@ class KDB4File(KDBFile):
         else:
             raise IOError('Master key invalid.')
 
-    def _encrypt(self):
+    def _decrypt_blocks(self, stream):
         """
-        Rebuild the master key from header settings and key-hash list. Encrypt
-        the stream start bytes and the out-buffer formatted as hashed block
-        stream with padding added as needed.
+        Check the header HMAC of a KDBX 4 file with the master key, then
+        verify, decrypt and decompress the HMAC block stream from `stream` on
+        the fly. The inner header is parsed, the XML after it is set as
+        in-buffer.
         """
-        # rebuild master key from (possibly) updated header
-        self._make_master_key()
+        mac = hmac.new(hmac_block_key(self.hmac_key, HEADER_HMAC_INDEX),
+                       self._header_data, hashlib.sha256).digest()
+        if not hmac.compare_digest(mac, self._header_hmac):
+            raise IOError('Master key invalid.')
+
+        blocks = HmacBlockIO(stream, self.hmac_key, HMAC_VERIFY_WORKERS)
+        try:
+            cipher, padded = self._cipher()
+            payload = io.BufferedReader(CipherReader(blocks, cipher, padded),
+                                        CipherReader.CHUNK_SIZE)
+            if self.header.CompressionFlags == 1:
+                payload = gzip.GzipFile(fileobj=payload, mode='rb')
+            self._read_inner_header(payload)
+            self.in_buffer = io.BytesIO()
+            shutil.copyfileobj(payload, self.in_buffer)
+            self.in_buffer.seek(0)
+        finally:
+            blocks.close()
+        self.opened = True
+
+    def _read_inner_header(self, payload):
+        """
+        Parse the inner header at the start of the decrypted KDBX 4 `payload`
+        into `self.inner_header`, attachments are loaded into the
+        `BinaryPool` `self.binaries` without copies.
+        """
+        self.inner_header = KDB4InnerHeader()
+        self.binaries = BinaryPool()
+        field_ids = set(self.inner_header.fields.values())
+        while True:
+            head = payload.read(INNER_FIELD_HEAD.size)
+            if len(head) != INNER_FIELD_HEAD.size:
+                raise IOError('Unexpected end of inner header.')
+            field_id, length = INNER_FIELD_HEAD.unpack(head)
+            if length < 0:
+                raise IOError('Invalid inner header field length.')
+            if field_id == 3:
+                self.binaries.load(payload, length)
+                continue
+            data = payload.read(length) if length else b''
+            if len(data) != length:
+                raise IOError('Unexpected end of inner header.')
+            if field_id == 0:
+                break
+            elif field_id in field_ids:
+                self.inner_header.b[field_id] = data
+            else:
+                raise IOError('Unknown inner header field %x found.' % field_id)
 
-        # make hashed block stream
-        block_buffer = HashedBlockIO()
-        block_buffer.write(self.out_buffer.read())
-        # data is buffered in hashed block io, start a new one
-        self.out_buffer = io.BytesIO()
-        # write start bytes (for successful decrypt check)
-        self.out_buffer.write(self.header.StreamStartBytes)
-        # append blocked data to out-buffer
-        block_buffer.write_block_stream(self.out_buffer)
-        block_buffer.close()
-        self.out_buffer.seek(0)
-
-        # encrypt the whole thing with header settings and master key
+    def _write_inner_header(self, payload):
+        """
+        Write the inner header with the attachments of `self.binaries` to the
+        KDBX 4 `payload`.
+        """
+        for field_id in sorted(self.inner_header.keys()):
+            if field_id not in (0, 3):
+                value = self.inner_header.b[field_id]
+                payload.write(INNER_FIELD_HEAD.pack(field_id, len(value)))
+                payload.write(value)
+        binaries = self.binaries
+        for index in range(len(binaries)):
+            payload.write(INNER_FIELD_HEAD.pack(3, binaries.size(index) + 1))
+            payload.write(bytearray([binaries.flags(index)]))
+            binaries.copy_to(index, payload)
+        payload.write(INNER_FIELD_HEAD.pack(0, 0))
+
+    def _cipher(self):
+        """
+        Return a new cipher object for the payload with header settings and
+        master key, and whether the payload is padded.
+        """
         ciphername = self.header.ciphers.get(self.header.CipherID, self.header.CipherID)
         if ciphername == 'AES':
-            data = pad(self.out_buffer.read())
-            self.out_buffer = aes_cbc_encrypt(data, self.master_key,
-                                              self.header.EncryptionIV)
+            return aes_cbc_cipher(self.master_key, self.header.EncryptionIV), True
         elif ciphername == 'Chacha20':
-            data = pad(self.out_buffer.read())
-            self.out_buffer = chacha20_cbc_encrypt(data, self.master_key,
-                                              self.header.EncryptionIV)
+            return chacha20_cipher(self.master_key, self.header.EncryptionIV), False
         elif ciphername == 'Twofish':
-            data = pad(self.out_buffer.read())
-            self.out_buffer = twofish_cbc_encrypt(data, self.master_key,
-                                                  self.header.EncryptionIV)
+            return twofish_cbc_cipher(self.master_key, self.header.EncryptionIV), True
         else:
             raise IOError('Unsupported encryption type: %s'%codecs.encode(ciphername, 'hex'))
 
+    def _encrypted_writer(self, stream):
+        """
+        Rebuild the master key from header settings and key-hash list. Return
+        a writer encrypting to `stream` with header settings and master key,
+        the stream start bytes (for successful decrypt check) are already
+        written to it. Padding is added when the writer is closed.
+        """
+        # rebuild master key from (possibly) updated header
+        self._make_master_key()
+
+        cipher = self._cipher()[0]
+        writer = CipherWriter(stream, cipher)
+        writer.write(self.header.StreamStartBytes)
+        return writer
+
     def _unzip(self):
         """
         Inplace decompress in-buffer. Read/write position is moved to 0.
@@ -289,18 +602,6 @@ class KDB4File(KDBFile):
         self.in_buffer = io.BytesIO(d.decompress(self.in_buffer.read()))
         self.in_buffer.seek(0)
 
-    def _zip(self):
-        """
-        Inplace compress out-buffer. Read/write position is moved to 0.
-        """
-        data = self.out_buffer.read()
-        self.out_buffer = io.BytesIO()
-        # note: compresslevel=6 seems to be important for kdb4!
-        gz = gzip.GzipFile(fileobj=self.out_buffer, mode='wb', compresslevel=6)
-        gz.write(data)
-        gz.close()
-        self.out_buffer.seek(0)
-
     def _make_master_key(self):
         """
         Make the master key by (1) combining the credentials to create 
@@ -310,10 +611,44 @@ class KDB4File(KDBFile):
         """
         super(KDB4File, self)._make_master_key()
         composite = sha256(b''.join(self.keys))
-        tkey = transform_key(composite,
-                             self.header.TransformSeed,
-                             self.header.TransformRounds)
+        tkey = self._transform_key(composite)
         self.master_key = sha256(self.header.MasterSeed + tkey)
+        if self.file_version >= FILEVERSION_4:
+            # base key of the header and block HMACs
+            self.hmac_key = sha512(self.header.MasterSeed + tkey + b'\x01')
+
+    def _transform_key(self, composite):
+        """
+        Transform the `composite` key hash with the key derivation function
+        and settings of the header. The result is cached for the credentials
+        and settings, saves do not derive the key again.
+        """
+        if self.file_version < FILEVERSION_4:
+            settings = (self.header.TransformSeed, self.header.TransformRounds)
+        else:
+            settings = self.header.KdfParameters
+        cache_key = (composite, settings)
+        if self._transformed_key is not None and \
+                self._transformed_key[0] == cache_key:
+            return self._transformed_key[1]
+        tkey = self._derive_key(composite)
+        self._transformed_key = (cache_key, tkey)
+        return tkey
+
+    def _derive_key(self, composite):
+        if self.file_version < FILEVERSION_4:
+            return transform_key(composite,
+                                 self.header.TransformSeed,
+                                 self.header.TransformRounds)
+        params = self.kdf_parameters
+        kdf = self.header.kdfs.get(params.get('$UUID'))
+        if kdf == 'AES-KDF':
+            return transform_key(composite, params['S'], params['R'])
+        if kdf in ('Argon2d', 'Argon2id'):
+            return argon2_kdf(composite, params,
+                              ARGON2D if kdf == 'Argon2d' else ARGON2ID)
+        raise IOError('Unsupported key derivation function: %s' %
+                      (kdf or codecs.encode(params.get('$UUID', b''), 'hex')))
 
 
 from lxml import etree
@@ -321,6 +656,25 @@ from lxml import objectify
 from libkeepass.crypto import Salsa20
 
 
+# indentation of pretty printed files is dropped on parse, it would only take
+# up memory as text and tail nodes
+XML_PARSER = objectify.makeparser(remove_blank_text=True)
+
+
+# elements written start and end tag apart by `KDBXmlExtension.serialize`, all
+# other elements are serialized as a whole, up to SERIALIZE_BATCH_SIZE at once
+XML_CONTAINERS = ('KeePassFile', 'Root', 'Group')
+SERIALIZE_BATCH_SIZE = 100
+# placeholder for protected values in serialized fragments
+SLOT_MARKER = ('slot-' + uuid.uuid4().hex).encode('ascii')
+
+
+def b64_length(string):
+    "Return the length of the data base64 encoded in `string`."
+    string = string.strip()
+    return len(string) * 3 // 4 - string[-2:].count('=')
+
+
 class KDBXmlExtension:
     """
     The KDB4 payload is a XML document. For easier use this class provides
@@ -329,17 +683,261 @@ class KDBXmlExtension:
     More importantly though in the XML document text values can be protected
     using Salsa20. Protected elements are unprotected by default (passwords are
     in clear). You can override this with the `unprotect=False` argument.
+
+    With `unprotect=False` only the keystream offset of each protected value
+    is recorded, `value_text` then decrypts single values when they are read.
     """
 
     def __init__(self, unprotect=True):
-        self._reset_salsa()
+        self._init_state()
         self.in_buffer.seek(0)
-        self.tree = objectify.parse(self.in_buffer)
+        self.tree = objectify.parse(self.in_buffer, XML_PARSER)
         objectify.deannotate(self.tree, pytype=True, cleanup_namespaces=True)
         self.obj_root = self.tree.getroot()
 
         if unprotect:
             self.unprotect()
+        else:
+            self._record_offsets()
+
+    def _init_state(self):
+        self._reset_salsa()
+        self._entry_index = None
+        self._search_index = None
+        self._url_index = None
+        self.enable_fragment_cache(False)
+        self._clear_offsets()
+
+    def _copy_tree(self, other):
+        """
+        Set a copy of the element tree of `other` as the element tree. Still
+        protected values keep their keystream offsets.
+        """
+        self._init_state()
+        self.obj_root = deepcopy(other.obj_root)
+        self.tree = self.obj_root.getroottree()
+        if other._protected_offsets:
+            for value, copy in zip(
+                    other.obj_root.iterfind('.//Value[@Protected]'),
+                    self.obj_root.iterfind('.//Value[@Protected]')):
+                pos = other._protected_offsets.get(id(value))
+                if pos is not None:
+                    self._protected_elems.append(copy)
+                    self._protected_offsets[id(copy)] = pos
+
+    @property
+    def entry_index(self):
+        """
+        The `EntryIndex` used by `query`, built on first use. Report changes
+        to the element tree with `invalidate`.
+        """
+        if self._entry_index is None:
+            self._entry_index = EntryIndex(self.obj_root)
+        return self._entry_index
+
+    def invalidate(self, elem=None):
+        """
+        Tell the reader that the Entry or Group `elem` was modified, added or
+        removed, so indexes and cached fragments are updated. Without argument
+        all indexes and fragments are dropped and rebuilt on next use.
+        """
+        if elem is None:
+            self._entry_index = None
+            self._search_index = None
+            self._url_index = None
+            if self._fragments is not None:
+                self.enable_fragment_cache()
+            return
+        if self._fragments:
+            self._drop_fragments(elem)
+        if self._entry_index is not None:
+            self._entry_index.update(elem)
+        if elem.tag in ('DeletedObjects', 'DeletedObject'):
+            return
+        for index in (self._search_index, self._url_index):
+            if index is not None:
+                index.update(elem)
+
+    def query(self, fields=None, **kwargs):
+        """
+        Find entries by field predicates, group path, tags, expiry and
+        deletion state. Returns a lazily evaluated `QueryResult`::
+
+            >>> from libkeepass.utils.query import prefix, regex
+            >>> res = kdb.query(Title='GitHub', UserName=prefix('adm'),
+            ...                 group='/Root/Internet', expired=False)
+            >>> res.page(0)
+            >>> print(res.explain())
+
+        See `libkeepass.utils.query.KDB4Query` for all options.
+        """
+        return self.entry_index.query(fields, **kwargs)
+
+    def search(self, text, limit=None, include_protected=False):
+        """
+        Full-text search over the String fields of all searchable entries.
+        Returns a list of (score, entry) tuples, best matches first.
+
+        The tokenised index is built on first use and updated incrementally
+        by `invalidate`. Protected values (ie. passwords) are only indexed
+        with `include_protected=True`.
+        """
+        index = self._search_index
+        if index is None or index.include_protected != include_protected:
+            index = self._search_index = FullTextIndex(
+                self.obj_root, include_protected=include_protected)
+        return index.search(text, limit)
+
+    def entries_for_url(self, url, match=MATCH_DOMAIN):
+        """
+        Return the entries whose URL or OverrideURL host matches the page
+        `url`: exact host matches first, then parent domains, then other
+        hosts of the same registrable domain. See
+        `libkeepass.utils.urls.DomainTrie.lookup` for `match`.
+        """
+        if self._url_index is None:
+            self._url_index = DomainTrie(self.obj_root)
+        return [entry for kind, entry in self._url_index.lookup(url, match)]
+
+    def bulk_insert(self, group_path, records, protected=PROTECTED_FIELDS):
+        """
+        Add an entry for each dict of String keys to values in `records` to
+        the group at `group_path` (eg. '/Root/Internet'), missing groups are
+        created. Returns the number of entries added::
+
+            >>> kdb.bulk_insert('/Root/Servers', [
+            ...     {'Title': 'db1', 'UserName': 'admin', 'Password': 's3cr37'},
+            ... ])
+
+        The values of the keys in `protected` are protected when saving, or
+        right away if the tree is protected (eg. read with
+        `unprotect=False`). Indexes are updated, there is no need to call `invalidate`. See
+        `libkeepass.utils.bulk`.
+        """
+        return BulkInserter(self.obj_root, protected,
+                            self._bulk_inserted).insert(group_path, records)
+
+    def import_csv(self, group_path, stream, protected=PROTECTED_FIELDS,
+                   **fmtparams):
+        """
+        Add the entries of the CSV text `stream` to the group at `group_path`,
+        those with a 'Group' column to the groups below it. See
+        `libkeepass.utils.bulk.read_csv`. Returns the number of entries added.
+        """
+        return BulkInserter(self.obj_root, protected,
+                            self._bulk_inserted).insert_paths(
+                                group_path, read_csv(stream, **fmtparams))
+
+    def import_xml(self, group_path, stream, protected=PROTECTED_FIELDS):
+        """
+        Add the entries of the KeePass 1.x or 2.x XML export in the binary
+        `stream` to the groups below `group_path`, keeping their group
+        structure. See `libkeepass.utils.bulk.read_xml`. Returns the number
+        of entries added.
+        """
+        return BulkInserter(self.obj_root, protected,
+                            self._bulk_inserted).insert_paths(
+                                group_path, read_xml(stream))
+
+    def _bulk_inserted(self, group, path, entries, fields):
+        """
+        Update the indexes for `entries` added to `group`, protect their
+        values if the tree is protected.
+        """
+        protection = self.obj_root.Meta.MemoryProtection
+        if entries and protection.ProtectPassword.text == 'True':
+            self._protect_added(entries)
+        if self._entry_index is not None:
+            self._entry_index.add(entries, path, fields)
+        # rebuilt on next use, cheaper than updating them entry by entry
+        self._search_index = None
+        self._url_index = None
+        if self._fragments:
+            self._drop_fragments(group)
+
+    def _clear_offsets(self):
+        # objectify elements hash and compare by text, so offsets are kept by
+        # id() and the elements in a list to keep their proxies alive
+        self._protected_elems = []
+        self._protected_offsets = {}
+
+    def _record_offsets(self):
+        """
+        Record the keystream offset and length of all protected values in
+        document order, without decrypting them.
+        """
+        self._clear_offsets()
+        offset = 0
+        for elem in self.obj_root.iterfind('.//Value[@Protected="True"]'):
+            if elem.text is None:
+                continue
+            length = b64_length(elem.text)
+            self._protected_elems.append(elem)
+            self._protected_offsets[id(elem)] = (offset, length)
+            offset += length
+
+    def _protect_added(self, entries):
+        """
+        Protect the unprotected values of the new `entries` with the keystream
+        after the recorded offsets. `protect` and `serialize` reencrypt them
+        in document order.
+        """
+        elems = [elem for entry in entries
+                 for elem in entry.iterfind('String/Value[@Protected="False"]')]
+        offset = 0
+        if self._protected_elems:
+            offset = sum(self._protected_offsets[id(self._protected_elems[-1])])
+        data = [elem.text.encode('utf-8') if elem.text is not None else b''
+                for elem in elems]
+        length = sum(map(len, data))
+        self._salsa.reserve(offset + length)
+        salsa = self._salsa.get(offset, length)
+        for elem, tmp, protected in zip(elems, data, xor_many(data, salsa)):
+            elem.set('Protected', 'True')
+            if not tmp:
+                continue
+            elem._setText(binascii.b2a_base64(protected).rstrip(b"\n")
+                          .decode("ascii"))
+            self._protected_elems.append(elem)
+            self._protected_offsets[id(elem)] = (offset, len(tmp))
+            offset += len(tmp)
+
+    def value_text(self, elem):
+        """
+        Return the clear text of the Value element `elem`. Protected values
+        with a known keystream offset (ie. read with `unprotect=False`) are
+        decrypted on each call, the clear text is not kept.
+        """
+        if elem.get('Protected') != 'True' or elem.text is None:
+            return elem.text
+        pos = self._protected_offsets.get(id(elem))
+        if pos is None:
+            raise ValueError("Keystream offset of protected value unknown")
+        offset, length = pos
+        data = binascii.a2b_base64(elem.text)
+        return xor(data, self._salsa.get(offset, length)).decode("utf-8")
+
+    def _clear_texts(self, elems):
+        """
+        Return the clear texts of the Value elements `elems`, protected ones
+        are decrypted in bulk at their recorded offsets.
+        """
+        texts = [elem.text for elem in elems]
+        protected = [i for i, elem in enumerate(elems)
+                     if elem.get('Protected') == 'True']
+        if protected:
+            offsets = []
+            for i in protected:
+                pos = self._protected_offsets.get(id(elems[i]))
+                if pos is None:
+                    raise ValueError("Keystream offset of protected value "
+                                     "unknown")
+                offsets.append(pos[0])
+            unprotected = self._unprotect_many([texts[i] for i in protected],
+                                               offsets)
+            for i, text in zip(protected, unprotected):
+                texts[i] = text
+        return texts
 
     def unprotect(self):
         """
@@ -351,12 +949,20 @@ class KDBXmlExtension:
         """
         self._reset_salsa()
         self.obj_root.Meta.MemoryProtection.ProtectPassword._setText('False')
-        for elem in self.obj_root.iterfind('.//Value[@Protected="True"]'):
-            if elem.text is not None:
-                elem.set('ProtectedValue', elem.text)
-                elem.set('Protected', 'False')
-                unprotected_text = self._unprotect(elem.text)
-                elem._setText(unprotected_text)
+        elems = [elem for elem in
+                 self.obj_root.iterfind('.//Value[@Protected="True"]')
+                 if elem.text is not None]
+        texts = [elem.text for elem in elems]
+        if self._protected_elems:
+            unprotected_texts = self._clear_texts(elems)
+        else:
+            unprotected_texts = self._unprotect_many(texts)
+        for elem, text, unprotected_text in zip(elems, texts,
+                                                unprotected_texts):
+            elem.set('ProtectedValue', text)
+            elem.set('Protected', 'False')
+            elem._setText(unprotected_text)
+        self._clear_offsets()
 
     def protect(self):
         """
@@ -370,15 +976,29 @@ class KDBXmlExtension:
         all text values of elements with 'Protected=False'. So you could use
         this after modifying a password, adding a completely new entry or
         deleting entry history items.
+
+        Values still protected at recorded offsets are reencrypted along with
+        them, so the keystream stays in document order.
         """
         self._reset_salsa()
         self.obj_root.Meta.MemoryProtection.ProtectPassword._setText('True')
-        for elem in self.obj_root.iterfind('.//Value[@Protected="False"]'):
-            if elem.text is not None:
-                etree.strip_attributes(elem, 'ProtectedValue')
-                elem.set('Protected', 'True')
-                protected_text = self._protect(elem.text)
-                elem._setText(protected_text)
+        elems = [elem for elem in
+                 self.obj_root.iterfind('.//Value[@Protected]')
+                 if elem.text is not None and
+                 (elem.get('Protected') == 'False' or
+                  id(elem) in self._protected_offsets)]
+        texts = self._clear_texts(elems)
+        protected_texts = self._protect_many(texts)
+        self._clear_offsets()
+        offset = 0
+        for elem, text, protected_text in zip(elems, texts, protected_texts):
+            etree.strip_attributes(elem, 'ProtectedValue')
+            elem.set('Protected', 'True')
+            elem._setText(protected_text)
+            length = len(text.encode("utf-8"))
+            self._protected_elems.append(elem)
+            self._protected_offsets[id(elem)] = (offset, length)
+            offset += length
 
     def is_protected(self):
         """Return True if passwords are protected."""
@@ -395,30 +1015,221 @@ class KDBXmlExtension:
             pp = str(pp, encoding='utf-8')
         return pp
 
+    def serialize(self, pretty_print=True):
+        """
+        Serialize the element tree as it would be after `protect`, without
+        modifying it. Yields chunks of the utf-8 encoded XML document.
+
+        Values are protected in document order as they are written. Container
+        elements (see `XML_CONTAINERS`) are written tag by tag, their other
+        children are copied and serialized in batches of
+        `SERIALIZE_BATCH_SIZE`, so only a few entries are copied at a time.
+
+        With `enable_fragment_cache` serialized groups are kept and reused
+        until they are reported as changed with `invalidate`.
+        """
+        self._reset_salsa()
+        yield b"<?xml version='1.0' encoding='utf-8' standalone='yes'?>\n"
+        if self._is_container(self.obj_root):
+            for pieces, values in self._serialize(self.obj_root, 0,
+                                                  pretty_print):
+                yield self._fill_slots(pieces, values)
+        else:
+            yield etree.tostring(self.obj_root, pretty_print=pretty_print,
+                                 encoding='utf-8')
+        if pretty_print:
+            yield b'\n'
+
+    def enable_fragment_cache(self, enabled=True):
+        """
+        Keep the serialized XML of every group between saves, so saving
+        again only serializes the groups changed since. Changes must be
+        reported with `invalidate`, like for the indexes. Protected values
+        are not cached, they are read from the tree on every save.
+        """
+        self._fragments = {} if enabled else None
+        self._fragment_owners = {}
+
+    def _drop_fragments(self, elem):
+        """
+        Drop the cached fragments of the groups containing `elem`, where it
+        is now and where it was when they were serialized.
+        """
+        groups = [a for a in elem.iterancestors('Group')]
+        if elem.tag == 'Group':
+            groups.append(elem)
+        uuid_ = elem.findtext('UUID')
+        owner = self._fragment_owners.pop(uuid_, None) if uuid_ else None
+        if owner is not None:
+            groups.append(owner)
+            groups.extend(owner.iterancestors('Group'))
+        for group in groups:
+            self._fragments.pop(id(group), None)
+
+    @staticmethod
+    def _is_container(elem):
+        # note: len() and indexing of objectified elements count siblings
+        return elem.tag in XML_CONTAINERS and not elem.attrib and \
+            not elem.text and next(elem.iterchildren(), None) is not None
+
+    def _fill_slots(self, pieces, values):
+        """
+        Join the byte string `pieces` of a serialized fragment with the
+        protected text of `values` in between, consuming the salsa.
+        """
+        if not values:
+            return pieces[0]
+        protected_texts = self._protect_many(self._clear_texts(values))
+        data = [pieces[0]]
+        for protected_text, piece in zip(protected_texts, pieces[1:]):
+            data.append(protected_text.encode('ascii'))
+            data.append(piece)
+        return b''.join(data)
+
+    def _serialize(self, elem, level, pretty_print):
+        """
+        Yield the serialization of the container `elem` as fragments: tuples
+        of byte string pieces and the Value elements whose protected text
+        goes between them.
+        """
+        if elem.tag == 'Group' and self._fragments is not None:
+            cached = self._fragments.get(id(elem))
+            if cached is None or cached[1] != (level, pretty_print):
+                cached = (elem, (level, pretty_print),
+                          self._join_fragments(
+                              self._serialize_tags(elem, level, pretty_print)))
+                self._fragments[id(elem)] = cached
+                for child in elem.iterchildren('Entry', 'Group'):
+                    self._fragment_owners[child.findtext('UUID')] = elem
+            yield cached[2]
+        else:
+            for fragment in self._serialize_tags(elem, level, pretty_print):
+                yield fragment
+
+    def _serialize_tags(self, elem, level, pretty_print):
+        tag = elem.tag.encode('utf-8')
+        indent = b'\n' + b'  ' * level if pretty_print else b''
+        yield [b'<' + tag + b'>'], []
+        batch = []
+        for child in elem.iterchildren():
+            if self._is_container(child):
+                if batch:
+                    yield self._serialize_batch(elem, batch, level,
+                                                pretty_print)
+                    batch = []
+                yield [indent + b'  ' if pretty_print else b''], []
+                for fragment in self._serialize(child, level + 1,
+                                                pretty_print):
+                    yield fragment
+            else:
+                batch.append(child)
+                if len(batch) >= SERIALIZE_BATCH_SIZE:
+                    yield self._serialize_batch(elem, batch, level,
+                                                pretty_print)
+                    batch = []
+        if batch:
+            yield self._serialize_batch(elem, batch, level, pretty_print)
+        yield [indent + b'</' + tag + b'>'], []
+
+    @staticmethod
+    def _join_fragments(fragments):
+        "Join `fragments` into a single one."
+        pieces, values = [b''], []
+        for fragment_pieces, fragment_values in fragments:
+            pieces[-1] += fragment_pieces[0]
+            pieces.extend(fragment_pieces[1:])
+            values.extend(fragment_values)
+        return pieces, values
+
+    def _serialize_batch(self, parent, batch, level, pretty_print):
+        """
+        Serialize copies of the consecutive children `batch` of `parent`,
+        indented for `level`. Returns a fragment with a slot for each value
+        to protect.
+        """
+        holder = parent.makeelement('Batch')
+        for child in batch:
+            holder.append(deepcopy(child))
+        values = self._mark_slots(batch, holder)
+        if pretty_print:
+            etree.indent(holder, space='  ', level=level)
+            next(holder.iterchildren(reversed=True)).tail = None
+        data = etree.tostring(holder, encoding='utf-8')
+        pieces = data[len(b'<Batch>'):-len(b'</Batch>')].split(SLOT_MARKER)
+        if len(pieces) != len(values) + 1:
+            raise ValueError("Slot marker found in element text")
+        return pieces, values
+
+    def _mark_slots(self, elems, holder):
+        """
+        Replace the text of the values to protect in `holder`, which contains
+        copies of `elems`, with a slot marker. Returns the original Value
+        elements of the slots.
+        """
+        copies = holder.xpath('.//Value[@Protected]')
+        originals = [value for elem in elems if not callable(elem.tag)
+                     for value in
+                     elem.xpath('descendant-or-self::Value[@Protected]')]
+        values = []
+        for value, copy in zip(originals, copies):
+            if value.text is not None and \
+                    (value.get('Protected') == 'False' or
+                     id(value) in self._protected_offsets):
+                etree.strip_attributes(copy, 'ProtectedValue')
+                copy.set('Protected', 'True')
+                copy._setText(SLOT_MARKER.decode('ascii'))
+                values.append(value)
+        for meta in holder.iterchildren('Meta'):
+            protect_password = meta.find('MemoryProtection/ProtectPassword')
+            if protect_password is not None:
+                protect_password._setText('True')
+        return values
+
     def write_to(self, stream):
         """Serialize the element tree to the out-buffer."""
         if self.out_buffer is None:
-            self.protect()
-            self.out_buffer = io.BytesIO(self.pretty_print())
+            self.out_buffer = io.BytesIO(b''.join(self.serialize()))
+
+    def _inner_stream(self):
+        "Return id and key of the inner random stream protecting values."
+        if self.file_version >= FILEVERSION_4:
+            return (self.inner_header.InnerRandomStreamID,
+                    self.inner_header.InnerRandomStreamKey)
+        return (self.header.get('InnerRandomStreamID', SALSA20_STREAM),
+                self.header.ProtectedStreamKey)
 
     def _reset_salsa(self):
-        """Clear the salsa buffer and reset algorithm."""
-        self._salsa_buffer = bytearray()
-        self.salsa = Salsa20.new(
-            sha256(self.header.ProtectedStreamKey),
-            KDB4_SALSA20_IV)
+        """
+        Rewind the salsa keystream (ChaCha20 in KDBX 4 files). It is only
+        regenerated if the protected stream key changed, so unprotecting and
+        protecting again reuse it.
+        """
+        stream_id, key = self._inner_stream()
+        if (stream_id, key) != self._salsa_key:
+            if stream_id == SALSA20_STREAM:
+                key = sha256(key)
+                self._salsa = KeyStream(
+                    lambda: Salsa20.new(key, KDB4_SALSA20_IV),
+                    lambda counter: salsa20_block(key, KDB4_SALSA20_IV, counter))
+            elif stream_id == CHACHA20_STREAM:
+                digest = sha512(key)
+                key, nonce = digest[:32], digest[32:44]
+                self._salsa = KeyStream(
+                    lambda: chacha20_cipher(key, nonce),
+                    lambda counter: chacha20_block(key, nonce, counter))
+            else:
+                raise IOError('Unsupported inner random stream: %s' %
+                              self.header.protected_streams.get(stream_id,
+                                                                stream_id))
+            self._salsa_key = self._inner_stream()
+        self._salsa.rewind()
 
     def _get_salsa(self, length):
         """
         Returns the next section of the "random" Salsa20 bytes with the 
         requested `length`.
         """
-        while length > len(self._salsa_buffer):
-            new_salsa = self.salsa.encrypt(bytearray(64))
-            self._salsa_buffer.extend(new_salsa)
-        nacho = self._salsa_buffer[:length]
-        del self._salsa_buffer[:length]
-        return nacho
+        return self._salsa.read(length)
 
     def _unprotect(self, string):
         """
@@ -437,6 +1248,34 @@ class KDBXmlExtension:
         tmp = xor(encoded, self._get_salsa(len(encoded)))
         return base64.b64encode(tmp).decode("utf-8")
 
+    def _unprotect_many(self, strings, offsets=None):
+        """
+        Bulk version of `_unprotect`: base64 decode all `strings`, XOR their
+        concatenation with the next salsa at once and split the result.
+        With `offsets` each string is XORed with the salsa at its offset
+        instead. Returns a list of unprotected strings.
+        """
+        data = list(map(binascii.a2b_base64, strings))
+        if offsets is None:
+            salsa = self._get_salsa(sum(map(len, data)))
+        else:
+            self._salsa.reserve(max([o + len(d) for o, d in zip(offsets, data)]
+                                    or [0]))
+            salsa = b''.join(self._salsa.get(o, len(d))
+                             for o, d in zip(offsets, data))
+        return [tmp.decode("utf-8") for tmp in xor_many(data, salsa)]
+
+    def _protect_many(self, strings):
+        """
+        Bulk version of `_protect`: XOR the concatenation of all `strings`
+        with the next salsa at once and base64 encode the split result.
+        Returns a list of protected strings.
+        """
+        data = [string.encode("utf-8") for string in strings]
+        salsa = self._get_salsa(sum(map(len, data)))
+        return [binascii.b2a_base64(tmp).rstrip(b"\n").decode("ascii")
+                for tmp in xor_many(data, salsa)]
+
 
 class KDB4Reader(KDB4File, KDBXmlExtension):
     """
@@ -458,6 +1297,9 @@ class KDB4Reader(KDB4File, KDBXmlExtension):
     """
 
     def __init__(self, stream=None, **credentials):
+        # key of the salsa keystream generated by _reset_salsa
+        self._salsa_key = None
+        self._saver = None
         KDB4File.__init__(self, stream, **credentials)
 
     def read_from(self, stream, unprotect=True):
@@ -466,22 +1308,60 @@ class KDB4Reader(KDB4File, KDBXmlExtension):
         # initialize only here
         KDBXmlExtension.__init__(self, unprotect)
 
-    def write_to(self, stream, use_etree=True):
+    def write_to(self, stream, use_etree=True, compact=False):
         """
         Write the KeePass database back to a KeePass2 compatible file.
         
         :arg stream: A file-like object or IO buffer.
-        :arg use_tree: Serialize the element tree to XML to save (default:
-            True), Set to False to write the data currently in the in-buffer
-            instead.
+        :arg use_tree: Ignored, the element tree is always serialized and
+            streamed to `stream` (the HeaderHash in it has to be updated).
+        :arg compact: Write the XML without indentation (default: False).
+            The files are smaller and faster to save and load, KeePass reads
+            them just the same.
+        """
+        KDB4File.write_to(self, stream, compact)
+
+    def snapshot(self):
+        """
+        Return a copy of the database (header, credentials and element tree)
+        that can be written while this one is changed.
+        """
+        kdb = self.__class__()
+        kdb.keys = list(self.keys)
+        kdb.header = KDB4Header(self.header)
+        kdb.file_version = self.file_version
+        kdb.inner_header = KDB4InnerHeader(self.inner_header)
+        kdb.binaries = self.binaries.copy()
+        kdb._transformed_key = self._transformed_key
+        kdb.opened = self.opened
+        kdb._copy_tree(self)
+        return kdb
+
+    def save_async(self, path, **kwargs):
         """
-        if use_etree:
-            KDBXmlExtension.write_to(self, stream)
-        KDB4File.write_to(self, stream)
+        Save the database to the file `path` in the background. A snapshot is
+        taken now, serializing, key derivation, encryption and writing happen
+        on a worker thread. The file is replaced atomically when complete.
+        Saves requested while a save is running are coalesced into one.
+
+        Returns a `concurrent.futures.Future`, see
+        `libkeepass.utils.save.AsyncSaver`. `kwargs` are passed to
+        `write_to`.
+        """
+        if self._saver is None:
+            self._saver = AsyncSaver()
+        return self._saver.save(self, path, **kwargs)
+
+    def close(self):
+        "Wait for background saves and close the in-buffer."
+        if self._saver is not None:
+            self._saver.wait()
+        KDB4File.close(self)
 
     def merge(self, other, *args, **kwargs):
         "Merge another database into this one."
         kdbm = KDB4UUIDMerge(self, other, *args, **kwargs)
         kdbm.merge()
+        self.invalidate()
         return kdbm
 
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Argon2 (RFC 9106) key derivation for KDBX 4 files.
+
+`argon2_hash` computes with the first available of these backends:
+
+* 'native': argon2-cffi, the lanes are computed on threads in C,
+* 'numpy': NumPy, the blocks of all lanes of a slice are computed at once,
+* 'python': pure Python reference, only fast enough for small memory
+  settings.
+
+The memory of running computations is accounted in `memory_budget`. A
+computation needing more than its limit is refused, others wait until enough
+of the budget is free.
+"""
+from __future__ import absolute_import
+
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    from argon2.low_level import hash_secret_raw, Type as _NativeType
+except ImportError:
+    hash_secret_raw = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+ARGON2D = 0
+ARGON2I = 1
+ARGON2ID = 2
+
+VERSION_10 = 0x10
+VERSION_13 = 0x13
+
+# default limit of the memory used by Argon2 at the same time, in bytes
+MEMORY_LIMIT = 1024 * 1024 * 1024
+
+BLOCK_SIZE = 1024
+SYNC_POINTS = 4
+
+# memory used for a block by the backends
+BACKEND_BLOCK_SIZES = {
+    'native': BLOCK_SIZE,
+    'numpy': BLOCK_SIZE,
+    # a list of 128 Python ints
+    'python': 6 * BLOCK_SIZE,
+}
+
+BACKENDS = [name for name, available in (
+    ('native', hash_secret_raw is not None),
+    ('numpy', np is not None),
+    ('python', True)) if available]
+
+
+class MemoryBudget(object):
+    """
+    Accounts the memory of running Argon2 computations, up to `limit` bytes.
+    `in_use` and `peak` are the reserved and highest reserved bytes.
+    """
+
+    def __init__(self, limit=MEMORY_LIMIT):
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        """
+        Reserve `size` bytes while the block is executed, wait for running
+        computations if necessary. Raises an IOError if `size` exceeds the
+        limit.
+        """
+        if size > self.limit:
+            raise IOError('Argon2 needs %d bytes of memory, more than the '
+                          'limit of %d bytes.' % (size, self.limit))
+        with self._cond:
+            while self.in_use + size > self.limit:
+                self._cond.wait()
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= size
+                self._cond.notify_all()
+
+
+memory_budget = MemoryBudget()
+
+
+def memory_blocks(memory_kib, parallelism):
+    "Number of blocks used for `memory_kib` KiB split in `parallelism` lanes."
+    memory_kib = max(memory_kib, 2 * SYNC_POINTS * parallelism)
+    return memory_kib - memory_kib % (SYNC_POINTS * parallelism)
+
+
+def memory_usage(memory_kib, parallelism, backend):
+    "Bytes of memory `backend` needs for the Argon2 settings."
+    return memory_blocks(memory_kib, parallelism) * BACKEND_BLOCK_SIZES[backend]
+
+
+def argon2_hash(password, salt, time_cost, memory_kib, parallelism,
+                hash_len=32, type=ARGON2D, version=VERSION_13, secret=b'',
+                associated_data=b'', backend=None):
+    """
+    Return the Argon2 tag of `password`. `backend` is the name of the
+    backend to use, the first of `BACKENDS` by default. The native backend
+    does not support `secret` and `associated_data`, another one is used for
+    them.
+    """
+    if backend is None:
+        backend = BACKENDS[0]
+        if backend == 'native' and (secret or associated_data):
+            backend = BACKENDS[1]
+    if backend not in BACKENDS:
+        raise ValueError('Argon2 backend %s is not available.' % backend)
+    if parallelism < 1 or time_cost < 1:
+        raise ValueError('Invalid Argon2 parameters.')
+
+    with memory_budget.reserve(memory_usage(memory_kib, parallelism,
+                                            backend)):
+        if backend == 'native':
+            return hash_secret_raw(
+                password, salt, time_cost, memory_kib, parallelism, hash_len,
+                {ARGON2D: _NativeType.D, ARGON2I: _NativeType.I,
+                 ARGON2ID: _NativeType.ID}[type], version)
+        h0 = _initial_hash(password, salt, time_cost, memory_kib,
+                           parallelism, hash_len, type, version, secret,
+                           associated_data)
+        lane_length = memory_blocks(memory_kib, parallelism) // parallelism
+        fill = _fill_numpy if backend == 'numpy' else _fill_python
+        final = fill(h0, parallelism, lane_length, time_cost, type, version)
+        return _hprime(final, hash_len)
+
+
+def argon2_kdf(key, params, type=ARGON2D):
+    """
+    Return the transformed key of the composite `key` with the Argon2
+    `params` from the KdfParameters of a KDBX 4 header.
+    """
+    return argon2_hash(key, params['S'], params['I'], params['M'] // 1024,
+                       params['P'], 32, type, params.get('V', VERSION_13),
+                       params.get('K', b''), params.get('A', b''))
+
+
+# shared parts
+
+LE32 = struct.Struct('<I')
+BLOCK = struct.Struct('<128Q')
+
+
+def _blake2b(data, digest_size=64):
+    return hashlib.blake2b(data, digest_size=digest_size).digest()
+
+
+def _initial_hash(password, salt, time_cost, memory_kib, parallelism,
+                  hash_len, type, version, secret, associated_data):
+    data = [LE32.pack(v) for v in (parallelism, hash_len, memory_kib,
+                                   time_cost, version, type)]
+    for value in (password, salt, secret, associated_data):
+        data.append(LE32.pack(len(value)))
+        data.append(value)
+    return _blake2b(b''.join(data))
+
+
+def _hprime(data, length):
+    "The variable length hash function H' of Argon2."
+    data = LE32.pack(length) + data
+    if length <= 64:
+        return _blake2b(data, length)
+    out = []
+    v = _blake2b(data)
+    while length > 64:
+        out.append(v[:32])
+        length -= 32
+        v = _blake2b(v, length) if length <= 64 else _blake2b(v)
+    out.append(v)
+    return b''.join(out)
+
+
+def _first_block(h0, index, lane):
+    return _hprime(h0 + LE32.pack(index) + LE32.pack(lane), BLOCK_SIZE)
+
+
+def _data_independent(type, pass_, slice_):
+    return type == ARGON2I or (type == ARGON2ID and pass_ == 0 and
+                               slice_ < SYNC_POINTS // 2)
+
+
+def _ref_index(pass_, slice_, index, same_lane, j1, segment_length,
+               lane_length):
+    "Index of the reference block in its lane, from the low word `j1`."
+    if pass_ == 0:
+        if slice_ == 0 or same_lane:
+            area = slice_ * segment_length + index - 1
+        else:
+            area = slice_ * segment_length - (index == 0)
+    elif same_lane:
+        area = lane_length - segment_length + index - 1
+    else:
+        area = lane_length - segment_length - (index == 0)
+    rel = (j1 * j1) >> 32
+    rel = area - 1 - ((area * rel) >> 32)
+    start = 0
+    if pass_ != 0 and slice_ != SYNC_POINTS - 1:
+        start = (slice_ + 1) * segment_length
+    return (start + rel) % lane_length
+
+
+def _addresses(pass_, lane, slice_, n_blocks, passes, type, segment_length):
+    "The pseudo random words of a data independent segment."
+    zero = [0] * 128
+    words = []
+    counter = 0
+    while len(words) < segment_length:
+        counter += 1
+        block = [pass_, lane, slice_, n_blocks, passes, type, counter] + \
+            [0] * 121
+        words.extend(_compress(zero, _compress(zero, block)))
+    return words
+
+
+# pure Python backend
+
+MASK32 = 0xffffffff
+MASK64 = 0xffffffffffffffff
+
+# word indices of the rows and columns of a block, each is permuted by P
+_ROWS = [list(range(16 * i, 16 * i + 16)) for i in range(8)]
+_COLUMNS = [[16 * r + 2 * i + k for r in range(8) for k in (0, 1)]
+            for i in range(8)]
+# the applications of GB in P on the 16 words, the first four on columns,
+# the last four on diagonals
+_P_STEPS = ((0, 4, 8, 12), (1, 5, 9, 13), (2, 6, 10, 14), (3, 7, 11, 15),
+            (0, 5, 10, 15), (1, 6, 11, 12), (2, 7, 8, 13), (3, 4, 9, 14))
+_GB_WORDS = [tuple(group[i] for i in step)
+             for groups in (_ROWS, _COLUMNS)
+             for group in groups for step in _P_STEPS]
+
+
+def _compress(x, y, out=None):
+    """
+    The compression function G of the blocks `x` and `y` (lists of 128
+    words), XORed with the block `out` if given.
+    """
+    r = [a ^ b for a, b in zip(x, y)]
+    q = list(r)
+    for ia, ib, ic, id_ in _GB_WORDS:
+        a, b, c, d = q[ia], q[ib], q[ic], q[id_]
+        a = (a + b + 2 * (a & MASK32) * (b & MASK32)) & MASK64
+        d ^= a
+        d = (d >> 32) | ((d << 32) & MASK64)
+        c = (c + d + 2 * (c & MASK32) * (d & MASK32)) & MASK64
+        b ^= c
+        b = (b >> 24) | ((b << 40) & MASK64)
+        a = (a + b + 2 * (a & MASK32) * (b & MASK32)) & MASK64
+        d ^= a
+        d = (d >> 16) | ((d << 48) & MASK64)
+        c = (c + d + 2 * (c & MASK32) * (d & MASK32)) & MASK64
+        b ^= c
+        b = (b >> 63) | ((b << 1) & MASK64)
+        q[ia], q[ib], q[ic], q[id_] = a, b, c, d
+    if out is None:
+        return [a ^ b for a, b in zip(q, r)]
+    return [a ^ b ^ c for a, b, c in zip(q, r, out)]
+
+
+def _fill_python(h0, lanes, lane_length, passes, type, version):
+    segment_length = lane_length // SYNC_POINTS
+    memory = [[None] * lane_length for _ in range(lanes)]
+    for lane in range(lanes):
+        for i in (0, 1):
+            memory[lane][i] = list(BLOCK.unpack(_first_block(h0, i, lane)))
+
+    for pass_ in range(passes):
+        for slice_ in range(SYNC_POINTS):
+            independent = _data_independent(type, pass_, slice_)
+            for lane in range(lanes):
+                if independent:
+                    addresses = _addresses(pass_, lane, slice_,
+                                           lanes * lane_length, passes, type,
+                                           segment_length)
+                blocks = memory[lane]
+                start = 2 if pass_ == 0 and slice_ == 0 else 0
+                for index in range(start, segment_length):
+                    pos = slice_ * segment_length + index
+                    prev = blocks[pos - 1]
+                    rand = addresses[index] if independent else prev[0]
+                    ref_lane = (rand >> 32) % lanes
+                    if pass_ == 0 and slice_ == 0:
+                        ref_lane = lane
+                    ref = memory[ref_lane][_ref_index(
+                        pass_, slice_, index, ref_lane == lane,
+                        rand & MASK32, segment_length, lane_length)]
+                    if pass_ == 0 or version == VERSION_10:
+                        blocks[pos] = _compress(prev, ref)
+                    else:
+                        blocks[pos] = _compress(prev, ref, blocks[pos])
+
+    final = memory[0][-1]
+    for lane in range(1, lanes):
+        final = [a ^ b for a, b in zip(final, memory[lane][-1])]
+    return BLOCK.pack(*final)
+
+
+# NumPy backend, computes the blocks of all lanes of a slice together
+
+if np is not None:
+    _NP_PHASES = []
+    for groups in (_ROWS, _COLUMNS):
+        for steps in (_P_STEPS[:4], _P_STEPS[4:]):
+            _NP_PHASES.append([
+                np.array([group[step[k]] for group in groups for step in steps])
+                for k in range(4)])
+    _NP_MASK32 = np.uint64(MASK32)
+    _NP_SHIFTS = dict((n, (np.uint64(n), np.uint64(64 - n)))
+                      for n in (32, 24, 16, 63))
+
+
+def _np_rotr(x, n):
+    right, left = _NP_SHIFTS[n]
+    return (x >> right) | (x << left)
+
+
+def _np_mul(a, b):
+    "a + b + 2 * lo(a) * lo(b), modulo 2 ** 64."
+    return a + b + (((a & _NP_MASK32) * (b & _NP_MASK32)) << np.uint64(1))
+
+
+def _compress_numpy(x, y, out=None):
+    "`_compress` of the rows of the (lanes, 128) arrays."
+    r = x ^ y
+    q = r.copy()
+    for ia, ib, ic, id_ in _NP_PHASES:
+        a, b, c, d = q[:, ia], q[:, ib], q[:, ic], q[:, id_]
+        a = _np_mul(a, b)
+        d = _np_rotr(d ^ a, 32)
+        c = _np_mul(c, d)
+        b = _np_rotr(b ^ c, 24)
+        a = _np_mul(a, b)
+        d = _np_rotr(d ^ a, 16)
+        c = _np_mul(c, d)
+        b = _np_rotr(b ^ c, 63)
+        q[:, ia], q[:, ib], q[:, ic], q[:, id_] = a, b, c, d
+    q ^= r
+    if out is not None:
+        q ^= out
+    return q
+
+
+def _fill_numpy(h0, lanes, lane_length, passes, type, version):
+    segment_length = lane_length // SYNC_POINTS
+    memory = np.zeros((lanes, lane_length, 128), dtype=np.uint64)
+    for lane in range(lanes):
+        for i in (0, 1):
+            memory[lane, i] = np.frombuffer(_first_block(h0, i, lane),
+                                            dtype='<u8')
+    all_lanes = np.arange(lanes)
+
+    for pass_ in range(passes):
+        for slice_ in range(SYNC_POINTS):
+            independent = _data_independent(type, pass_, slice_)
+            if independent:
+                addresses = [_addresses(pass_, lane, slice_,
+                                        lanes * lane_length, passes, type,
+                                        segment_length)
+                             for lane in range(lanes)]
+            start = 2 if pass_ == 0 and slice_ == 0 else 0
+            for index in range(start, segment_length):
+                pos = slice_ * segment_length + index
+                prev = memory[:, pos - 1]
+                if independent:
+                    rands = [addresses[lane][index] for lane in range(lanes)]
+                else:
+                    rands = [int(v) for v in prev[:, 0]]
+                ref_lanes, ref_indexes = [], []
+                for lane, rand in enumerate(rands):
+                    ref_lane = (rand >> 32) % lanes
+                    if pass_ == 0 and slice_ == 0:
+                        ref_lane = lane
+                    ref_lanes.append(ref_lane)
+                    ref_indexes.append(_ref_index(
+                        pass_, slice_, index, ref_lane == lane,
+                        rand & MASK32, segment_length, lane_length))
+                ref = memory[ref_lanes, ref_indexes]
+                if pass_ == 0 or version == VERSION_10:
+                    memory[all_lanes, pos] = _compress_numpy(prev, ref)
+                else:
+                    memory[all_lanes, pos] = _compress_numpy(
+                        prev, ref, memory[:, pos])
+
+    final = np.bitwise_xor.reduce(memory[:, -1], axis=0)
+    return final.astype('<u8').tobytes()
@@ -1,11 +1,25 @@
 # -*- coding: utf-8 -*-
 
+import struct
+import base64
+import binascii
 import datetime
 
 
+# KDBX 4 files store times as base64 encoded seconds since 0001-01-01
+KDBX4_EPOCH = datetime.datetime(1, 1, 1)
+
+
 def parse_timestamp(date_text):
-    "Parse timestamp"
-    return datetime.datetime.strptime(str(date_text), '%Y-%m-%dT%H:%M:%SZ')
+    "Parse timestamp, ISO 8601 or base64 encoded seconds (KDBX 4)"
+    date_text = str(date_text)
+    if date_text.endswith('Z'):
+        return datetime.datetime.strptime(date_text, '%Y-%m-%dT%H:%M:%SZ')
+    try:
+        seconds, = struct.unpack('<q', base64.b64decode(date_text))
+    except (binascii.Error, struct.error):
+        raise ValueError('Invalid timestamp: {!r}'.format(date_text))
+    return KDBX4_EPOCH + datetime.timedelta(seconds=seconds)
 
 def unparse_timestamp(dt):
     "Create timestamp from datetime object"
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Converting many KDB3 files to KDBX on a process pool, as done by
+``kdbutil convert4 --batch``::
+
+    >>> with io.open('manifest.txt') as f:
+    ...     jobs = read_manifest(f)
+    >>> for result in convert_batch(jobs, workers=8, password='secret'):
+    ...     if result.error is not None:
+    ...         print(result.input, result.error)
+
+Each file is converted with `write_kdb3_as_kdb4` in a worker process. Errors
+are reported in the result of their file, the other files are converted
+anyway. A worker process that dies fails the files not yet converted.
+"""
+
+import io
+import os
+import time
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import libkeepass
+import libkeepass.kdb3
+from libkeepass.utils.convert import write_kdb3_as_kdb4
+
+
+# stages of a conversion, in order
+STAGES = ('read', 'decrypt', 'convert', 'sync')
+
+
+class ConvertResult(object):
+    """
+    Outcome of converting the KDB3 file `input` to `output`: the number of
+    `entries` and the seconds spent in each of `STAGES` that was reached by
+    stage name in `times`. `error` is the message of the failure, else None.
+    """
+    __slots__ = ('input', 'output', 'entries', 'times', 'error')
+
+    def __init__(self, input, output, entries=None, times=None, error=None):
+        self.input = input
+        self.output = output
+        self.entries = entries
+        self.times = OrderedDict() if times is None else times
+        self.error = error
+
+    @property
+    def seconds(self):
+        return sum(self.times.values())
+
+    def __repr__(self):
+        return 'ConvertResult(input={!r}, output={!r}, entries={!r}, ' \
+            'error={!r})'.format(self.input, self.output, self.entries,
+                                 self.error)
+
+
+def read_manifest(stream):
+    """
+    Return the (input, output) path pairs listed in a text `stream`, one file
+    per line with the paths separated by a tab. Without output path the
+    input path with extension ``.kdbx`` is used. Empty lines and lines
+    starting with ``#`` are skipped.
+    """
+    jobs = []
+    for lineno, line in enumerate(stream, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        paths = line.split('\t')
+        if len(paths) > 2 or not paths[0]:
+            raise ValueError('Invalid manifest line {}: {!r}'.format(
+                lineno, line))
+        if len(paths) == 1 or not paths[1]:
+            paths = [paths[0], os.path.splitext(paths[0])[0] + '.kdbx']
+        jobs.append((paths[0], paths[1]))
+    return jobs
+
+
+def convert_file(input, output, **credentials):
+    """
+    Convert the KDB3 file `input` to the KDBX file `output` and return the
+    `ConvertResult`. The output is written to a temporary file renamed to
+    `output` when complete, nothing is left behind on errors.
+    """
+    result = ConvertResult(input, output)
+    stage = STAGES[0]
+    start = time.time()
+
+    def done(next_stage):
+        now = time.time()
+        result.times[stage] = now - start
+        return next_stage, now
+
+    tmp_path = None
+    try:
+        with io.open(os.path.expanduser(input), 'rb') as stream:
+            data = io.BytesIO(stream.read())
+        stage, start = done('decrypt')
+        with libkeepass.open_stream(data, **credentials) as kdb3:
+            if not isinstance(kdb3, libkeepass.kdb3.KDB3File):
+                raise IOError('Not a KeePass 1.x file.')
+            stage, start = done('convert')
+            directory, name = os.path.split(os.path.abspath(output))
+            fd, tmp_path = tempfile.mkstemp(prefix='.' + name + '.',
+                                            suffix='.tmp', dir=directory)
+            stats = {}
+            with os.fdopen(fd, 'wb') as stream:
+                write_kdb3_as_kdb4(kdb3, stream, stats=stats)
+                stage, start = done('sync')
+                os.fsync(stream.fileno())
+            os.replace(tmp_path, output)
+            tmp_path = None
+            stage, start = done(None)
+            result.entries = stats['entries']
+    except Exception as ex:
+        if stage is not None:
+            done(None)
+        result.error = '{}: {}'.format(type(ex).__name__, ex)
+    finally:
+        if tmp_path is not None:
+            os.unlink(tmp_path)
+    return result
+
+
+def _convert_job(job, credentials):
+    return convert_file(job[0], job[1], **credentials)
+
+
+def convert_batch(jobs, workers=None, **credentials):
+    """
+    Convert the KDB3 files of the (input, output) pairs in `jobs` on a pool
+    of `workers` processes (one per CPU if None), all opened with the same
+    `credentials`. Yields a `ConvertResult` per file as they are done.
+    KDB3 files are only opened with a password, keyfiles are not supported.
+    """
+    if credentials.get('password') is None:
+        raise ValueError('KDB3 files can only be converted with a password, '
+                         'keyfiles are not supported.')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict(
+            (executor.submit(_convert_job, job, credentials), job)
+            for job in jobs)
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as ex:
+                # the worker process died
+                input, output = futures[future]
+                yield ConvertResult(input, output, error='{}: {}'.format(
+                    type(ex).__name__, ex))
+
+
+def format_report(results):
+    """
+    Return a text report of a batch: converted and failed files, then the
+    total, mean and maximum seconds of each stage over the files that
+    reached it.
+    """
+    failed = sum(1 for result in results if result.error is not None)
+    lines = ['{} converted, {} failed, {} entries'.format(
+        len(results) - failed, failed,
+        sum(result.entries or 0 for result in results))]
+    lines.append('{:<10} {:>6} {:>10} {:>10} {:>10}'.format(
+        'stage', 'files', 'total', 'mean', 'max'))
+    for stage in STAGES + ('all',):
+        if stage == 'all':
+            times = [result.seconds for result in results]
+        else:
+            times = [result.times[stage] for result in results
+                     if stage in result.times]
+        if not times:
+            continue
+        lines.append('{:<10} {:>6} {:>9.3f}s {:>9.3f}s {:>9.3f}s'.format(
+            stage, len(times), sum(times), sum(times) / len(times),
+            max(times)))
+    return '\n'.join(lines)
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Attachments of KDBX 4 files, which are stored as raw bytes in the inner header
+and referenced by index from entries (``<Value Ref="0"/>``).
+
+`BinaryPool` keeps them apart from the XML, never base64 encoded: small ones
+as memoryviews of the buffer they were decrypted into, larger ones in an
+anonymous temporary file. Saving writes them back as they are::
+
+    >>> with kdb.binaries.open(0) as f:
+    ...     shutil.copyfileobj(f, out)
+    >>> with io.open('report.pdf', 'rb') as f:
+    ...     kdb.binaries.replace(0, f)
+"""
+
+import io
+import weakref
+import tempfile
+import itertools
+import threading
+
+
+# attachments larger than this are kept in a temporary file
+SPILL_THRESHOLD = 1024 * 1024
+# attachments are read and written in chunks of this size
+COPY_CHUNK_SIZE = 64 * 1024
+
+# flags byte of attachments KeePass keeps protected in memory
+PROTECTED = 0x01
+
+
+class SpillFile(object):
+    """
+    Anonymous temporary file attachments are appended to, they are never
+    changed after. Access is serialized, so pools sharing the file (eg. a
+    snapshot being saved) can use it from several threads. Each pool sharing
+    the file calls `close` once, the file is closed and removed by the last
+    one or when it is no longer referenced.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._lock = threading.Lock()
+        self._users = 1
+        self._finalizer = weakref.finalize(self, self._file.close)
+        self.size = 0
+
+    def share(self):
+        "Register another pool using the file, return the file."
+        with self._lock:
+            self._users += 1
+        return self
+
+    def close(self):
+        with self._lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+        self._finalizer()
+
+    def append(self, chunks):
+        "Append the data in `chunks`, return its offset and length."
+        with self._lock:
+            offset = self.size
+            self._file.seek(offset)
+            for chunk in chunks:
+                self._file.write(chunk)
+                self.size += len(chunk)
+            return offset, self.size - offset
+
+    def read_at(self, offset, length):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+
+class Attachment(object):
+    """
+    An attachment in a `BinaryPool`: its flags and `size`, the data is a
+    memoryview in `view` or `size` bytes at `offset` of the `spill` file.
+    """
+    __slots__ = ('flags', 'size', 'view', 'spill', 'offset')
+
+    def __init__(self, flags, size, view=None, spill=None, offset=0):
+        self.flags = flags
+        self.size = size
+        self.view = view
+        self.spill = spill
+        self.offset = offset
+
+    def chunk(self, pos, length):
+        "Return `length` bytes from `pos` of the data, a memoryview if kept."
+        if self.view is not None:
+            return self.view[pos:pos + length]
+        return self.spill.read_at(self.offset + pos, length)
+
+
+class AttachmentReader(io.RawIOBase):
+    "Readable stream of the data of an `Attachment`."
+
+    def __init__(self, attachment):
+        io.RawIOBase.__init__(self)
+        self.attachment = attachment
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        length = min(len(b), self.attachment.size - self.pos)
+        if length <= 0:
+            return 0
+        data = self.attachment.chunk(self.pos, length)
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+def _read_chunks(stream, length=None):
+    "Yield the data of `stream` in chunks, up to `length` bytes if given."
+    while length is None or length > 0:
+        size = COPY_CHUNK_SIZE if length is None else \
+            min(COPY_CHUNK_SIZE, length)
+        chunk = stream.read(size)
+        if not chunk:
+            if length is not None:
+                raise IOError('Unexpected end of attachment.')
+            return
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+
+class BinaryPool(object):
+    """
+    The attachments of a KDBX 4 file, by index. New data is given as bytes or
+    as readable binary stream, which is copied in chunks. Attachments larger
+    than `spill_threshold` (default `SPILL_THRESHOLD`) are spilled to the
+    temporary file.
+    """
+
+    def __init__(self, spill_threshold=None):
+        if spill_threshold is None:
+            spill_threshold = SPILL_THRESHOLD
+        self.spill_threshold = spill_threshold
+        self._attachments = []
+        self._spill = None
+
+    def __len__(self):
+        return len(self._attachments)
+
+    def __repr__(self):
+        return 'BinaryPool({})'.format([a.size for a in self._attachments])
+
+    def size(self, index):
+        return self._attachments[index].size
+
+    def flags(self, index):
+        return self._attachments[index].flags
+
+    def protected(self, index):
+        return bool(self._attachments[index].flags & PROTECTED)
+
+    def spilled(self, index):
+        "Whether the attachment is kept in the temporary file."
+        return self._attachments[index].view is None
+
+    def read(self, index):
+        "Return the data of an attachment as bytes."
+        attachment = self._attachments[index]
+        return bytes(attachment.chunk(0, attachment.size))
+
+    def view(self, index):
+        """
+        Return a read-only memoryview of the data, for spilled attachments of
+        a copy read into memory.
+        """
+        attachment = self._attachments[index]
+        if attachment.view is not None:
+            return attachment.view
+        return memoryview(self.read(index))
+
+    def open(self, index):
+        "Return a readable binary stream of the data of an attachment."
+        return io.BufferedReader(AttachmentReader(self._attachments[index]),
+                                 COPY_CHUNK_SIZE)
+
+    def copy_to(self, index, stream):
+        "Write the data of an attachment to `stream` in chunks."
+        attachment = self._attachments[index]
+        for pos in range(0, attachment.size, COPY_CHUNK_SIZE):
+            stream.write(attachment.chunk(pos, COPY_CHUNK_SIZE))
+
+    def add(self, data, protected=False):
+        "Add an attachment, return its index."
+        self._attachments.append(self._store(data, PROTECTED if protected else 0))
+        return len(self._attachments) - 1
+
+    def replace(self, index, data, protected=None):
+        """
+        Replace the data of an attachment, the protected flag is kept unless
+        `protected` is given. Entries refer to it by the same index.
+        """
+        flags = self._attachments[index].flags
+        if protected is not None:
+            flags = (flags & ~PROTECTED) | (PROTECTED if protected else 0)
+        self._attachments[index] = self._store(data, flags)
+
+    def remove(self, index):
+        """
+        Remove an attachment, the indexes of the following ones decrease.
+        References in the XML have to be updated by the caller.
+        """
+        del self._attachments[index]
+
+    def load(self, stream, length):
+        """
+        Add the attachment of a Binary inner header field of `length` bytes,
+        a flags byte followed by the data, read from `stream`.
+        """
+        if length < 1:
+            raise IOError('Invalid attachment length.')
+        if length - 1 > self.spill_threshold:
+            flags = bytearray(stream.read(1))
+            if not flags:
+                raise IOError('Unexpected end of attachment.')
+            offset, size = self._spill_file().append(
+                _read_chunks(stream, length - 1))
+            attachment = Attachment(flags[0], size, spill=self._spill,
+                                    offset=offset)
+        else:
+            # one buffer for the field, the data is a slice of it
+            buf = bytearray(length)
+            view = memoryview(buf)
+            pos = 0
+            while pos < length:
+                n = stream.readinto(view[pos:])
+                if not n:
+                    raise IOError('Unexpected end of attachment.')
+                pos += n
+            attachment = Attachment(buf[0], length - 1,
+                                    view=view.toreadonly()[1:])
+        self._attachments.append(attachment)
+        return len(self._attachments) - 1
+
+    def copy(self):
+        """
+        Return a pool with the same attachments. The data is shared, it is
+        never changed in place.
+        """
+        pool = BinaryPool(self.spill_threshold)
+        pool._attachments = list(self._attachments)
+        if self._spill is not None:
+            pool._spill = self._spill.share()
+        return pool
+
+    def close(self):
+        """
+        Drop all attachments. The temporary file is removed once all copies
+        of the pool are closed.
+        """
+        self._attachments = []
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def _spill_file(self):
+        if self._spill is None:
+            self._spill = SpillFile()
+        return self._spill
+
+    def _store(self, data, flags):
+        if not hasattr(data, 'read'):
+            if len(data) <= self.spill_threshold:
+                data = bytes(data)
+                return Attachment(flags, len(data), view=memoryview(data))
+            data = io.BytesIO(data)
+        # read up to the threshold into memory, spill if there is more
+        chunks, size = [], 0
+        for chunk in _read_chunks(data):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > self.spill_threshold:
+                spill = self._spill_file()
+                offset, size = spill.append(
+                    itertools.chain(chunks, _read_chunks(data)))
+                return Attachment(flags, size, spill=spill, offset=offset)
+        data = b''.join(chunks)
+        return Attachment(flags, len(data), view=memoryview(data))
+
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+Adding many entries to a KDB4 element tree at once::
+
+    >>> kdb.bulk_insert('/Root/Servers', [
+    ...     {'Title': 'db1', 'UserName': 'admin', 'Password': 'secret'},
+    ...     {'Title': 'db2', 'UserName': 'admin', 'Password': 'secret',
+    ...      'URL': 'ssh://db2', 'Tags': ['cmdb', 'db'], 'Rack': 'B4'},
+    ... ])
+    2
+    >>> with io.open('export.csv', newline='') as f:
+    ...     kdb.import_csv('/Root/Imported', f)
+
+Records are dicts of String keys to values. ``Tags`` (a string or a list of
+tags) and ``IconID`` are set as entry properties, all other keys become String
+fields. Entries always get the standard fields Title, UserName, Password, URL
+and Notes, missing ones are empty.
+
+`BulkInserter` writes the XML of `ENTRY_BATCH_SIZE` entries at a time and
+parses it once, instead of building every element on its own. Groups are
+resolved once per path and missing ones are created.
+"""
+
+import os
+import re
+import csv
+import base64
+import datetime
+
+from lxml import etree, objectify
+
+from . import unparse_timestamp
+from .query import group_path, split_tags
+
+
+# entries are generated and parsed in batches of this size
+ENTRY_BATCH_SIZE = 1000
+# String fields of new entries and their order
+STANDARD_FIELDS = ('Title', 'UserName', 'Password', 'URL', 'Notes')
+# String fields written as protected values by default
+PROTECTED_FIELDS = ('Password',)
+# icon of new groups (folder)
+GROUP_ICON = 48
+
+# header names of CSV columns (lower case) with a standard field
+CSV_COLUMNS = {
+    'title': 'Title',
+    'account': 'Title',
+    'username': 'UserName',
+    'user name': 'UserName',
+    'login name': 'UserName',
+    'login': 'UserName',
+    'password': 'Password',
+    'url': 'URL',
+    'web site': 'URL',
+    'website': 'URL',
+    'notes': 'Notes',
+    'comments': 'Notes',
+    'tags': 'Tags',
+    'icon': 'IconID',
+}
+# header name (lower case) of the CSV column with the group of an entry
+CSV_GROUP_COLUMN = 'group'
+
+# fields of the <pwentry> elements of KeePass 1.x XML files
+PWENTRY_FIELDS = {
+    'title': 'Title',
+    'username': 'UserName',
+    'password': 'Password',
+    'url': 'URL',
+    'notes': 'Notes',
+    'image': 'IconID',
+}
+
+# parser of the generated XML, like the one of KDB4 element trees
+XML_PARSER = objectify.makeparser(remove_blank_text=True)
+# record keys set as entry properties instead of String fields
+ENTRY_PROPERTIES = ('Tags', 'IconID')
+
+ENTRY_XML = (u'<Entry><UUID>{uuid}</UUID><IconID>{icon}</IconID>'
+             u'<ForegroundColor/><BackgroundColor/><OverrideURL/>'
+             u'<Tags>{tags}</Tags>{times}{strings}'
+             u'<AutoType><Enabled>True</Enabled>'
+             u'<DataTransferObfuscation>0</DataTransferObfuscation>'
+             u'</AutoType><History/></Entry>')
+GROUP_XML = (u'<Group><UUID>{uuid}</UUID><Name>{name}</Name><Notes/>'
+             u'<IconID>{icon}</IconID>{times}<IsExpanded>True</IsExpanded>'
+             u'<DefaultAutoTypeSequence/><EnableAutoType>null</EnableAutoType>'
+             u'<EnableSearching>null</EnableSearching>'
+             u'<LastTopVisibleEntry>AAAAAAAAAAAAAAAAAAAAAA==</LastTopVisibleEntry>'
+             u'</Group>')
+TIMES_XML = (u'<Times><CreationTime>{0}</CreationTime>'
+             u'<LastModificationTime>{0}</LastModificationTime>'
+             u'<LastAccessTime>{0}</LastAccessTime>'
+             u'<ExpiryTime>{0}</ExpiryTime><Expires>False</Expires>'
+             u'<UsageCount>0</UsageCount>'
+             u'<LocationChanged>{0}</LocationChanged></Times>')
+# String elements up to the value, by protection, and after it
+STRING_XML = (u'<String><Key>{}</Key><Value>',
+              u'<String><Key>{}</Key><Value Protected="False">')
+STRING_END_XML = u'</Value></String>'
+# characters that cannot be written to an XML document
+INVALID_XML_CHARS = re.compile(
+    u'[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
+
+def xml_escape(text):
+    "Escape `text` for XML, carriage returns too (the parser drops them)."
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '>', '&gt;').replace('\r', '&#13;')
+
+
+def check_xml_text(text, what):
+    """
+    Raise a ValueError about `what` if `text` has characters that cannot be
+    written to XML, like most control characters.
+    """
+    match = INVALID_XML_CHARS.search(text)
+    if match is not None:
+        raise ValueError('{} has a character not allowed in XML: {!r}'.format(
+            what, match.group()))
+
+
+def new_uuids(count):
+    "Return `count` random base64 encoded UUIDs."
+    data = os.urandom(16 * count)
+    return [base64.b64encode(data[i:i + 16]).decode('ascii')
+            for i in range(0, 16 * count, 16)]
+
+
+def split_path(path):
+    "Split a group path (eg. '/Root/Internet') into group names."
+    if not isinstance(path, (list, tuple)):
+        path = path.strip('/').split('/') if path.strip('/') else ()
+    return tuple(path)
+
+
+class BulkInserter(object):
+    """
+    Inserts entries into the groups of a KDB4 element tree, given by path
+    (eg. '/Root/Internet' like for `query`). Missing groups are created.
+
+    All entries and groups created by one inserter share their Times. Values
+    of the String keys in `protected` are added unprotected with a
+    'Protected="False"' attribute, so they are protected when the database is
+    saved (`KDB4Reader.bulk_insert` protects them right away if its tree is
+    protected). Records and group names with characters not allowed in XML
+    raise a ValueError before their batch or group is added. `on_insert` is
+    called with the group, its path, the list of entries and their fields for
+    `EntryIndex.add` after each batch added to a group, and with empty lists
+    for new groups.
+    """
+
+    def __init__(self, obj_root, protected=PROTECTED_FIELDS, on_insert=None,
+                 batch_size=ENTRY_BATCH_SIZE):
+        self.obj_root = obj_root
+        self.root_group = obj_root.find('Root/Group')
+        if self.root_group is None:
+            raise ValueError('Database has no root group.')
+        self.protected = frozenset(protected)
+        self.on_insert = on_insert
+        self.batch_size = batch_size
+        self.times = TIMES_XML.format(
+            unparse_timestamp(datetime.datetime.utcnow()))
+        # group names -> Group element, filled as paths are looked up
+        self.groups = {}
+        self.count = 0
+        # String key -> XML of the String element up to the value
+        self._string_heads = {}
+
+    def group(self, path):
+        """
+        Return the Group element at `path`, a path string or a sequence of
+        group names starting with the name of the root group. Missing groups
+        are created.
+        """
+        names = self._names(path)
+        group = self.groups.get(names)
+        if group is not None:
+            return group
+        for name in names:
+            check_xml_text(name, 'Group name {!r}'.format(name))
+        if len(names) == 1:
+            if names[0] != (self.root_group.findtext('Name') or ''):
+                raise ValueError('Group path {!r} is not below the root '
+                                 'group.'.format(group_path(names)))
+            group = self.root_group
+        else:
+            parent = self.group(names[:-1])
+            for child in parent.iterchildren('Group'):
+                if (child.findtext('Name') or '') == names[-1]:
+                    group = child
+                    break
+            else:
+                group = self._parse(GROUP_XML.format(
+                    uuid=new_uuids(1)[0], name=xml_escape(names[-1]),
+                    icon=GROUP_ICON, times=self.times))[0]
+                parent.append(group)
+                if self.on_insert is not None:
+                    self.on_insert(group, group_path(names), [], [])
+        self.groups[names] = group
+        return group
+
+    def _names(self, path):
+        "Return the group names of `path`, the root group if empty."
+        return split_path(path) or (self.root_group.findtext('Name') or '',)
+
+    def insert(self, path, records):
+        """
+        Add an entry for each record of the iterable `records` to the group
+        at `path`. Returns the number of entries added.
+        """
+        count = self.count
+        names = self._names(path)
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                self._insert_batch(names, batch)
+                batch = []
+        if batch:
+            self._insert_batch(names, batch)
+        else:
+            self.group(names)
+        return self.count - count
+
+    def insert_paths(self, path, items):
+        """
+        Add the records of the (group names, record) pairs of the iterable
+        `items` to the groups below `path` given by the names. Returns the
+        number of entries added.
+        """
+        count = self.count
+        base = self._names(path)
+        batches = {}
+        for names, record in items:
+            names = base + split_path(names)
+            batch = batches.setdefault(names, [])
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                self._insert_batch(names, batch)
+                del batches[names]
+        for names, batch in batches.items():
+            self._insert_batch(names, batch)
+        return self.count - count
+
+    def _parse(self, xml):
+        "Return the objectified elements in the XML string `xml`."
+        holder = etree.fromstring(
+            u'<Group>{}</Group>'.format(xml).encode('utf-8'), XML_PARSER)
+        return list(holder.iterchildren())
+
+    def _entry(self, uuid, record):
+        """
+        Return the XML of the entry for `record` and its fields for
+        `EntryIndex.add`.
+        """
+        tags = record.get('Tags', u'')
+        if not isinstance(tags, str):
+            tags = u';'.join(tags)
+        keys = STANDARD_FIELDS + tuple(
+            key for key in record
+            if key not in STANDARD_FIELDS and key not in ENTRY_PROPERTIES)
+        strings = []
+        values = {}
+        protected = []
+        for key in keys:
+            value = record.get(key)
+            if value is None:
+                value = u''
+            elif not isinstance(value, str):
+                value = str(value)
+            head = self._string_heads.get(key)
+            if head is None:
+                head = self._string_heads[key] = STRING_XML[
+                    key in self.protected].format(xml_escape(key))
+            strings.append(head)
+            strings.append(xml_escape(value))
+            strings.append(STRING_END_XML)
+            if key in self.protected:
+                protected.append(key)
+            else:
+                values[key] = value
+        strings = u''.join(strings)
+        if INVALID_XML_CHARS.search(strings) is not None or \
+                INVALID_XML_CHARS.search(tags) is not None:
+            self._check_record(record, keys, tags)
+        xml = ENTRY_XML.format(uuid=uuid, icon=int(record.get('IconID', 0)),
+                               tags=xml_escape(tags), times=self.times,
+                               strings=strings)
+        return xml, (uuid, values, split_tags(tags), protected)
+
+    @staticmethod
+    def _check_record(record, keys, tags):
+        "Raise a ValueError naming the key of `record` that is not valid XML."
+        title = record.get('Title')
+        for key in keys:
+            what = 'Record with Title {!r}: key {!r}'.format(title, key)
+            check_xml_text(key, what)
+            value = record.get(key)
+            if value is not None:
+                check_xml_text(value if isinstance(value, str) else
+                               str(value), what + ' value')
+        check_xml_text(tags, 'Record with Title {!r}: Tags'.format(title))
+
+    def _insert_batch(self, names, records):
+        xml, fields = [], []
+        for uuid, record in zip(new_uuids(len(records)), records):
+            entry_xml, entry_fields = self._entry(uuid, record)
+            xml.append(entry_xml)
+            fields.append(entry_fields)
+        # the group is only created once its entries are known to be valid
+        group = self.group(names)
+        entries = self._parse(u''.join(xml))
+        # entries go before the subgroups
+        first_group = next(group.iterchildren('Group'), None)
+        if first_group is None:
+            group.extend(entries)
+        else:
+            for entry in entries:
+                first_group.addprevious(entry)
+        self.count += len(entries)
+        if self.on_insert is not None:
+            self.on_insert(group, group_path(names), entries, fields)
+
+
+def read_csv(stream, **fmtparams):
+    """
+    Yield (group names, record) pairs for the rows of a CSV text `stream`
+    with a header row. Columns known from KeePass and KeePassX exports are
+    mapped to the standard fields (see `CSV_COLUMNS`), others are String
+    fields named after their header, left out where empty. A 'Group' column
+    holds the path of the group of the entry, '/' separated. `fmtparams`
+    are passed to `csv.reader`.
+    """
+    reader = csv.reader(stream, **fmtparams)
+    header = next(reader, None)
+    if header is None:
+        return
+    keys = [CSV_COLUMNS.get(name.strip().lower(), name.strip())
+            for name in header]
+    group_column = None
+    for i, name in enumerate(header):
+        if name.strip().lower() == CSV_GROUP_COLUMN:
+            group_column = i
+    for row in reader:
+        if not any(row):
+            continue
+        record = {}
+        names = ()
+        for i, value in enumerate(row[:len(keys)]):
+            if i == group_column:
+                names = split_path(value)
+            elif keys[i] == 'Tags':
+                record['Tags'] = split_tags(value)
+            elif keys[i] == 'IconID':
+                record['IconID'] = int(value or 0)
+            elif value or keys[i] in STANDARD_FIELDS:
+                record[keys[i]] = value
+        yield names, record
+
+
+def read_xml(stream):
+    """
+    Yield (group names, record) pairs for the entries of a KeePass XML
+    export in the binary `stream`: KeePass 2.x XML (<KeePassFile>, group
+    names below the root group) or KeePass 1.x XML (<pwlist>, group names
+    from the 'tree' attribute and the group). The document is parsed
+    incrementally, parsed entries are dropped.
+    """
+    names = []
+    for event, elem in etree.iterparse(stream, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == 'Group':
+                names.append(None)
+            continue
+        if tag == 'Name' and names and names[-1] is None and \
+                elem.getparent().tag == 'Group':
+            names[-1] = elem.text or u''
+        elif tag == 'Group':
+            names.pop()
+        elif tag == 'Entry' and elem.getparent().tag == 'Group':
+            yield tuple(names[1:]), _entry_record(elem)
+            _drop(elem)
+        elif tag == 'pwentry':
+            yield _pwentry_names(elem), _pwentry_record(elem)
+            _drop(elem)
+
+
+def _drop(elem):
+    "Free a parsed element and the siblings before it."
+    elem.clear()
+    parent = elem.getparent()
+    while elem.getprevious() is not None:
+        del parent[0]
+
+
+def _entry_record(elem):
+    record = {}
+    for string in elem.iterchildren('String'):
+        value = string.find('Value')
+        if value is not None and value.get('Protected') == 'True':
+            raise ValueError('Protected value of {!r} in XML export.'.format(
+                string.findtext('Key')))
+        record[string.findtext('Key')] = \
+            value.text if value is not None and value.text else u''
+    tags = split_tags(elem.findtext('Tags'))
+    if tags:
+        record['Tags'] = tags
+    icon = elem.findtext('IconID')
+    if icon:
+        record['IconID'] = int(icon)
+    return record
+
+
+def _pwentry_names(elem):
+    group = elem.find('group')
+    if group is None:
+        return ()
+    tree = group.get('tree')
+    names = tuple(tree.split('\\')) if tree else ()
+    return names + (group.text or u'',)
+
+
+def _pwentry_record(elem):
+    record = {}
+    for tag, key in PWENTRY_FIELDS.items():
+        text = elem.findtext(tag)
+        if text is None:
+            continue
+        record[key] = int(text) if key == 'IconID' else text
+    return record
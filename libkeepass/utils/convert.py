@@ -9,18 +9,34 @@ import datetime
 import codecs
 import struct
 
-from xml.sax.saxutils import escape
 import lxml.etree
 import lxml.objectify
+from lxml.etree import Element, SubElement
 
 import libkeepass.common
 import libkeepass.kdb3
 import libkeepass.kdb4
 from libkeepass.crypto import sha256
+from libkeepass.kdb3 import NEVER_EXPIRES, XML_DECLARATION
+from libkeepass.kdb3 import format_xml_time, xml_text
 
 
-def convert_kdb3_to_kxml4(kdb3):
-    "Convert given KDB3 to xml in v4 format."
+# the group all KDB3 groups are put in
+ROOT_GROUP = {
+    'group_id': 0,
+    'title': 'Root',
+    'icon': 48,
+    'created': NEVER_EXPIRES,
+    'modified': NEVER_EXPIRES,
+    'accessed': NEVER_EXPIRES,
+    'expires': NEVER_EXPIRES,
+    'expanded': True,
+    'level': -1,
+}
+
+
+def _kxml4_document():
+    "Return a v4 XML document with the Meta of converted files and no groups."
     doc4 = lxml.etree.fromstring(u"""\
 <KeePassFile>
     <Meta>
@@ -43,121 +59,122 @@ def convert_kdb3_to_kxml4(kdb3):
     </Meta>
     <Root>
     </Root>
-</KeePassFile>""".format(datetime.datetime(2999, 12, 28, 23, 59, 59)))
+</KeePassFile>""".format(NEVER_EXPIRES), TEMPLATE_PARSER)
     
     doc4.find('.//DatabaseName').text = 'converted'
+    return doc4
+
+
+TEMPLATE_PARSER = lxml.etree.XMLParser(remove_blank_text=True)
+
+
+def _parent_id(group):
+    "Return the id of the parent of a KDB3 group, None for the root group."
+    if 'groups' in group:
+        # This is a sub-group
+        return group['groups']
+    elif group['level'] == 0:
+        return ROOT_GROUP['group_id']
+    return None
+
+
+def _group_element(group):
+    "Return the <Group> element of a KDB3 group, without entries or groups."
+    # Create group uuid from 32-bit unique group id.  All group ids with in
+    # a file should be unique. However, its possible that two out of sync
+    # files have two different groups with the same group id. Although this
+    # should be sufficiently improbable.
+    # Use first half of cryptographic sha256 hash to uniquely map the 32-bit
+    # (4-byte) group id into the 16-byte UUID space.
+    # The *Orphaned* group has id -1, packed as the reserved 0xFFFFFFFF.
+    group_uuid = base64.b64encode(sha256(struct.pack("<L", group['group_id'] & 0xFFFFFFFF))[:16]).decode('ascii')
+    
+    # by default we don't want to search the Backup group, since these
+    # were deleted entries
+    enabled = 'False' if group['title'] == 'Backup' else 'null'
+    
+    groupEl = Element('Group')
+    SubElement(groupEl, 'UUID').text = group_uuid
+    SubElement(groupEl, 'Name').text = xml_text(group['title'])
+    SubElement(groupEl, 'IconID').text = str(group['icon'])
+    _times(groupEl, group)
+    # groups of files without tree state are collapsed
+    SubElement(groupEl, 'IsExpanded').text = str(bool(group.get('expanded')))
+    SubElement(groupEl, 'EnableAutoType').text = enabled
+    SubElement(groupEl, 'EnableSearching').text = enabled
+    return groupEl
+
+
+def _entry_element(entry, protect=None):
+    """
+    Return the <Entry> element of a KDB3 entry. The password is protected
+    with the function `protect` if given.
+    """
+    if 'bin_desc' in entry and entry['bin_desc']:
+        raise ValueError("Unexpected bin_desc '%s'. (%r)"%(entry['bin_desc'], entry.get('binary', '')))
+    
+    entryEl = Element('Entry')
+    SubElement(entryEl, 'UUID').text = base64.b64encode(codecs.decode(entry['id'], 'hex')).decode('ascii')
+    SubElement(entryEl, 'IconID').text = str(entry['icon'])
+    _times(entryEl, entry)
+    for k4 in ('Title', 'URL', 'UserName', 'Password', 'Notes'):
+        stringEl = SubElement(entryEl, 'String')
+        SubElement(stringEl, 'Key').text = k4
+        valueEl = SubElement(stringEl, 'Value')
+        text = xml_text(entry[k4.lower()])
+        if k4 == 'Password' and protect is not None and text is not None:
+            valueEl.set('Protected', 'True')
+            text = protect(text)
+        valueEl.text = text
+    return entryEl
+
+
+def _times(parent, record):
+    "Add the <Times> element of a KDB3 group or entry to `parent`."
+    # FIXME: We assume the v3 timestamps are in UTC, but this is almost
+    #   certainly not the case. Perhaps we should allow the user to specify.
+    #   Did the old KeePassX always use UTC anyway?  Need to check.
+    # the *Orphaned* group has no dates
+    created, modified, accessed, expires = [
+        record.get(key, NEVER_EXPIRES)
+        for key in ('created', 'modified', 'accessed', 'expires')]
+    timesEl = SubElement(parent, 'Times')
+    SubElement(timesEl, 'CreationTime').text = format_xml_time(created) + 'Z'
+    SubElement(timesEl, 'LastModificationTime').text = \
+        format_xml_time(modified) + 'Z'
+    SubElement(timesEl, 'LastAccessTime').text = \
+        format_xml_time(accessed) + 'Z'
+    SubElement(timesEl, 'ExpiryTime').text = format_xml_time(expires) + 'Z'
+    SubElement(timesEl, 'Expires').text = str(expires != NEVER_EXPIRES)
+    SubElement(timesEl, 'UsageCount').text = '0'
+    SubElement(timesEl, 'LocationChanged').text = format_xml_time(created) + 'Z'
+
+
+def convert_kdb3_to_kxml4(kdb3):
+    "Convert given KDB3 to xml in v4 format."
+    doc4 = _kxml4_document()
     root = doc4.find('Root')
     
-    group_id_map = {}
-    root_group = {
-        'group_id': 0,
-        'title': 'Root',
-        'icon': 48,
-        'created': datetime.datetime(2999, 12, 28, 23, 59, 59),
-        'modified': datetime.datetime(2999, 12, 28, 23, 59, 59),
-        'accessed': datetime.datetime(2999, 12, 28, 23, 59, 59),
-        'expires': datetime.datetime(2999, 12, 28, 23, 59, 59),
-        'expanded': True,
-        'level': -1,
-    }
-    for group in [root_group]+kdb3.groups:
-        group = group.copy()
-        if group['level'] == 0:
-            group['groups'] = 0
-        # Create group uuid from 32-bit unique group id.  All group ids with in
-        # a file should be unique. However, its possible that two out of sync
-        # files have two different groups with the same group id. Although this
-        # should be sufficiently improbable.
-        # Use first half of cryptographic sha256 hash to uniquely map the 32-bit
-        # (4-byte) group id into the 16-byte UUID space.
-        group['uuid'] = base64.b64encode(sha256(struct.pack("<L", group['group_id']))[:16]).decode('ascii')
-        group_id_map[group['group_id']] = group['uuid']
-        group['expire_valid'] = (group['expires'] != datetime.datetime(2999, 12, 28, 23, 59, 59))
-        group['expanded'] = str(bool(group['expanded']))
-        group['enable_auto_type'] = 'null'
-        group['enable_searching'] = 'null'
-        
-        for k in ('uuid', 'title'):
-            group[k] = escape(group[k])
-        
-        if group['title'] == 'Backup':
-            # by default we don't want to search the Backup group, since these
-            # were deleted entries
-            group['enable_auto_type'] = 'False'
-            group['enable_searching'] = 'False'
-        
-        groupEl = lxml.etree.fromstring(u"""\
-<Group>
-    <UUID>{uuid}</UUID>
-    <Name>{title}</Name>
-    <IconID>{icon}</IconID>
-    <Times>
-        <CreationTime>{created:%Y-%m-%dT%H:%M:%S}Z</CreationTime>
-        <LastModificationTime>{modified:%Y-%m-%dT%H:%M:%S}Z</LastModificationTime>
-        <LastAccessTime>{accessed:%Y-%m-%dT%H:%M:%S}Z</LastAccessTime>
-        <ExpiryTime>{expires:%Y-%m-%dT%H:%M:%S}Z</ExpiryTime>
-        <Expires>{expire_valid}</Expires>
-        <UsageCount>0</UsageCount>
-        <LocationChanged>{created:%Y-%m-%dT%H:%M:%S}Z</LocationChanged>
-    </Times>
-    <IsExpanded>{expanded}</IsExpanded>
-    <EnableAutoType>{enable_auto_type}</EnableAutoType>
-    <EnableSearching>{enable_searching}</EnableSearching>
-</Group>""".format(**group))
-        # FIXME: We assume the v3 timestamps are in UTC, but this is almost
-        #   certainly not the case. Perhaps we should allow the user to specify.
-        #   Did the old KeePassX always use UTC anyway?  Need to check.
-        
-        if 'groups' in group:
-            # This is a sub-group
-            g_parent_uuid = group_id_map[group['groups']]
-            root.find(".//Group[UUID='%s']"%g_parent_uuid).append(groupEl)
-        else:
-            root.append(groupEl)
-    
-    for entry in kdb3.entries:
-        entry = entry.copy()
-        entry['uuid'] = escape(base64.b64encode(codecs.decode(entry['id'], 'hex')).decode('ascii'))
-        entry['expire_valid'] = (entry['expires'] != datetime.datetime(2999, 12, 28, 23, 59, 59))
-        
-        entryEl = lxml.etree.fromstring(u"""\
-<Entry>
-    <UUID>{uuid}</UUID>
-    <IconID>{icon}</IconID>
-    <Times>
-        <CreationTime>{created:%Y-%m-%dT%H:%M:%S}Z</CreationTime>
-        <LastModificationTime>{modified:%Y-%m-%dT%H:%M:%S}Z</LastModificationTime>
-        <LastAccessTime>{accessed:%Y-%m-%dT%H:%M:%S}Z</LastAccessTime>
-        <ExpiryTime>{expires:%Y-%m-%dT%H:%M:%S}Z</ExpiryTime>
-        <Expires>{expire_valid}</Expires>
-        <UsageCount>0</UsageCount>
-        <LocationChanged>{created:%Y-%m-%dT%H:%M:%S}Z</LocationChanged>
-    </Times>
-</Entry>""".format(**entry))
-        
-        for k4 in ('Title', 'URL', 'UserName', 'Password', 'Notes'):
-            k3 = k4.lower()
-            stringEl = lxml.etree.fromstring(u"""\
-<String>
-    <Key>{key}</Key>
-    <Value>{value}</Value>
-</String>""".format(key=k4, value=escape(entry[k3])))
-            entryEl.append(stringEl)
-        
-        if 'bin_desc' in entry and entry['bin_desc']:
-            raise ValueError("Unexpected bin_desc '%s'. (%r)"%(entry['bin_desc'], entry.get('binary', '')))
-        
-        g_parent_uuid = group_id_map[entry['group_id']]
-        root.find(".//Group[UUID='%s']"%g_parent_uuid).append(entryEl)
+    # group elements by group id, groups are listed before their sub-groups
+    group_elements = {}
+    for group in [ROOT_GROUP]+kdb3.groups:
+        parent_id = _parent_id(group)
+        parent = root if parent_id is None else group_elements[parent_id]
+        groupEl = _group_element(group)
+        parent.append(groupEl)
+        group_elements[group['group_id']] = groupEl
+    
+    for entry in kdb3.iter_entries():
+        group_elements[entry['group_id']].append(_entry_element(entry))
     
     return doc4
 
 
-def convert_kdb3_to_kdb4(kdb3):
-    "Convert given KDB3 file to KDB4."
-    # First convert the KDB3 unencrypted binary to xml in v4 format.
-    kxml4 = convert_kdb3_to_kxml4(kdb3)
-    
+def _kdb4_for_kdb3(kdb3):
+    """
+    Return a KDB4Reader with the settings and credentials of a converted
+    `kdb3`, without element tree.
+    """
     ciphername = kdb3.header.encryption_flags[kdb3.header.Flags-1]
     for cipherid, cname in libkeepass.kdb4.KDB4Header.ciphers.items():
         if ciphername == cname:
@@ -181,9 +198,108 @@ def convert_kdb3_to_kdb4(kdb3):
     kdb4.header.InnerRandomStreamID = 2 # Salsa20
     
     kdb4.keys = kdb3.keys[:]
+    return kdb4
+
+
+def convert_kdb3_to_kdb4(kdb3):
+    "Convert given KDB3 file to KDB4."
+    # First convert the KDB3 unencrypted binary to xml in v4 format.
+    kxml4 = convert_kdb3_to_kxml4(kdb3)
+    
+    kdb4 = _kdb4_for_kdb3(kdb3)
     kdb4.in_buffer = io.BytesIO(lxml.etree.tostring(kxml4))
     libkeepass.kdb4.KDBXmlExtension.__init__(kdb4)
     
     return kdb4
 
 
+class _ChunkSink(object):
+    "File object keeping what `lxml.etree.xmlfile` writes until taken."
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(data)
+    
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_kdb3_as_kxml4(kdb3, kdb4, pretty_print=True, stats=None):
+    """
+    Yield the v4 XML document of `kdb3` as chunks of utf-8 bytes, written
+    group by group with `lxml.etree.xmlfile`. Entries are decoded and
+    written one at a time, passwords are protected with the inner random
+    stream of `kdb4` as they are written. The HeaderHash for the header of
+    `kdb4` is included. The numbers of 'groups' and 'entries' written are
+    counted in the dict `stats` if given.
+    """
+    if stats is None:
+        stats = {}
+    stats['groups'] = stats['entries'] = 0
+    doc4 = _kxml4_document()
+    meta = doc4.find('Meta')
+    SubElement(meta, 'HeaderHash').text = base64.b64encode(sha256(kdb4._header())).decode('ascii')
+    children = {}
+    for group in kdb3.groups:
+        children.setdefault(_parent_id(group), []).append(group)
+    kdb4._reset_salsa()
+    protect = kdb4._protect
+    sink = _ChunkSink()
+    
+    def write(xf, elem, level):
+        if pretty_print:
+            xf.write('\n' + '  ' * level)
+            lxml.etree.indent(elem, space='  ', level=level)
+        xf.write(elem)
+    
+    def write_group(xf, group, level):
+        if pretty_print:
+            xf.write('\n' + '  ' * level)
+        with xf.element('Group'):
+            stats['groups'] += 1
+            for child in _group_element(group):
+                write(xf, child, level + 1)
+            for entry in kdb3.iter_entries(group['group_id']):
+                write(xf, _entry_element(entry, protect), level + 1)
+                stats['entries'] += 1
+                yield sink.take()
+            for child in children.get(group['group_id'], ()):
+                for chunk in write_group(xf, child, level + 1):
+                    yield chunk
+            if pretty_print:
+                xf.write('\n' + '  ' * level)
+    
+    yield XML_DECLARATION
+    with lxml.etree.xmlfile(sink, encoding='utf-8', buffered=False) as xf:
+        with xf.element('KeePassFile'):
+            write(xf, meta, 1)
+            if pretty_print:
+                xf.write('\n  ')
+            with xf.element('Root'):
+                for chunk in write_group(xf, ROOT_GROUP, 2):
+                    yield chunk
+                if pretty_print:
+                    xf.write('\n  ')
+            if pretty_print:
+                xf.write('\n')
+    yield sink.take()
+
+
+def write_kdb3_as_kdb4(kdb3, stream, compact=False, stats=None):
+    """
+    Convert `kdb3` to a KeePass 2 file written to `stream`, without element
+    tree or XML document in memory: the XML of `iter_kdb3_as_kxml4` is
+    compressed, split in blocks and encrypted as it is generated. With
+    `compact` the XML is written without indentation, the numbers of groups
+    and entries written are counted in the dict `stats` if given. Returns
+    the KDB4Reader with the header and credentials of the file, it has no
+    element tree.
+    """
+    kdb4 = _kdb4_for_kdb3(kdb3)
+    kdb4._write_payload(stream, kdb4._header(),
+                        iter_kdb3_as_kxml4(kdb3, kdb4, not compact, stats))
+    return kdb4
@@ -180,11 +180,11 @@ class KDB4Merge(KDBMerge):
         "Merge a KDB4 databases"
         kdb_dest, kdb_src = self.kdb_dest, self.kdb_src
         
-        # databases must be unprotected to do a merge
-        protected_dest = kdb_dest.is_protected()
-        protected_src = kdb_src.is_protected()
-        if protected_dest:
+        # databases must be unprotected to do a merge, the destination is left
+        # unprotected as values are protected when it is written
+        if kdb_dest.is_protected():
             kdb_dest.unprotect()
+        protected_src = kdb_src.is_protected()
         if protected_src:
             kdb_src.unprotect()
         
@@ -193,9 +193,7 @@ class KDB4Merge(KDBMerge):
         
         self._merge_roots(kdb_dest.obj_root.Root, kdb_src.obj_root.Root)
         
-        # Set protected status back to the way it was before
-        if protected_dest:
-            kdb_dest.protect()
+        # Set protected status of the source back to the way it was before
         if protected_src:
             kdb_src.protect()
 
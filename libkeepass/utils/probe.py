@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Reading the settings of KeePass files from their headers, no credentials
+needed::
+
+    >>> info = libkeepass.probe('passwords.kdbx')
+    >>> info.cipher, info.rounds
+    ('AES', 6000)
+
+`scan` probes all KeePass files below a directory on a thread pool::
+
+    >>> for info in libkeepass.scan('/srv/vaults', workers=8):
+    ...     if info.error is None and info.rounds < 100000:
+    ...         print(info.path)
+"""
+
+import io
+import os
+import struct
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import libkeepass
+
+
+SCAN_EXTENSIONS = ('.kdb', '.kdbx')
+
+
+class ProbeResult(object):
+    """
+    Header settings of a KeePass file. Fields that do not exist in the file
+    format are None, `error` is only set by `scan` for files that could not
+    be probed.
+    """
+    __slots__ = ('path', 'format', 'version', 'cipher', 'kdf', 'rounds',
+                 'compression', 'inner_stream', 'header_size', 'file_size',
+                 'error')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return 'ProbeResult({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__))
+
+
+def _version(packed):
+    "Format the version number `packed` as 'major.minor'."
+    return '{}.{}'.format(packed >> 16, packed & 0xffff)
+
+
+def _kdb3_info(kdb):
+    header = kdb.header
+    return dict(
+        format='KDB3',
+        version=_version(struct.unpack('<I', header.Version)[0]),
+        cipher=header.encryption_flags.get(header.Flags - 1),
+        kdf='AES-KDF',
+        rounds=header.KeyEncRounds,
+        compression=None,
+        inner_stream=None,
+    )
+
+
+def _kdb4_info(kdb):
+    header = kdb.header
+    compression = header.get('CompressionFlags')
+    stream_id = header.get('InnerRandomStreamID')
+    if kdb.file_version < libkeepass.kdb4.FILEVERSION_4:
+        kdf, rounds = 'AES-KDF', header.get('TransformRounds')
+    else:
+        # the inner stream settings are in the encrypted inner header
+        params = kdb.kdf_parameters
+        kdf = header.kdfs.get(params.get('$UUID'))
+        rounds = params.get('R', params.get('I'))
+    return dict(
+        format='KDB4',
+        version=_version(kdb.file_version),
+        cipher=header.ciphers.get(header.get('CipherID')),
+        kdf=kdf,
+        rounds=rounds,
+        compression='gzip' if compression == 1 else 'none',
+        inner_stream=header.protected_streams.get(stream_id, stream_id),
+    )
+
+
+def probe_stream(stream, path=None):
+    """
+    Read the signature and header of the KeePass file in `stream` and return
+    a `ProbeResult`. Raises `UnknownKDBError` for other files.
+    """
+    header = libkeepass.common.HeaderBuffer(stream)
+    signature = libkeepass.common.read_signature(header)
+    kdb = libkeepass.get_kdb_reader(signature)()
+    kdb._read_header(header)
+    if isinstance(kdb, libkeepass.kdb3.KDB3File):
+        info = _kdb3_info(kdb)
+    else:
+        info = _kdb4_info(kdb)
+    stream.seek(0, io.SEEK_END)
+    return ProbeResult(path=path, header_size=kdb.header_length,
+                       file_size=stream.tell(), **info)
+
+
+def probe(path_or_stream):
+    """
+    Return the `ProbeResult` of the KeePass file at a path or in an open
+    binary stream.
+    """
+    if hasattr(path_or_stream, 'read'):
+        return probe_stream(path_or_stream,
+                            getattr(path_or_stream, 'name', None))
+    with io.open(path_or_stream, 'rb') as stream:
+        return probe_stream(stream, path_or_stream)
+
+
+def _probe_path(path):
+    try:
+        return probe(path)
+    except Exception as ex:
+        return ProbeResult(path=path, error=ex)
+
+
+def scan(directory, workers=4, extensions=SCAN_EXTENSIONS):
+    """
+    Probe the files with one of `extensions` (any file if None) in the tree
+    below `directory` on `workers` threads. Yields a `ProbeResult` per file
+    in the order of `os.walk`, files that could not be probed have `error`
+    set to the exception.
+    """
+    if extensions is not None:
+        extensions = tuple(ext.lower() for ext in extensions)
+    # probes submitted ahead of the results consumed
+    window = workers * 4
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                if extensions is not None and \
+                        not name.lower().endswith(extensions):
+                    continue
+                pending.append(executor.submit(
+                    _probe_path, os.path.join(root, name)))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
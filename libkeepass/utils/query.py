@@ -0,0 +1,509 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed entry lookups for KDB4 element trees.
+
+`EntryIndex` keeps per-field postings of the (non protected) String values of
+all entries, plus group path, tag and UUID indexes. `KDB4Query` describes what
+to look for and `QueryResult` lazily evaluates it against an index::
+
+    >>> res = kdb.query(Title='GitHub', UserName=prefix('adm'))
+    >>> res.page(0, size=20)
+    >>> print(res.explain())
+
+Plain strings are exact matches, wrap the value in `prefix`, `contains` or
+`regex` for the other kinds of matches. Field names that are not valid keyword
+arguments can be passed in the `fields` dictionary.
+"""
+
+import re
+import bisect
+import datetime
+import itertools
+
+from . import parse_timestamp
+
+
+DEFAULT_PAGE_SIZE = 50
+
+
+class Predicate(object):
+    "Base class of the field predicates of a `KDB4Query`."
+    kind = None
+
+    def __init__(self, value):
+        self.value = value
+
+    def match(self, text):
+        raise NotImplementedError("Must use subclass")
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.kind, self.value)
+
+
+class Exact(Predicate):
+    "Field value equals `value`, answered from the field index."
+    kind = 'exact'
+
+    def match(self, text):
+        return text == self.value
+
+
+class Prefix(Predicate):
+    "Field value starts with `value`, answered from the sorted field values."
+    kind = 'prefix'
+
+    def match(self, text):
+        return text is not None and text.startswith(self.value)
+
+
+class Contains(Predicate):
+    """
+    Field value contains `value`. Only the distinct values of a field are
+    scanned, not the entries.
+    """
+    kind = 'contains'
+
+    def __init__(self, value, ignore_case=False):
+        Predicate.__init__(self, value)
+        self.ignore_case = ignore_case
+        if ignore_case:
+            self._needle = value.lower()
+        else:
+            self._needle = value
+
+    def match(self, text):
+        if text is None:
+            return False
+        if self.ignore_case:
+            text = text.lower()
+        return self._needle in text
+
+
+class Regex(Predicate):
+    "Field value matches the regular expression `value`, needs a scan."
+    kind = 'regex'
+
+    def __init__(self, value, flags=0):
+        Predicate.__init__(self, value)
+        self.regex = re.compile(value, flags)
+
+    def match(self, text):
+        return text is not None and self.regex.search(text) is not None
+
+
+exact = Exact
+prefix = Prefix
+contains = Contains
+regex = Regex
+
+
+def split_tags(text):
+    "Split the text of an entry's Tags element, KeePass allows ';' and ','."
+    if not text:
+        return ()
+    return tuple(t.strip() for t in re.split('[;,]', text) if t.strip())
+
+
+def group_path(names):
+    "Join group names to the path format of `merge.get_pw_path`."
+    return '/' + '/'.join(names)
+
+
+class KDB4Query(object):
+    """
+    Description of an entry query.
+
+    :arg fields: dictionary of String keys to a `Predicate` or a plain string
+        for exact matches.
+    :arg group: group path (eg. '/Root Group/Internet') or Group element,
+        only entries in this group or its subgroups match. '/' matches all
+        groups.
+    :arg tags: iterable of tags, all of which an entry must have.
+    :arg expired: True/False to only return (not) expired entries, None for
+        both.
+    :arg include_deleted: also return entries listed in DeletedObjects.
+    """
+
+    def __init__(self, fields=None, group=None, tags=(), expired=None,
+                 include_deleted=False):
+        self.fields = {}
+        for key, pred in (fields or {}).items():
+            if not isinstance(pred, Predicate):
+                pred = Exact(pred)
+            self.fields[key] = pred
+        if group is not None and not isinstance(group, str):
+            group = group_path(self._group_names(group))
+        if group is not None:
+            # the root path '/' contains every group, no filter needed
+            group = '/' + group.strip('/') if group.strip('/') else None
+        self.group = group
+        if isinstance(tags, str):
+            tags = split_tags(tags)
+        self.tags = tuple(tags)
+        self.expired = expired
+        self.include_deleted = include_deleted
+
+    @staticmethod
+    def _group_names(group):
+        names = []
+        while group is not None and group.tag == 'Group':
+            names.insert(0, group.findtext('Name') or '')
+            group = group.getparent()
+        return names
+
+
+class EntryIndex(object):
+    """
+    Secondary indexes over the entries of a KDB4 element tree.
+
+    Entries are numbered in document order. History entries are not indexed
+    and neither are protected values, because their text depends on the
+    protection state of the tree. Fields which are protected in any entry are
+    listed in `protected_keys` and never answered from the index.
+
+    The index is not aware of changes to the tree, report them using
+    `update`.
+    """
+
+    def __init__(self, obj_root):
+        self.obj_root = obj_root
+        self.build()
+
+    def build(self):
+        "(Re)build all indexes from the element tree."
+        # per position (document order) lists, removed entries become None
+        self.entries = []
+        self.values = []
+        self.paths = []
+        self.tags = []
+        self.uuids = []
+        # uuid -> position
+        self.positions = {}
+        # field key -> value -> positions
+        self.postings = {}
+        self.by_path = {}
+        self.by_tag = {}
+        self.protected_keys = set()
+        self.deleted = set()
+        self._sorted_values = {}
+        self._sorted_paths = None
+
+        root = self.obj_root.find('Root')
+        if root is None:
+            return
+        self.deleted = set(el.text for el in
+                           root.iterfind('DeletedObjects/DeletedObject/UUID'))
+        for group, path in self._iter_groups(root):
+            for entry in group.iterchildren('Entry'):
+                self._add(entry, path)
+
+    @staticmethod
+    def _iter_groups(parent, names=()):
+        "Yield (group, path) for all groups below `parent` in document order."
+        stack = [(g, names) for g in reversed(list(parent.iterchildren('Group')))]
+        while stack:
+            group, names = stack.pop()
+            names = names + (group.findtext('Name') or '',)
+            yield group, group_path(names)
+            stack.extend((g, names) for g in
+                         reversed(list(group.iterchildren('Group'))))
+
+    def _add(self, entry, path):
+        values = {}
+        for string in entry.iterchildren('String'):
+            key = string.findtext('Key')
+            value = string.find('Value')
+            if key is None or value is None:
+                continue
+            if value.get('Protected') is not None:
+                self.protected_keys.add(key)
+                continue
+            values[key] = value.text or ''
+        self._insert(entry, path, entry.findtext('UUID'), values,
+                     split_tags(entry.findtext('Tags')))
+
+    def _insert(self, entry, path, uuid, values, tags):
+        pos = len(self.entries)
+        self.entries.append(entry)
+        self.values.append(values)
+        self.paths.append(path)
+        self.tags.append(tags)
+        self.uuids.append(uuid)
+        self.positions[uuid] = pos
+
+        for key, value in values.items():
+            self.postings.setdefault(key, {}).setdefault(value, []).append(pos)
+            self._sorted_values.pop(key, None)
+        for tag in tags:
+            self.by_tag.setdefault(tag, []).append(pos)
+        if path not in self.by_path:
+            self._sorted_paths = None
+        self.by_path.setdefault(path, []).append(pos)
+
+    def _remove(self, pos):
+        for key, value in self.values[pos].items():
+            plist = self.postings[key][value]
+            plist.remove(pos)
+            if not plist:
+                del self.postings[key][value]
+                self._sorted_values.pop(key, None)
+        for tag in self.tags[pos]:
+            self.by_tag[tag].remove(pos)
+        self.by_path[self.paths[pos]].remove(pos)
+        del self.positions[self.uuids[pos]]
+        self.entries[pos] = None
+        self.values[pos] = {}
+        self.tags[pos] = ()
+
+    def _is_attached(self, elem):
+        for ancestor in elem.iterancestors():
+            if ancestor.tag == 'History':
+                return False
+            if ancestor is self.obj_root or ancestor.tag == 'KeePassFile':
+                return True
+        return False
+
+    def update(self, elem):
+        """
+        Reindex a changed, added or removed Entry or Group element. For groups
+        all entries in the subtree are reindexed, so renamed or moved groups
+        get their new path.
+        """
+        if elem.tag == 'DeletedObjects' or elem.tag == 'DeletedObject':
+            self.deleted = set(el.text for el in self.obj_root.iterfind(
+                'Root/DeletedObjects/DeletedObject/UUID'))
+            return
+        parent = elem.getparent()
+        if elem.tag == 'Entry' and parent is not None and \
+                parent.tag == 'History':
+            # history items share the UUID of the entry owning them
+            return self.update(parent.getparent())
+        if elem.tag == 'Entry':
+            entries = [elem]
+        elif elem.tag == 'Group':
+            entries = [e for e in elem.iter('Entry')
+                       if e.getparent().tag == 'Group']
+        else:
+            raise ValueError("Can only reindex Entry or Group elements, "
+                             "not %s" % elem.tag)
+
+        # detached elements are only removed from the index
+        attached = self._is_attached(elem)
+        for entry in entries:
+            pos = self.positions.get(entry.findtext('UUID'))
+            if pos is not None:
+                self._remove(pos)
+            if attached:
+                self._add(entry, group_path(
+                    KDB4Query._group_names(entry.getparent())))
+
+    def add(self, entries, path, fields=None):
+        """
+        Index new `entries` of the group with `path`. If given, `fields` are
+        the (UUID, non protected String values, tags, protected String keys)
+        of each entry, their elements are not read then.
+        """
+        if fields is None:
+            for entry in entries:
+                self._add(entry, path)
+            return
+        for entry, (uuid, values, tags, protected) in zip(entries, fields):
+            self.protected_keys.update(protected)
+            self._insert(entry, path, uuid, values, tags)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def live_positions(self):
+        return [pos for pos, e in enumerate(self.entries) if e is not None]
+
+    def value(self, pos, key):
+        "Return the text of field `key` of the entry at `pos`."
+        values = self.values[pos]
+        if key in values:
+            return values[key]
+        if key not in self.protected_keys:
+            return None
+        for string in self.entries[pos].iterchildren('String'):
+            if string.findtext('Key') == key:
+                return string.findtext('Value')
+        return None
+
+    # index lookups, all return a sorted list of positions
+
+    def lookup(self, key, value):
+        return list(self.postings.get(key, {}).get(value, ()))
+
+    def _sorted(self, key):
+        if key not in self._sorted_values:
+            self._sorted_values[key] = sorted(self.postings.get(key, {}))
+        return self._sorted_values[key]
+
+    def lookup_prefix(self, key, prefix):
+        values = self._sorted(key)
+        postings = self.postings.get(key, {})
+        found = []
+        for i in range(bisect.bisect_left(values, prefix), len(values)):
+            if not values[i].startswith(prefix):
+                break
+            found.extend(postings[values[i]])
+        found.sort()
+        return found
+
+    def lookup_contains(self, key, predicate):
+        found = []
+        for value, plist in self.postings.get(key, {}).items():
+            if predicate.match(value):
+                found.extend(plist)
+        found.sort()
+        return found
+
+    def lookup_group(self, path):
+        if self._sorted_paths is None:
+            self._sorted_paths = sorted(self.by_path)
+        paths = self._sorted_paths
+        found = []
+        for i in range(bisect.bisect_left(paths, path), len(paths)):
+            if paths[i] != path and not paths[i].startswith(path + '/'):
+                if not paths[i].startswith(path):
+                    break
+                continue
+            found.extend(self.by_path[paths[i]])
+        found.sort()
+        return found
+
+    def lookup_tag(self, tag):
+        return list(self.by_tag.get(tag, ()))
+
+    def query(self, fields=None, **kwargs):
+        """
+        Query entries, returns a lazily evaluated `QueryResult`. Keyword
+        arguments that are not options of `KDB4Query` are field predicates.
+        """
+        fields = dict(fields or {})
+        options = {}
+        for name in ('group', 'tags', 'expired', 'include_deleted'):
+            if name in kwargs:
+                options[name] = kwargs.pop(name)
+        fields.update(kwargs)
+        return QueryResult(self, KDB4Query(fields, **options))
+
+
+class QueryResult(object):
+    """
+    Lazily evaluated result of a `KDB4Query`. The plan is made on first use;
+    iterating yields matching Entry elements in document order.
+    """
+
+    def __init__(self, index, query):
+        self.index = index
+        self.query = query
+        self._plan = None
+
+    def _make_plan(self):
+        index, query = self.index, self.query
+        sources = []
+        for key, pred in sorted(query.fields.items()):
+            if key in index.protected_keys:
+                continue
+            desc = 'index {} {}={!r}'.format(pred.kind, key, pred.value)
+            if pred.kind == 'exact':
+                sources.append((desc, index.lookup(key, pred.value)))
+            elif pred.kind == 'prefix':
+                sources.append((desc, index.lookup_prefix(key, pred.value)))
+            elif pred.kind == 'contains':
+                sources.append(('value scan contains {}={!r}'.format(
+                    key, pred.value), index.lookup_contains(key, pred)))
+        if query.group is not None:
+            sources.append(('index group {!r}'.format(query.group),
+                            index.lookup_group(query.group)))
+        for tag in query.tags:
+            sources.append(('index tag {!r}'.format(tag),
+                            index.lookup_tag(tag)))
+
+        if sources:
+            driver, candidates = min(sources, key=lambda s: len(s[1]))
+        else:
+            driver, candidates = 'full scan', index.live_positions()
+        filters = ['{} {}'.format(pred.kind, key)
+                   for key, pred in sorted(query.fields.items())]
+        if query.expired is not None:
+            filters.append('expired={}'.format(query.expired))
+        if not query.include_deleted:
+            filters.append('not deleted')
+        self._plan = {
+            'driver': driver,
+            'candidates': candidates,
+            'sources': [(desc, len(c)) for desc, c in sources],
+            'filters': filters,
+        }
+        return self._plan
+
+    @property
+    def plan(self):
+        return self._plan or self._make_plan()
+
+    def _matches(self, pos, now):
+        index, query = self.index, self.query
+        entry = index.entries[pos]
+        if entry is None:
+            return False
+        if not query.include_deleted and index.uuids[pos] in index.deleted:
+            return False
+        for key, pred in query.fields.items():
+            if not pred.match(index.value(pos, key)):
+                return False
+        if query.group is not None:
+            path = index.paths[pos]
+            if path != query.group and not path.startswith(query.group + '/'):
+                return False
+        if query.tags and not set(query.tags).issubset(index.tags[pos]):
+            return False
+        if query.expired is not None and \
+                is_expired(entry, now) != query.expired:
+            return False
+        return True
+
+    def __iter__(self):
+        now = datetime.datetime.utcnow()
+        for pos in self.plan['candidates']:
+            if self._matches(pos, now):
+                yield self.index.entries[pos]
+
+    def page(self, number, size=DEFAULT_PAGE_SIZE):
+        "Return the list of entries on (zero based) page `number`."
+        start = number * size
+        return list(itertools.islice(iter(self), start, start + size))
+
+    def first(self):
+        "Return the first matching entry or None."
+        for entry in self:
+            return entry
+        return None
+
+    def count(self):
+        "Count all matching entries, this evaluates the whole query."
+        return sum(1 for _ in self)
+
+    def explain(self):
+        "Return a human readable description of the chosen plan."
+        plan = self.plan
+        lines = ['plan: {} ({} candidates of {} entries)'.format(
+            plan['driver'], len(plan['candidates']), len(self.index))]
+        for desc, count in plan['sources']:
+            lines.append('  considered: {} ({} candidates)'.format(desc, count))
+        for desc in plan['filters']:
+            lines.append('  filter: {}'.format(desc))
+        return '\n'.join(lines)
+
+
+def is_expired(entry, now=None):
+    "Return True if the Entry or Group element `entry` has expired."
+    if entry.findtext('Times/Expires') != 'True':
+        return False
+    expiry = entry.findtext('Times/ExpiryTime')
+    if not expiry:
+        return False
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return parse_timestamp(expiry) <= now
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Saving databases to files atomically, in the foreground or on a worker thread.
+
+`save_atomic` writes to a temporary file next to the target, which replaces
+the target only after it was written and synced completely.
+
+`AsyncSaver` saves snapshots of a database on a worker thread::
+
+    >>> future = kdb.save_async('passwords.kdbx')
+    >>> # keep editing kdb, the save is not affected
+    >>> future.result()
+    'passwords.kdbx'
+
+Requests for a path that arrive while it is being written are coalesced: only
+the latest snapshot is written once the running save is done, all those
+requests share its future.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def save_atomic(kdb, path, **kwargs):
+    """
+    Write `kdb` to `path` via a temporary file in the same directory, which
+    is renamed to `path` when complete. `kwargs` are passed to `write_to`.
+
+    The permissions of an existing file at `path` are kept, new files are
+    only readable and writable by the owner.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp',
+                                    dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            kdb.write_to(stream, **kwargs)
+            os.fsync(stream.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+class AsyncSaver(object):
+    """
+    Writes database snapshots with `save_atomic` on a worker thread, one at a
+    time. The thread is started when needed and ends when there is nothing
+    left to save.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # path -> (snapshot, write_to kwargs, future) waiting to be written
+        self._pending = OrderedDict()
+        self._thread = None
+
+    def save(self, kdb, path, **kwargs):
+        """
+        Take a snapshot of `kdb` and schedule writing it to `path`. Returns a
+        `concurrent.futures.Future` with the path as result.
+        """
+        snapshot = kdb.snapshot()
+        with self._cond:
+            if path in self._pending:
+                # coalesce with the save waiting for this path
+                replaced, _, future = self._pending[path]
+                replaced.close()
+            else:
+                future = Future()
+            self._pending[path] = (snapshot, kwargs, future)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='libkeepass-save')
+                self._thread.start()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._pending:
+                    self._thread = None
+                    self._cond.notify_all()
+                    return
+                path, (snapshot, kwargs, future) = \
+                    self._pending.popitem(last=False)
+            if not future.set_running_or_notify_cancel():
+                snapshot.close()
+                continue
+            try:
+                future.set_result(save_atomic(snapshot, path, **kwargs))
+            except BaseException as ex:
+                future.set_exception(ex)
+            finally:
+                snapshot.close()
+
+    def wait(self, timeout=None):
+        """
+        Wait until all scheduled saves are done. Returns False if `timeout`
+        seconds passed before.
+        """
+        with self._cond:
+            if self._thread is threading.current_thread():
+                raise RuntimeError("Cannot wait for saves from the worker")
+            while self._thread is not None:
+                if not self._cond.wait(timeout):
+                    return False
+        return True
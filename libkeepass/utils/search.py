@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Tokenised inverted index over the String fields of KDB4 entries.
+
+The index works on any (objectified or plain) lxml element tree of a KDB4
+document, so it can be used by the library and by tools that parse the XML
+themselves::
+
+    >>> index = FullTextIndex(kdb.obj_root)
+    >>> for score, entry in index.search('mail work', limit=10):
+    ...     print(score, entry.UUID.text)
+
+Entries in groups with `EnableSearching` set to false (inherited by subgroups
+set to null) and History entries are not indexed. Protected values are only
+indexed with `include_protected=True`.
+"""
+
+import re
+import math
+import bisect
+
+# relative weight of a term found in one of these fields, any other String
+# field gets DEFAULT_FIELD_WEIGHT
+FIELD_WEIGHTS = {
+    'Title': 4.0,
+    'UserName': 2.0,
+    'URL': 2.0,
+    'Notes': 1.0,
+}
+DEFAULT_FIELD_WEIGHT = 1.0
+# score factor for query tokens only matching as prefix of a term
+PREFIX_WEIGHT = 0.5
+
+_token_re = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    "Split `text` into lower case word tokens."
+    if not text:
+        return []
+    return _token_re.findall(text.lower())
+
+
+def _searching_enabled(group, inherited):
+    value = (group.findtext('EnableSearching') or 'null').lower()
+    if value == 'null':
+        return inherited
+    return value != 'false'
+
+
+class FullTextIndex(object):
+    """
+    Inverted index of entry String fields with ranked searches. Postings map
+    each term to the weighted term frequency per entry position.
+
+    Like `EntryIndex` the index does not notice changes to the tree, report
+    modified, added or removed Entry and Group elements with `update`.
+    """
+
+    def __init__(self, obj_root, include_protected=False):
+        self.obj_root = obj_root
+        self.include_protected = include_protected
+        self.build()
+
+    def build(self):
+        "(Re)build the index from the element tree."
+        self.entries = []
+        self.terms = []
+        self.positions = {}
+        self.postings = {}
+        self._sorted_terms = None
+
+        root = self.obj_root.find('Root')
+        if root is None:
+            return
+        stack = [(g, True) for g in reversed(list(root.iterchildren('Group')))]
+        while stack:
+            group, enabled = stack.pop()
+            enabled = _searching_enabled(group, enabled)
+            if enabled:
+                for entry in group.iterchildren('Entry'):
+                    self._add(entry)
+            stack.extend((g, enabled) for g in
+                         reversed(list(group.iterchildren('Group'))))
+
+    def _entry_terms(self, entry):
+        terms = {}
+        for string in entry.iterchildren('String'):
+            value = string.find('Value')
+            if value is None:
+                continue
+            if value.get('Protected') is not None and \
+                    not self.include_protected:
+                continue
+            weight = FIELD_WEIGHTS.get(string.findtext('Key'),
+                                       DEFAULT_FIELD_WEIGHT)
+            for token in tokenize(value.text):
+                terms[token] = terms.get(token, 0.0) + weight
+        return terms
+
+    def _add(self, entry):
+        terms = self._entry_terms(entry)
+        pos = len(self.entries)
+        self.entries.append(entry)
+        self.terms.append(terms)
+        self.positions[entry.findtext('UUID')] = pos
+        for term, weight in terms.items():
+            if term not in self.postings:
+                self.postings[term] = {}
+                self._sorted_terms = None
+            self.postings[term][pos] = weight
+
+    def _remove(self, pos):
+        for term in self.terms[pos]:
+            plist = self.postings[term]
+            del plist[pos]
+            if not plist:
+                del self.postings[term]
+                self._sorted_terms = None
+        del self.positions[self.entries[pos].findtext('UUID')]
+        self.entries[pos] = None
+        self.terms[pos] = {}
+
+    def _is_searchable(self, entry):
+        "Return True if `entry` is attached to the tree and searchable."
+        groups = []
+        for ancestor in entry.iterancestors():
+            if ancestor.tag == 'Group':
+                groups.append(ancestor)
+            elif ancestor.tag == 'Root':
+                break
+            elif ancestor.tag == 'History':
+                return False
+        else:
+            return False
+        enabled = True
+        for group in reversed(groups):
+            enabled = _searching_enabled(group, enabled)
+        return enabled
+
+    def update(self, elem):
+        """
+        Reindex a changed, added or removed Entry or Group element. Only the
+        affected entries are tokenised again.
+        """
+        parent = elem.getparent()
+        if elem.tag == 'Entry' and parent is not None and \
+                parent.tag == 'History':
+            return self.update(parent.getparent())
+        if elem.tag == 'Entry':
+            entries = [elem]
+        elif elem.tag == 'Group':
+            entries = [e for e in elem.iter('Entry')
+                       if e.getparent().tag == 'Group']
+        else:
+            raise ValueError("Can only reindex Entry or Group elements, "
+                             "not %s" % elem.tag)
+        for entry in entries:
+            pos = self.positions.get(entry.findtext('UUID'))
+            if pos is not None:
+                self._remove(pos)
+            if self._is_searchable(entry):
+                self._add(entry)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _expand(self, token):
+        "Yield (term, factor) of all terms matching the query `token`."
+        if token in self.postings:
+            yield token, 1.0
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        terms = self._sorted_terms
+        for i in range(bisect.bisect_right(terms, token), len(terms)):
+            if not terms[i].startswith(token):
+                break
+            yield terms[i], PREFIX_WEIGHT
+
+    def search(self, text, limit=None):
+        """
+        Return a list of (score, entry) tuples of the entries matching all
+        tokens in `text`, best matches first. A token matches terms equal to
+        it or starting with it, scores are tf-idf weighted by field.
+        """
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        n_entries = float(max(len(self.positions), 1))
+        scores = None
+        for token in set(tokens):
+            token_scores = {}
+            for term, factor in self._expand(token):
+                plist = self.postings[term]
+                idf = math.log(1.0 + n_entries / len(plist))
+                for pos, weight in plist.items():
+                    token_scores[pos] = token_scores.get(pos, 0.0) + \
+                        factor * weight * idf
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = dict((pos, score + token_scores[pos])
+                              for pos, score in scores.items()
+                              if pos in token_scores)
+            if not scores:
+                return []
+        ranked = sorted(scores.items(), key=lambda ps: (-ps[1], ps[0]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [(score, self.entries[pos]) for pos, score in ranked]
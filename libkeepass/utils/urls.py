@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Browser style lookup of KDB4 entries by page URL.
+
+`DomainTrie` stores the hosts of the URL and OverrideURL fields of all entries
+by their reversed labels (`login.example.com` is stored under com -> example
+-> login). Scheme, user info, port, a trailing dot and a leading `www.` are
+ignored. A lookup returns entries for
+
+* the exact host,
+* parent domains of the host, down to the registrable domain,
+* other hosts below the same registrable domain,
+
+in that order. Hosts without a registrable domain, like a public suffix
+itself, only match exactly. The registrable domain is found with a small built-in list of
+multi-label public suffixes, which can be replaced with `public_suffixes`.
+"""
+
+from urllib.parse import urlsplit
+
+
+WEB_SCHEMES = ('http', 'https', 'ftp', 'ftps')
+
+# public suffixes with more than one label, everything else is assumed to be
+# a single label suffix like 'com' or 'de'
+PUBLIC_SUFFIXES = frozenset("""
+    ac.uk co.uk gov.uk ltd.uk me.uk net.uk org.uk plc.uk sch.uk
+    com.au edu.au gov.au net.au org.au id.au
+    co.nz govt.nz net.nz org.nz
+    co.jp ne.jp or.jp ac.jp go.jp
+    co.kr or.kr
+    com.br net.br org.br gov.br
+    com.cn net.cn org.cn gov.cn edu.cn
+    com.hk com.sg com.tw com.mx com.ar com.tr com.ua com.pl
+    co.in net.in org.in co.za org.za co.il ac.il
+    github.io gitlab.io herokuapp.com appspot.com blogspot.com
+    cloudfront.net azurewebsites.net
+""".split())
+
+MATCH_EXACT = 'exact'
+MATCH_PARENT = 'parent'
+MATCH_DOMAIN = 'domain'
+
+
+def url_host(url):
+    """
+    Return the normalised host name of `url` or None if it has no usable
+    host. URLs without scheme are read as web URLs.
+    """
+    if not url:
+        return None
+    url = url.strip()
+    if '{' in url:
+        # KeePass field references and placeholders
+        return None
+    if '://' not in url:
+        url = 'http://' + url
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+    except ValueError:
+        return None
+    if parts.scheme.lower() not in WEB_SCHEMES or not host:
+        return None
+    host = host.rstrip('.')
+    if host.startswith('www.'):
+        host = host[4:]
+    return host or None
+
+
+def _is_ip(host):
+    return ':' in host or host.replace('.', '').isdigit()
+
+
+def host_labels(host):
+    "Return the labels of `host` starting at the top level domain."
+    if _is_ip(host):
+        return [host]
+    return host.split('.')[::-1]
+
+
+class _Node(object):
+    __slots__ = ('children', 'positions')
+
+    def __init__(self):
+        self.children = {}
+        self.positions = set()
+
+
+class DomainTrie(object):
+    """
+    Reverse domain trie over entry URLs. Like the other indexes it does not
+    notice changes to the tree, report modified Entry and Group elements with
+    `update`.
+    """
+
+    def __init__(self, obj_root, public_suffixes=PUBLIC_SUFFIXES):
+        self.obj_root = obj_root
+        self.public_suffixes = public_suffixes
+        self.build()
+
+    def build(self):
+        "(Re)build the trie from the element tree."
+        self.root = _Node()
+        self.entries = []
+        self.hosts = []
+        self.positions = {}
+        root = self.obj_root.find('Root')
+        if root is None:
+            return
+        for entry in root.iter('Entry'):
+            if entry.getparent().tag == 'Group':
+                self._add(entry)
+
+    def _entry_hosts(self, entry):
+        urls = [entry.findtext('OverrideURL')]
+        for string in entry.iterchildren('String'):
+            if string.findtext('Key') == 'URL':
+                urls.append(string.findtext('Value'))
+        hosts = set(url_host(url) for url in urls)
+        hosts.discard(None)
+        return hosts
+
+    def _add(self, entry):
+        hosts = self._entry_hosts(entry)
+        pos = len(self.entries)
+        self.entries.append(entry)
+        self.hosts.append(hosts)
+        self.positions[entry.findtext('UUID')] = pos
+        for host in hosts:
+            node = self.root
+            for label in host_labels(host):
+                node = node.children.setdefault(label, _Node())
+            node.positions.add(pos)
+
+    def _remove(self, pos):
+        for host in self.hosts[pos]:
+            path = [self.root]
+            for label in host_labels(host):
+                path.append(path[-1].children[label])
+            path[-1].positions.discard(pos)
+            # prune empty nodes
+            labels = host_labels(host)
+            for i in range(len(labels), 0, -1):
+                node = path[i]
+                if node.positions or node.children:
+                    break
+                del path[i - 1].children[labels[i - 1]]
+        del self.positions[self.entries[pos].findtext('UUID')]
+        self.entries[pos] = None
+        self.hosts[pos] = set()
+
+    def update(self, elem):
+        "Reindex a changed, added or removed Entry or Group element."
+        parent = elem.getparent()
+        if elem.tag == 'Entry' and parent is not None and \
+                parent.tag == 'History':
+            return self.update(parent.getparent())
+        if elem.tag == 'Entry':
+            entries = [elem]
+        elif elem.tag == 'Group':
+            entries = [e for e in elem.iter('Entry')
+                       if e.getparent().tag == 'Group']
+        else:
+            raise ValueError("Can only reindex Entry or Group elements, "
+                             "not %s" % elem.tag)
+        attached = any(a.tag == 'Root' for a in elem.iterancestors())
+        for entry in entries:
+            pos = self.positions.get(entry.findtext('UUID'))
+            if pos is not None:
+                self._remove(pos)
+            if attached:
+                self._add(entry)
+
+    def registrable_length(self, labels):
+        """
+        Number of labels of the registrable domain in reversed `labels`, None
+        if the host has no registrable domain (public suffixes, single label
+        hosts and IP addresses).
+        """
+        if len(labels) == 1:
+            return None
+        if '.'.join(labels[1::-1]) in self.public_suffixes:
+            suffix_len = 2
+        else:
+            suffix_len = 1
+        if len(labels) <= suffix_len:
+            return None
+        return suffix_len + 1
+
+    def lookup(self, url, match=MATCH_DOMAIN):
+        """
+        Return a list of (match kind, entry) tuples for the page `url`, best
+        matches first. `match` limits the lookup to MATCH_EXACT hosts or
+        MATCH_PARENT domains, the default MATCH_DOMAIN also returns entries of
+        sibling hosts below the registrable domain.
+        """
+        host = url_host(url)
+        if host is None:
+            return []
+        labels = host_labels(host)
+        reg_len = self.registrable_length(labels)
+
+        path = []
+        node = self.root
+        for label in labels:
+            node = node.children.get(label)
+            if node is None:
+                break
+            path.append(node)
+
+        found = []
+        seen = set()
+
+        def add(kind, positions):
+            for pos in sorted(positions - seen):
+                found.append((kind, self.entries[pos]))
+            seen.update(positions)
+
+        if len(path) == len(labels):
+            add(MATCH_EXACT, path[-1].positions)
+        if reg_len is None:
+            # never match across a public suffix
+            return found
+        if match in (MATCH_PARENT, MATCH_DOMAIN):
+            for node in reversed(path[reg_len - 1:len(labels) - 1]):
+                add(MATCH_PARENT, node.positions)
+        if match == MATCH_DOMAIN and len(path) >= reg_len:
+            stack = [path[reg_len - 1]]
+            below = set()
+            while stack:
+                node = stack.pop()
+                below.update(node.positions)
+                stack.extend(node.children.values())
+            add(MATCH_DOMAIN, below)
+        return found
@@ -13,16 +13,11 @@ except IndexError:
 
 try:
     with libkeepass.open(filename, password=getpass.getpass()) as kdb:
-        found = {}
-        for entry in kdb.obj_root.findall('.//Group/Entry'):
-            uuid = entry.find('./UUID').text
-            kv = {string.find('./Key').text : string.find('./Value').text for string in entry.findall('./String')}
-            if kv['Title'] == entry_title:
-                found[uuid] = kv['Password']
+        # entries listed in DeletedObjects are skipped by default
+        found = {entry.find("./String[Key='Password']/Value").text
+                 for entry in kdb.query(Title=entry_title)}
 
-        removed_uuids = {uuid.text for uuid in kdb.obj_root.findall('.//DeletedObject/UUID')}
-
-    for password in { found[k] for k in found.keys() if k not in removed_uuids }:
+    for password in found:
         print(password)
 except Exception as e:
     print('Could not query KeePass Database %s:\n%s' % (filename, str(e)), file=sys.stderr)
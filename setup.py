@@ -12,15 +12,24 @@ setup(
     keywords="keepass library",
     url="https://github.com/libkeepass/libkeepass",  # project home page, if any
     test_suite="tests",
+    python_requires=">=3.8",
     install_requires=[
-        "lxml>=3.2.1",
+        "lxml>=4.5",
         "pycryptodome>=3.4.11",
         "colorama>=0.3.2"
     ],
+    extras_require={
+        "argon2": ["argon2-cffi>=18.2.0"],
+        "numpy": ["numpy"],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.2",
-        "Programming Language :: Python :: 3.3",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
     ]
 )
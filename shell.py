@@ -8,6 +8,7 @@ import binascii
 import shlex
 
 import libkeepass
+from libkeepass.utils.search import FullTextIndex
 import getpass
 import lxml.etree
 import colorama
@@ -23,6 +24,7 @@ class KeePassShell(cmd.Cmd):
     filename = ''
     root = None
     tree = None
+    index = None
     current_group = None
     current_path = ''
     _globals = {}
@@ -37,6 +39,7 @@ class KeePassShell(cmd.Cmd):
                 kdbx_data = kdb.pretty_print()
                 self.root = lxml.etree.fromstring(kdbx_data)
                 self.tree = lxml.etree.ElementTree(self.root)
+                self.index = FullTextIndex(self.root)
                 self.current_group = self.tree.xpath("/KeePassFile/Root/Group")[0]
                 self.current_path = '/' + self.current_group.find('Name').text
                 self.filename = arg
@@ -55,25 +58,22 @@ class KeePassShell(cmd.Cmd):
 
 
     def do_search(self, arg):
-        """Search in a file"""
+        """Search words in the entries of a file: search [-n <max results>] <words>"""
         if self.root is None or self.tree is None:
             print("You must open a file first")
             return
-        search_term = arg
-        xpath_query = (
-            "//Group[EnableSearching!='false']/"
-            "Entry/String["
-            "(Key='Title' and re:test(Value, '{0}', 'i')) or "
-            "(Key='URL' and contains(Value,'{0}'))]/..").format(search_term.replace("'", "\\'"))
-        # print(xpath_query)
-        for e in self.root.xpath(xpath_query, namespaces={"re": "http://exslt.org/regular-expressions"}):
+        parser = argparse.ArgumentParser(prog='search')
+        parser.add_argument('-n', '--limit', type=int, default=None)
+        parser.add_argument('words', nargs='*')
+        try:
+            args = parser.parse_args(shlex.split(arg))
+        except SystemExit as ex:
+            print(repr(ex))
+            return
+        for score, e in self.index.search(' '.join(args.words), args.limit):
             print()
-            groups_path = [p.find(".//Name").text for p in e.iterancestors() if p.tag == 'Group']
+            groups_path = [p.find("Name").text for p in e.iterancestors() if p.tag == 'Group']
             print('/'.join(groups_path[::-1]))
-            # print(tree.getpath(e))
-            # print(lxml.etree.tostring(e).decode())
-            # print(lxml.etree.tostring(e.find('.//String[Key="URL"]')).decode())
-            # print(lxml.etree.tostring(e.find('.//String[Key="Password"]')))
             title = e.find('.//String[Key="Title"]/Value')
             if title is not None:
                 title = title.text
@@ -10,6 +10,7 @@ sys.path.insert(0, os.path.abspath(projectdir))
 from tests.tests import *
 from tests.tests_merge import *
 from tests.tests_check import *
+from tests.tests_query import *
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,666 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks, they are not part of the test suite. Run all or some of them
+with::
+
+    python -m tests.benchmarks [name ...]
+"""
+from __future__ import print_function
+
+import io
+import os
+import sys
+import copy
+import gzip
+import time
+import uuid
+import base64
+import random
+import datetime
+import tracemalloc
+from collections import OrderedDict
+
+testdir = os.path.dirname(__file__)
+sys.path.insert(0, os.path.abspath(os.path.dirname(testdir)))
+
+from tests import get_datafile
+
+import libkeepass
+import libkeepass.kdb3
+import libkeepass.kdb4
+from libkeepass.crypto import Salsa20, sha256, aes_cbc_encrypt, pad
+from libkeepass.hbio import HashedBlockIO
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timed(func, *args, **kwargs):
+    "Return (seconds, result) of calling `func`."
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def peak_memory(func, *args, **kwargs):
+    "Return (seconds, peak bytes allocated by Python) of calling `func`."
+    tracemalloc.start()
+    try:
+        seconds, result = timed(func, *args, **kwargs)
+        return seconds, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def new_uuid():
+    return base64.b64encode(uuid.uuid4().bytes).decode()
+
+
+def synthetic_kdb(n_entries, n_groups=0):
+    """
+    Return the merge sample database grown to `n_entries` entries, spread
+    over `n_groups` new groups if given.
+    """
+    kdb = libkeepass.open(get_datafile('sample_merge-t0-t1.kdbx'),
+                          password='qwerty')
+    root_group = kdb.obj_root.Root.Group
+    groups = [root_group]
+    if n_groups:
+        template = kdb.obj_root.find(".//Group[Name='Homebanking']")
+        groups = []
+        for i in range(n_groups):
+            group = copy.deepcopy(template)
+            group.UUID._setText(new_uuid())
+            group.Name._setText('Group {}'.format(i))
+            root_group.append(group)
+            groups.append(group)
+    template = kdb.obj_root.find('.//Entry')
+    passwords = random_passwords(n_entries)
+    for i, password in enumerate(
+            passwords[len(root_group.findall('.//Entry')):]):
+        entry = copy.deepcopy(template)
+        entry.UUID._setText(new_uuid())
+        entry.find("String[Key='Password']").Value._setText(password)
+        groups[i % len(groups)].append(entry)
+    return kdb
+
+
+class NullWriter(io.RawIOBase):
+    "Discards everything, counts the bytes written."
+
+    def __init__(self):
+        self.length = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.length += len(data)
+        return len(data)
+
+
+def legacy_save(kdb, stream):
+    "The fully buffered AES save pipeline libkeepass used."
+    stream.write(kdb._header())
+    kdb.protect()
+    data = kdb.pretty_print()
+    kdb.unprotect()
+    buf = io.BytesIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6)
+    gz.write(data)
+    gz.close()
+    block_buffer = HashedBlockIO()
+    block_buffer.write(buf.getvalue())
+    buf = io.BytesIO()
+    buf.write(kdb.header.StreamStartBytes)
+    block_buffer.write_block_stream(buf)
+    kdb._make_master_key()
+    stream.write(aes_cbc_encrypt(pad(buf.getvalue()), kdb.master_key,
+                                 kdb.header.EncryptionIV))
+
+
+def random_passwords(n, seed=0):
+    rnd = random.Random(seed)
+    chars = u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!$\xe4\xf6'
+    return [u''.join(rnd.choice(chars) for _ in range(rnd.randint(8, 24)))
+            for _ in range(n)]
+
+
+class LegacyProtection(object):
+    "The per value protection with 64 byte salsa refills libkeepass used."
+
+    def __init__(self, key):
+        self.salsa = Salsa20.new(sha256(key),
+                                 libkeepass.kdb4.KDB4_SALSA20_IV)
+        self.buffer = bytearray()
+
+    def get_salsa(self, length):
+        while length > len(self.buffer):
+            self.buffer.extend(self.salsa.encrypt(bytearray(64)))
+        nacho = self.buffer[:length]
+        del self.buffer[:length]
+        return nacho
+
+    @staticmethod
+    def xor(aa, bb):
+        return bytearray([a ^ b for a, b in zip(bytearray(aa), bytearray(bb))])
+
+    def unprotect(self, strings):
+        result = []
+        for string in strings:
+            tmp = base64.b64decode(string.encode("utf-8"))
+            result.append(self.xor(tmp, self.get_salsa(len(tmp))).decode("utf-8"))
+        return result
+
+    def protect(self, strings):
+        result = []
+        for string in strings:
+            encoded = string.encode("utf-8")
+            tmp = self.xor(encoded, self.get_salsa(len(encoded)))
+            result.append(base64.b64encode(tmp).decode("utf-8"))
+        return result
+
+
+@benchmark
+def protected_values(sizes=(10000, 100000, 1000000)):
+    """Per value and bulk protection of 10k, 100k and 1M protected fields"""
+    key = os.urandom(32)
+    kdb = libkeepass.kdb4.KDB4Reader()
+    kdb.header.ProtectedStreamKey = key
+
+    print('{:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'fields', 'protect', 'bulk', 'unprotect', 'bulk'))
+    for n in sizes:
+        passwords = random_passwords(n)
+
+        t_legacy_p, legacy_p = timed(LegacyProtection(key).protect, passwords)
+        kdb._reset_salsa()
+        t_bulk_p, bulk_p = timed(kdb._protect_many, passwords)
+        assert bulk_p == legacy_p
+
+        t_legacy_u, legacy_u = timed(LegacyProtection(key).unprotect, bulk_p)
+        kdb._reset_salsa()
+        t_bulk_u, bulk_u = timed(kdb._unprotect_many, bulk_p)
+        assert bulk_u == legacy_u == passwords
+
+        print('{:>8} {:>11.3f}s {:>11.3f}s {:>11.3f}s {:>11.3f}s'.format(
+            n, t_legacy_p, t_bulk_p, t_legacy_u, t_bulk_u))
+
+
+@benchmark
+def save_memory(sizes=(1000, 10000, 50000)):
+    """Peak Python memory and time of buffered and streaming saves"""
+    print('{:>8} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+        'entries', 'file size', 'buffered', 'peak', 'streaming', 'peak'))
+    for n in sizes:
+        kdb = synthetic_kdb(n)
+        t_legacy, m_legacy = peak_memory(legacy_save, kdb, NullWriter())
+        out = NullWriter()
+        t_stream, m_stream = peak_memory(kdb.write_to, out)
+        print('{:>8} {:>11.1f}M {:>11.3f}s {:>11.1f}M {:>11.3f}s {:>11.1f}M'.format(
+            n, out.length / 1e6, t_legacy, m_legacy / 1e6,
+            t_stream, m_stream / 1e6))
+        kdb.close()
+
+
+def load_peak(data, **credentials):
+    "Return (seconds, peak Python memory) of opening the file in `data`."
+    return peak_memory(libkeepass.kdb4.KDB4Reader, io.BytesIO(data),
+                       **credentials)
+
+
+@benchmark
+def compact_save():
+    """File size, save time and load memory of pretty and compact files"""
+    vaults = [
+        ('sample1.kdbx', dict(password='asdf')),
+        ('sample3.kdbx', dict(password='qwer',
+                              keyfile=get_datafile('sample3_keyfile.exe'))),
+        ('sample_merge-t0-t1.kdbx', dict(password='qwerty')),
+    ]
+    print('{:>24} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'vault', 'xml', 'compact', 'file', 'compact', 'save', 'compact',
+        'load', 'compact'))
+    rows = [(name, libkeepass.open(get_datafile(name), **credentials),
+             credentials) for name, credentials in vaults]
+    rows.append(('10000 entries', synthetic_kdb(10000),
+                 dict(password='qwerty')))
+    for name, kdb, credentials in rows:
+        xml = len(b''.join(kdb.serialize()))
+        xml_compact = len(b''.join(kdb.serialize(pretty_print=False)))
+        results = []
+        for compact in (False, True):
+            out = io.BytesIO()
+            seconds = min(timed(kdb.write_to, out, compact=compact)[0]
+                          for _ in range(3))
+            out = io.BytesIO()
+            kdb.write_to(out, compact=compact)
+            results.append((len(out.getvalue()), seconds,
+                            load_peak(out.getvalue(), **credentials)[1]))
+        (size, save, load), (c_size, c_save, c_load) = results
+        print('{:>24} {:>9} {:>9} {:>9} {:>9} {:>8.3f}s {:>8.3f}s {:>8.2f}M '
+              '{:>8.2f}M'.format(name, xml, xml_compact, size, c_size, save,
+                                 c_save, load / 1e6, c_load / 1e6))
+        kdb.close()
+
+
+@benchmark
+def incremental_save(sizes=(10000, 100000), n_groups=100):
+    """Serialization with and without fragment cache after one change"""
+    print('{:>8} {:>12} {:>12} {:>12}'.format(
+        'entries', 'uncached', 'cold cache', 'one change'))
+    for n in sizes:
+        kdb = synthetic_kdb(n, n_groups)
+        t_full = timed(b''.join, kdb.serialize())[0]
+        kdb.enable_fragment_cache()
+        t_cold = timed(b''.join, kdb.serialize())[0]
+        entry = kdb.obj_root.findall('.//Entry')[n // 2]
+        entry.find("String[Key='Title']").Value._setText('Changed')
+        kdb.invalidate(entry)
+        t_warm = timed(b''.join, kdb.serialize())[0]
+        print('{:>8} {:>11.3f}s {:>11.3f}s {:>11.3f}s'.format(
+            n, t_full, t_cold, t_warm))
+        kdb.close()
+
+
+def legacy_read_header(stream):
+    "The per field KDB4 header parsing libkeepass used."
+    from libkeepass.common import HeaderDictionary, stream_unpack
+
+    class Header(HeaderDictionary):
+        fields = libkeepass.kdb4.KDB4Header.fields
+        fmt = libkeepass.kdb4.KDB4Header.fmt
+
+    header = Header()
+    stream_unpack(stream, 0, 4)
+    stream_unpack(stream, None, 4)
+    stream_unpack(stream, None, 4)
+    while True:
+        field_id = stream_unpack(stream, None, 1, 'b')
+        length = stream_unpack(stream, None, 2, 'H')
+        if length > 0:
+            header.b[field_id] = stream_unpack(stream, None, length,
+                                               '{}s'.format(length))
+        if field_id == 0:
+            return header
+
+
+@benchmark
+def header_parse(n=20000):
+    """Time per parsed header of 20k KDB4 and KDB3 headers"""
+    print('{:>24} {:>12} {:>12}'.format('file', 'per field', 'compiled'))
+    for name in ('sample1.kdbx', 'sample3.kdbx', 'sample7_kpx.kdb'):
+        with io.open(get_datafile(name), 'rb') as f:
+            stream = io.BytesIO(f.read())
+        signature = libkeepass.common.read_signature(
+            libkeepass.common.HeaderBuffer(stream))
+        reader = libkeepass.get_kdb_reader(signature)
+        legacy = '-'
+        if reader is libkeepass.kdb4.KDB4Reader:
+            t_legacy = timed(lambda: [legacy_read_header(stream)
+                                      for _ in range(n)])[0]
+            legacy = '{:.1f}us'.format(t_legacy / n * 1e6)
+        kdb = reader()
+        t_compiled = timed(lambda: [kdb._read_header(
+                                        libkeepass.common.HeaderBuffer(stream))
+                                    for _ in range(n)])[0]
+        print('{:>24} {:>12} {:>10.1f}us'.format(
+            name, legacy, t_compiled / n * 1e6))
+
+
+@benchmark
+def argon2(settings=((2, 1024, 1), (2, 1024, 4), (2, 16384, 4))):
+    """Argon2d time of the available backends"""
+    from libkeepass.kdf import BACKENDS, argon2_hash
+    print('{:>20} '.format('t, KiB, lanes') +
+          ' '.join('{:>12}'.format(name) for name in BACKENDS))
+    for time_cost, memory_kib, lanes in settings:
+        results = []
+        for backend in BACKENDS:
+            if backend == 'python' and memory_kib > 1024:
+                results.append('-')
+                continue
+            results.append('{:.3f}s'.format(timed(
+                argon2_hash, b'password', b'saltsalt', time_cost, memory_kib,
+                lanes, backend=backend)[0]))
+        print('{:>20} '.format('{}, {}, {}'.format(time_cost, memory_kib, lanes)) +
+              ' '.join('{:>12}'.format(r) for r in results))
+
+
+def legacy_date(buf, pos, size):
+    import struct
+    b = struct.unpack('<5B', buf[pos:pos+size])
+    return datetime.datetime(
+        (b[0] << 6) | (b[1] >> 2), ((b[1] & 0b11) << 2) | (b[2] >> 6),
+        ((b[2] & 0b111111) >> 1), ((b[2] & 0b1) << 4) | (b[3] >> 4),
+        ((b[3] & 0b1111) << 2) | (b[4] >> 6), (b[4] & 0b111111))
+
+
+def legacy_parse_body(in_buffer, n_groups, n_entries):
+    "The field loops of the slicing KDB3 body parser libkeepass used."
+    import struct
+    from binascii import b2a_hex
+    from libkeepass.kdb3 import parse_null_turminated as text
+    buf = in_buffer.getbuffer().tobytes()
+    pos = 0
+    group = {}
+    while n_groups:
+        m_type = struct.unpack("<H", buf[pos:pos+2])[0]
+        pos += 2
+        size = struct.unpack("<L", buf[pos:pos+4])[0]
+        pos += 4
+        if m_type == 1:
+            group['group_id'] = struct.unpack("<L", buf[pos:pos+4])[0]
+        elif m_type == 2:
+            group['title'] = text(buf[pos:pos+size])
+        elif m_type == 3:
+            group['created'] = legacy_date(buf, pos, size)
+        elif m_type == 4:
+            group['modified'] = legacy_date(buf, pos, size)
+        elif m_type == 5:
+            group['accessed'] = legacy_date(buf, pos, size)
+        elif m_type == 6:
+            group['expires'] = legacy_date(buf, pos, size)
+        elif m_type == 7:
+            group['icon'] = struct.unpack("<L", buf[pos:pos+4])[0]
+        elif m_type == 8:
+            group['level'] = struct.unpack("<H", buf[pos:pos+2])[0]
+        elif m_type == 0xFFFF:
+            n_groups -= 1
+            group = {}
+        pos += size
+    buf = in_buffer.getbuffer().tobytes()
+    entry = {}
+    while n_entries:
+        m_type = struct.unpack("<H", buf[pos:pos+2])[0]
+        pos += 2
+        size = struct.unpack("<L", buf[pos:pos+4])[0]
+        pos += 4
+        if m_type == 1:
+            entry['id'] = text(b2a_hex(buf[pos:pos+size]))
+        elif m_type == 2:
+            entry['group_id'] = struct.unpack('<L', buf[pos:pos+4])[0]
+        elif m_type == 3:
+            entry['icon'] = struct.unpack('<L', buf[pos:pos+4])[0]
+        elif m_type == 4:
+            entry['title'] = text(buf[pos:pos+size])
+        elif m_type == 5:
+            entry['url'] = text(buf[pos:pos+size])
+        elif m_type == 6:
+            entry['username'] = text(buf[pos:pos+size])
+        elif m_type == 7:
+            entry['password'] = text(buf[pos:pos+size])
+        elif m_type == 8:
+            entry['notes'] = text(buf[pos:pos+size])
+        elif m_type == 9:
+            entry['created'] = legacy_date(buf, pos, size)
+        elif m_type == 0xA:
+            entry['modified'] = legacy_date(buf, pos, size)
+        elif m_type == 0xB:
+            entry['accessed'] = legacy_date(buf, pos, size)
+        elif m_type == 0xC:
+            entry['expires'] = legacy_date(buf, pos, size)
+        elif m_type == 0xD:
+            entry['bin_desc'] = text(buf[pos:pos+size])
+        elif m_type == 0xE:
+            entry['binary'] = buf[pos:pos+size]
+        elif m_type == 0xFFFF:
+            n_entries -= 1
+            entry = {}
+        pos += size
+
+
+def parse_body(in_buffer, n_groups, n_entries):
+    "Decode the records of a KDB3 body with the field tables."
+    from libkeepass.kdb3 import iter_records, KDB3Group, KDB3Entry
+    with in_buffer.getbuffer() as buf:
+        pos = 0
+        for group, pos in iter_records(buf, pos, n_groups, KDB3Group,
+                                       'Group'):
+            pass
+        for entry, pos in iter_records(buf, pos, n_entries, KDB3Entry,
+                                       'Entry'):
+            pass
+
+
+@benchmark
+def kdb3_parse(sizes=(1000, 10000, 100000)):
+    """Decoding of KDB3 bodies, slicing per field and table driven"""
+    from tests.tests import kdb3_records, kdb3_body
+    print('{:>8} {:>12} {:>12}'.format('entries', 'slicing', 'table'))
+    for n in sizes:
+        groups, entries = kdb3_records(n, max(n // 100, 1))
+        body = io.BytesIO(kdb3_body(groups, entries))
+        t_legacy = min(timed(legacy_parse_body, body, len(groups), n)[0]
+                       for _ in range(3))
+        t_table = min(timed(parse_body, body, len(groups), n)[0]
+                      for _ in range(3))
+        print('{:>8} {:>11.3f}s {:>11.3f}s'.format(n, t_legacy, t_table))
+
+
+@benchmark
+def kdb3_scaling(sizes=((5000, 500), (10000, 1000), (20000, 2000),
+                        (40000, 4000))):
+    """Load and pretty print time of KDB3 files as entries and groups grow"""
+    from tests.tests import kdb3_records, make_kdb3
+    print('{:>8} {:>8} {:>12} {:>12} {:>12}'.format(
+        'entries', 'groups', 'load', 'print', 'per entry'))
+    for n_entries, n_groups in sizes:
+        data = make_kdb3(*kdb3_records(n_entries, n_groups, depth=8),
+                         password='asdf', rounds=1)
+        t_load, kdb = timed(libkeepass.open_stream, io.BytesIO(data),
+                            password='asdf')
+        t_print = timed(kdb.pretty_print)[0]
+        print('{:>8} {:>8} {:>11.3f}s {:>11.3f}s {:>10.1f}us'.format(
+            n_entries, n_groups, t_load, t_print,
+            (t_load + t_print) / n_entries * 1e6))
+        kdb.close()
+
+
+@benchmark
+def kdb3_iter(sizes=(10000, 50000)):
+    """Peak memory of exporting KDB3 entries from a list and streamed"""
+    from tests.tests import kdb3_records, make_kdb3
+
+    def export(entries):
+        out = NullWriter()
+        for entry in entries:
+            out.write(u'{title}\t{username}\t{url}\n'.format(
+                **entry).encode('utf-8'))
+
+    print('{:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'entries', 'list', 'peak', 'streamed', 'peak'))
+    for n in sizes:
+        data = make_kdb3(*kdb3_records(n, n // 100), password='asdf',
+                         rounds=1)
+        results = []
+        for streamed in (False, True):
+            kdb = libkeepass.open_stream(io.BytesIO(data), password='asdf')
+            results.extend(peak_memory(
+                lambda: export(kdb.iter_entries() if streamed
+                               else kdb.entries)))
+            kdb.close()
+        print('{:>8} {:>11.3f}s {:>11.1f}M {:>11.3f}s {:>11.1f}M'.format(
+            n, results[0], results[1] / 1e6, results[2], results[3] / 1e6))
+
+
+@benchmark
+def kdb3_memory(sizes=(10000, 100000)):
+    """Memory of the KDB3 entries as dicts and as slotted records"""
+    from tests.tests import kdb3_records, make_kdb3
+
+    def allocated(func):
+        tracemalloc.start()
+        try:
+            result = func()
+            return result, tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    print('{:>8} {:>12} {:>12}'.format('entries', 'dicts', 'records'))
+    for n in sizes:
+        data = make_kdb3(*kdb3_records(n, n // 100), password='asdf',
+                         rounds=1)
+        kdb = libkeepass.open_stream(io.BytesIO(data), password='asdf')
+        dicts, dict_size = allocated(
+            lambda: [entry.copy() for entry in kdb.iter_entries()])
+        del dicts
+        records, record_size = allocated(lambda: kdb.entries)
+        print('{:>8} {:>11.1f}M {:>11.1f}M'.format(
+            n, dict_size / 1e6, record_size / 1e6))
+        kdb.close()
+
+
+def legacy_pretty_print(kdb):
+    "The template based KDB3 pretty_print libkeepass used."
+    from xml.sax.saxutils import escape
+    from lxml import etree
+    pwentries = []
+    for entry in kdb.entries:
+        entry = entry.copy()
+        for field in ('title', 'username', 'url', 'password', 'notes'):
+            entry[field] = escape(entry[field])
+        entry['group'] = escape(entry['group'])
+        entry['grp_tree_attr'] = ''
+        if 'groups' in kdb.groups_by_id[entry['group_id']]:
+            parent_group_id = kdb.groups_by_id[entry['group_id']]['groups']
+            entry['grp_tree_attr'] = ' tree="{}"'.format(
+                escape(kdb._get_group_path(parent_group_id)))
+        entry['expire_valid'] = (
+            entry['expires'] != datetime.datetime(2999, 12, 28, 23, 59, 59))
+        pwentries.append(u"""\
+<pwentry>
+        <group{grp_tree_attr}>{group}</group>
+        <title>{title}</title>
+        <username>{username}</username>
+        <url>{url}</url>
+        <password>{password}</password>
+        <notes>{notes}</notes>
+        <uuid>{id}</uuid>
+        <image>{icon}</image>
+        <creationtime>{created:%Y-%m-%dT%H:%M:%S}</creationtime>
+        <lastmodtime>{modified:%Y-%m-%dT%H:%M:%S}</lastmodtime>
+        <lastaccesstime>{accessed:%Y-%m-%dT%H:%M:%S}</lastaccesstime>
+        <expiretime expires="{expire_valid}">{expires:%Y-%m-%dT%H:%M:%S}</expiretime>
+</pwentry>""".format(**entry))
+    root = etree.fromstring(u"""\
+<pwlist>
+{pwentries}
+</pwlist>""".format(pwentries='\n'.join(pwentries)))
+    return etree.tostring(root, pretty_print=True, encoding='utf-8',
+                          standalone=True)
+
+
+@benchmark
+def kdb3_xml(sizes=(10000, 50000)):
+    """Time and peak memory of KDB3 XML exports, template based and streamed"""
+    from tests.tests import kdb3_records, make_kdb3
+    print('{:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'entries', 'template', 'peak', 'streamed', 'peak'))
+    for n in sizes:
+        data = make_kdb3(*kdb3_records(n, n // 100), password='asdf',
+                         rounds=1)
+        results = []
+        for export in (lambda kdb: NullWriter().write(legacy_pretty_print(kdb)),
+                       lambda kdb: kdb.write_xml(NullWriter())):
+            kdb = libkeepass.open_stream(io.BytesIO(data), password='asdf')
+            results.extend(peak_memory(export, kdb))
+            kdb.close()
+        print('{:>8} {:>11.3f}s {:>11.1f}M {:>11.3f}s {:>11.1f}M'.format(
+            n, results[0], results[1] / 1e6, results[2], results[3] / 1e6))
+
+
+@benchmark
+def convert_scaling(sizes=((10000, 1000), (25000, 2500), (50000, 5000),
+                           (100000, 10000))):
+    """KDB3 to KDBX conversion time, tree and streamed, as the files grow"""
+    from tests.tests import kdb3_records, make_kdb3
+    from libkeepass.utils.convert import convert_kdb3_to_kxml4, \
+        write_kdb3_as_kdb4
+    print('{:>8} {:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'entries', 'groups', 'convert', 'per entry', 'streamed', 'per entry'))
+    for n_entries, n_groups in sizes:
+        data = make_kdb3(*kdb3_records(n_entries, n_groups, depth=8),
+                         password='asdf', rounds=1)
+        kdb = libkeepass.open_stream(io.BytesIO(data), password='asdf')
+        t_convert = timed(convert_kdb3_to_kxml4, kdb)[0]
+        t_stream = timed(write_kdb3_as_kdb4, kdb, io.BytesIO())[0]
+        print('{:>8} {:>8} {:>11.3f}s {:>10.1f}us {:>11.3f}s {:>10.1f}us'.format(
+            n_entries, n_groups, t_convert, t_convert / n_entries * 1e6,
+            t_stream, t_stream / n_entries * 1e6))
+        kdb.close()
+
+
+@benchmark
+def convert_memory(sizes=(10000, 50000)):
+    """Time and peak memory of KDB3 to KDBX conversions, tree and streamed"""
+    from tests.tests import kdb3_records, make_kdb3
+    from libkeepass.utils.convert import convert_kdb3_to_kdb4, \
+        write_kdb3_as_kdb4
+    print('{:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'entries', 'tree', 'peak', 'streamed', 'peak'))
+    for n in sizes:
+        data = make_kdb3(*kdb3_records(n, n // 100), password='asdf',
+                         rounds=1)
+        results = []
+        for convert in (lambda kdb: convert_kdb3_to_kdb4(kdb).write_to(NullWriter()),
+                        lambda kdb: write_kdb3_as_kdb4(kdb, NullWriter())):
+            kdb = libkeepass.open_stream(io.BytesIO(data), password='asdf')
+            results.extend(peak_memory(convert, kdb))
+            kdb.close()
+        print('{:>8} {:>11.3f}s {:>11.1f}M {:>11.3f}s {:>11.1f}M'.format(
+            n, results[0], results[1] / 1e6, results[2], results[3] / 1e6))
+
+
+def legacy_insert(kdb, group, records):
+    "Add entries one at a time, parsing the XML of each and reindexing it."
+    from lxml import objectify
+    from libkeepass.utils.bulk import BulkInserter
+    inserter = BulkInserter(kdb.obj_root)
+    for record in records:
+        entry = objectify.fromstring(inserter._entry(new_uuid(), record)[0],
+                                     libkeepass.kdb4.XML_PARSER)
+        group.append(entry)
+        kdb.invalidate(entry)
+
+
+@benchmark
+def bulk_insert(sizes=(10000, 30000)):
+    """Adding entries one at a time and with bulk_insert, index kept"""
+    print('{:>8} {:>12} {:>12}'.format('entries', 'one by one', 'bulk'))
+    for n in sizes:
+        records = [{'Title': 'host{}'.format(i), 'UserName': 'admin',
+                    'Password': 'pw{}'.format(i),
+                    'URL': 'ssh://host{}.example.com'.format(i)}
+                   for i in range(n)]
+        results = []
+        for bulk in (False, True):
+            kdb = libkeepass.open(get_datafile('sample1.kdbx'),
+                                  password='asdf')
+            kdb.entry_index
+            if bulk:
+                results.append(timed(kdb.bulk_insert, '/sample1/Import',
+                                     records)[0])
+            else:
+                group = kdb.obj_root.find('Root/Group')
+                results.append(timed(legacy_insert, kdb, group, records)[0])
+            assert kdb.query(Title='host7').count() == 1
+            kdb.close()
+        print('{:>8} {:>11.3f}s {:>11.3f}s'.format(n, *results))
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        func = BENCHMARKS[name]
+        print('# {}: {}'.format(name, func.__doc__))
+        func()
+        print()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Writes the KDBX 4 sample files sample10_kdbx4_aeskdf.kdbx and
+sample11_kdbx4_argon2.kdbx (password 'asdf').
+
+KeePass and KeePassXC were not available where they were created, so they
+are written here from the format as KeePass 2.35+ writes it (KdbxFile.Write),
+without the header, block, XML or protection code of libkeepass. Only the
+Argon2 hash is taken from libkeepass.kdf, it is checked against the RFC 9106
+test vectors. Times are base64 encoded seconds since 0001-01-01 like KeePass
+writes them in v4 files.
+
+Run from the project directory: python -m tests.data.kdbx4_fixtures
+"""
+
+import os
+import gzip
+import hmac
+import struct
+import base64
+import hashlib
+import datetime
+
+from Crypto.Cipher import AES, ChaCha20
+from Crypto.Util.Padding import pad
+
+from libkeepass.kdf import argon2_hash, ARGON2D
+
+PASSWORD = b'asdf'
+
+AES_CIPHER = bytes.fromhex('31c1f2e6bf714350be5805216afc5aff')
+CHACHA20_CIPHER = bytes.fromhex('d6038a2b8b6f4cb5a524339a31dbb59a')
+AES_KDF = bytes.fromhex('c9d9f39a628a4460bf740d08c18a4fea')
+ARGON2D_KDF = bytes.fromhex('ef636ddf8c29444b91f7a9a403e30a0c')
+
+# VariantDictionary value types
+UINT32, UINT64, BYTES = 0x04, 0x05, 0x42
+
+XML = u"""<?xml version="1.0" encoding="utf-8" standalone="yes"?>
+<KeePassFile>
+\t<Meta>
+\t\t<Generator>KeePass</Generator>
+\t\t<DatabaseName>{name}</DatabaseName>
+\t\t<DatabaseNameChanged>{time}</DatabaseNameChanged>
+\t\t<MemoryProtection>
+\t\t\t<ProtectTitle>False</ProtectTitle>
+\t\t\t<ProtectUserName>False</ProtectUserName>
+\t\t\t<ProtectPassword>True</ProtectPassword>
+\t\t\t<ProtectURL>False</ProtectURL>
+\t\t\t<ProtectNotes>False</ProtectNotes>
+\t\t</MemoryProtection>
+\t\t<RecycleBinEnabled>True</RecycleBinEnabled>
+\t\t<RecycleBinUUID>AAAAAAAAAAAAAAAAAAAAAA==</RecycleBinUUID>
+\t</Meta>
+\t<Root>
+\t\t<Group>
+\t\t\t<UUID>{group_uuid}</UUID>
+\t\t\t<Name>{name}</Name>
+\t\t\t<Notes />
+\t\t\t<IconID>49</IconID>
+\t\t\t<Times>
+\t\t\t\t<CreationTime>{time}</CreationTime>
+\t\t\t\t<LastModificationTime>{time}</LastModificationTime>
+\t\t\t\t<LastAccessTime>{time}</LastAccessTime>
+\t\t\t\t<ExpiryTime>{time}</ExpiryTime>
+\t\t\t\t<Expires>False</Expires>
+\t\t\t\t<UsageCount>0</UsageCount>
+\t\t\t\t<LocationChanged>{time}</LocationChanged>
+\t\t\t</Times>
+\t\t\t<IsExpanded>True</IsExpanded>
+\t\t\t<Entry>
+\t\t\t\t<UUID>{entry_uuid}</UUID>
+\t\t\t\t<IconID>0</IconID>
+\t\t\t\t<Times>
+\t\t\t\t\t<CreationTime>{time}</CreationTime>
+\t\t\t\t\t<LastModificationTime>{time}</LastModificationTime>
+\t\t\t\t\t<LastAccessTime>{time}</LastAccessTime>
+\t\t\t\t\t<ExpiryTime>{time}</ExpiryTime>
+\t\t\t\t\t<Expires>True</Expires>
+\t\t\t\t\t<UsageCount>0</UsageCount>
+\t\t\t\t\t<LocationChanged>{time}</LocationChanged>
+\t\t\t\t</Times>
+\t\t\t\t<String>
+\t\t\t\t\t<Key>Notes</Key>
+\t\t\t\t\t<Value>nötes</Value>
+\t\t\t\t</String>
+\t\t\t\t<String>
+\t\t\t\t\t<Key>Password</Key>
+\t\t\t\t\t<Value Protected="True">{password}</Value>
+\t\t\t\t</String>
+\t\t\t\t<String>
+\t\t\t\t\t<Key>Title</Key>
+\t\t\t\t\t<Value>Sample Entry</Value>
+\t\t\t\t</String>
+\t\t\t\t<String>
+\t\t\t\t\t<Key>URL</Key>
+\t\t\t\t\t<Value>https://keepass.info/</Value>
+\t\t\t\t</String>
+\t\t\t\t<String>
+\t\t\t\t\t<Key>UserName</Key>
+\t\t\t\t\t<Value>User Name</Value>
+\t\t\t\t</String>
+\t\t\t\t<String>
+\t\t\t\t\t<Key>PIN</Key>
+\t\t\t\t\t<Value Protected="True">{pin}</Value>
+\t\t\t\t</String>
+\t\t\t\t<Binary>
+\t\t\t\t\t<Key>attached.txt</Key>
+\t\t\t\t\t<Value Ref="0" />
+\t\t\t\t</Binary>
+\t\t\t\t<History />
+\t\t\t</Entry>
+\t\t</Group>
+\t\t<DeletedObjects />
+\t</Root>
+</KeePassFile>"""
+
+
+def variant_dictionary(items):
+    data = struct.pack('<H', 0x0100)
+    for type, name, value in items:
+        if type == UINT32:
+            value = struct.pack('<I', value)
+        elif type == UINT64:
+            value = struct.pack('<Q', value)
+        name = name.encode('utf-8')
+        data += struct.pack('<BI', type, len(name)) + name + \
+            struct.pack('<I', len(value)) + value
+    return data + b'\x00'
+
+
+def kdbx4_time(dt):
+    seconds = int((dt - datetime.datetime(1, 1, 1)).total_seconds())
+    return base64.b64encode(struct.pack('<q', seconds)).decode('ascii')
+
+
+def block_key(base, index):
+    return hashlib.sha512(struct.pack('<Q', index) + base).digest()
+
+
+def write(path, cipher, kdf):
+    composite = hashlib.sha256(hashlib.sha256(PASSWORD).digest()).digest()
+    master_seed = os.urandom(32)
+    seed = os.urandom(32)
+    if kdf == 'aes':
+        rounds = 6000
+        params = [(BYTES, '$UUID', AES_KDF), (UINT64, 'R', rounds),
+                  (BYTES, 'S', seed)]
+        ecb = AES.new(seed, AES.MODE_ECB)
+        key = composite
+        for _ in range(rounds):
+            key = ecb.encrypt(key)
+        transformed = hashlib.sha256(key).digest()
+    else:
+        iterations, memory, lanes = 2, 1024 * 1024, 2
+        params = [(BYTES, '$UUID', ARGON2D_KDF), (BYTES, 'S', seed),
+                  (UINT32, 'P', lanes), (UINT64, 'M', memory),
+                  (UINT64, 'I', iterations), (UINT32, 'V', 0x13)]
+        transformed = argon2_hash(composite, seed, iterations,
+                                  memory // 1024, lanes, 32, ARGON2D)
+    iv = os.urandom(16 if cipher == AES_CIPHER else 12)
+
+    fields = [(2, cipher), (3, struct.pack('<I', 1)), (4, master_seed),
+              (7, iv), (11, variant_dictionary(params)), (0, b'\r\n\r\n')]
+    header = struct.pack('<III', 0x9AA2D903, 0xB54BFB67, 0x00040000)
+    for field_id, data in fields:
+        header += struct.pack('<BI', field_id, len(data)) + data
+
+    master_key = hashlib.sha256(master_seed + transformed).digest()
+    hmac_base = hashlib.sha512(master_seed + transformed + b'\x01').digest()
+
+    # inner header: ChaCha20 inner stream and one protected attachment
+    stream_key = os.urandom(64)
+    inner = b''
+    for field_id, data in ((1, struct.pack('<I', 3)), (2, stream_key),
+                           (3, b'\x01attached file\n'), (0, b'')):
+        inner += struct.pack('<BI', field_id, len(data)) + data
+    digest = hashlib.sha512(stream_key).digest()
+    inner_stream = ChaCha20.new(key=digest[:32], nonce=digest[32:44])
+
+    def protect(text):
+        data = text.encode('utf-8')
+        return base64.b64encode(bytes(
+            a ^ b for a, b in zip(data, inner_stream.encrypt(
+                b'\x00' * len(data))))).decode('ascii')
+
+    time = kdbx4_time(datetime.datetime(2018, 5, 12, 10, 30, 0))
+    xml = XML.format(name=os.path.splitext(os.path.basename(path))[0],
+                     time=time,
+                     group_uuid=base64.b64encode(os.urandom(16)).decode(),
+                     entry_uuid=base64.b64encode(os.urandom(16)).decode(),
+                     password=protect(u'pässword'),
+                     pin=protect(u'1234'))
+    payload = gzip.compress(inner + xml.encode('utf-8'))
+    if cipher == AES_CIPHER:
+        payload = AES.new(master_key, AES.MODE_CBC, iv).encrypt(
+            pad(payload, 16))
+    else:
+        payload = ChaCha20.new(key=master_key, nonce=iv).encrypt(payload)
+
+    out = header + hashlib.sha256(header).digest() + hmac.new(
+        block_key(hmac_base, 0xFFFFFFFFFFFFFFFF), header,
+        hashlib.sha256).digest()
+    # small blocks, so the file has several
+    size = 256
+    chunks = [payload[i:i + size] for i in range(0, len(payload), size)]
+    for index, chunk in enumerate(chunks + [b'']):
+        head = struct.pack('<QI', index, len(chunk))
+        out += hmac.new(block_key(hmac_base, index), head + chunk,
+                        hashlib.sha256).digest() + head[8:] + chunk
+    with open(path, 'wb') as f:
+        f.write(out)
+
+
+if __name__ == '__main__':
+    directory = os.path.dirname(os.path.abspath(__file__))
+    write(os.path.join(directory, 'sample10_kdbx4_aeskdf.kdbx'),
+          AES_CIPHER, 'aes')
+    write(os.path.join(directory, 'sample11_kdbx4_argon2.kdbx'),
+          CHACHA20_CIPHER, 'argon2')
@@ -1,7 +1,18 @@
 # -*- coding: utf-8 -*-
+import io
 import os
 import sys
+import copy
+import gzip
+import pickle
+import hmac
+import shutil
+import struct
+import base64
+import hashlib
+import binascii
 import datetime
+import tempfile
 import unittest
 import warnings
 
@@ -10,12 +21,23 @@ import libkeepass
 import libkeepass.common
 import libkeepass.kdb4
 import libkeepass.kdb3
+import libkeepass.kdf
 
 
 from libkeepass.crypto import sha256, transform_key, xor, pad
 from libkeepass.crypto import aes_cbc_decrypt, twofish_cbc_decrypt, twofish_cbc_encrypt
 from libkeepass.crypto import AES_BLOCK_SIZE
-from libkeepass.crypto import Salsa20
+from libkeepass.crypto import Salsa20, KeyStream, salsa20_block
+from libkeepass.crypto import CipherWriter, aes_cbc_cipher, aes_cbc_encrypt
+from libkeepass.crypto import CipherReader, chacha20_cipher, chacha20_block
+from libkeepass.crypto import sha512, twofish_cbc_cipher
+from libkeepass.hbio import HashedBlockIO, HashedBlockWriter
+from libkeepass.hbio import HmacBlockIO, HmacBlockWriter, hmac_block_key
+from libkeepass.kdf import argon2_hash, ARGON2D, ARGON2I, ARGON2ID
+from libkeepass.kdf import BACKENDS, MemoryBudget
+from libkeepass.utils.save import AsyncSaver, save_atomic
+
+from lxml import etree
 
 from . import get_datafile
 
@@ -60,6 +82,108 @@ class TextCrypto(unittest.TestCase):
                          b"?\xd2=]\x96\x13\x04\\\x05k\x08\xe8\xf3X\x9a\xb4\xe7"
                          b"\xc6\xdb\x88\t\x94u\xee\x04\xd2\xc2\x00\xc8")
 
+    def test_keystream(self):
+        KDB4_SALSA20_IV = bytes(bytearray.fromhex('e830094b97205d2a'))
+        salsa = Salsa20.new(b'keysmustbe16byte', KDB4_SALSA20_IV)
+        expected = salsa.encrypt(bytearray(200))
+
+        calls = []
+        def new_cipher():
+            cipher = Salsa20.new(b'keysmustbe16byte', KDB4_SALSA20_IV)
+            class Counting(object):
+                def encrypt(self, data):
+                    calls.append(len(data))
+                    return cipher.encrypt(data)
+            return Counting()
+
+        ks = KeyStream(new_cipher)
+        ks.reserve(150)
+        self.assertEqual(calls, [KeyStream.CHUNK_SIZE])
+        self.assertEqual(ks.read(3), expected[:3])
+        self.assertEqual(ks.read(130), expected[3:133])
+        self.assertEqual(ks.get(64, 10), expected[64:74])
+        ks.rewind()
+        self.assertEqual(ks.read(200), expected)
+        self.assertEqual(len(calls), 1)
+        # reading past the reserved keystream continues the cipher stream
+        ks.get(KeyStream.CHUNK_SIZE, 1)
+        self.assertEqual(calls, [KeyStream.CHUNK_SIZE] * 2)
+
+    def test_stream_writers(self):
+        data = os.urandom(3 * CipherWriter.CHUNK_SIZE + 5)
+        key, iv = os.urandom(32), os.urandom(16)
+        out = io.BytesIO()
+        writer = CipherWriter(out, aes_cbc_cipher(key, iv))
+        for i in range(0, len(data), 1000):
+            writer.write(data[i:i + 1000])
+        writer.close()
+        self.assertEqual(out.getvalue(), aes_cbc_encrypt(pad(data), key, iv))
+
+        expected = io.BytesIO()
+        hb = HashedBlockIO()
+        hb.write(data)
+        hb.write_block_stream(expected, block_length=4096)
+        out = io.BytesIO()
+        writer = HashedBlockWriter(out, block_length=4096)
+        writer.write(data[:10])
+        writer.write(data[10:])
+        writer.close()
+        self.assertEqual(out.getvalue(), expected.getvalue())
+        self.assertEqual(HashedBlockIO(initial_bytes=out.getvalue()).read(), data)
+
+    def test_stream_readers(self):
+        data = os.urandom(3 * CipherReader.CHUNK_SIZE + 5)
+        key, iv = os.urandom(32), os.urandom(16)
+        encrypted = io.BytesIO(aes_cbc_encrypt(pad(data), key, iv))
+        reader = CipherReader(encrypted, aes_cbc_cipher(key, iv))
+        self.assertEqual(reader.read(), data)
+        encrypted = chacha20_cipher(key, iv[:12]).encrypt(data)
+        reader = CipherReader(io.BytesIO(encrypted),
+                              chacha20_cipher(key, iv[:12]), padded=False)
+        self.assertEqual(reader.read(), data)
+        self.assertEqual(chacha20_block(key, iv[:12], 2),
+                         chacha20_cipher(key, iv[:12]).encrypt(bytes(bytearray(192)))[128:])
+
+        key = sha512(b'secret')
+        out = io.BytesIO()
+        writer = HmacBlockWriter(out, key, block_length=4096)
+        writer.write(data)
+        writer.close()
+        for workers in (1, 3):
+            blocks = HmacBlockIO(io.BytesIO(out.getvalue()), key, workers)
+            self.assertEqual(blocks.read(10), data[:10])
+            self.assertEqual(blocks.read(), data[10:])
+            blocks.close()
+
+        # blocks are verified when they are reached
+        tampered = bytearray(out.getvalue())
+        tampered[5 * (4096 + 36) + 100] ^= 1
+        blocks = io.BufferedReader(
+            HmacBlockIO(io.BytesIO(bytes(tampered)), key, workers=3))
+        self.assertEqual(blocks.read(5 * 4096), data[:5 * 4096])
+        with assertRaisesRegex(self, IOError, "Block HMAC mismatch error."):
+            blocks.read()
+        # the key depends on the block index, blocks cannot be reordered
+        swapped = out.getvalue()
+        swapped = swapped[4132:8264] + swapped[:4132] + swapped[8264:]
+        with assertRaisesRegex(self, IOError, "Block HMAC mismatch error."):
+            HmacBlockIO(io.BytesIO(swapped), key).read()
+        with assertRaisesRegex(self, IOError, "Unexpected end of block stream."):
+            HmacBlockIO(io.BytesIO(out.getvalue()[:-10]), key).read()
+        self.assertNotEqual(hmac_block_key(key, 0), hmac_block_key(key, 1))
+
+    def test_keystream_seek(self):
+        key = sha256(b'secret')
+        iv = bytes(bytearray.fromhex('e830094b97205d2a'))
+        expected = Salsa20.new(key, iv).encrypt(bytearray(256))
+        self.assertEqual(salsa20_block(key, iv, 2), expected[128:192])
+        ks = KeyStream(lambda: Salsa20.new(key, iv),
+                       lambda counter: salsa20_block(key, iv, counter))
+        # seeks without generating the keystream before
+        self.assertEqual(ks.get(100, 100), expected[100:200])
+        self.assertEqual(len(ks), 0)
+        self.assertEqual(ks.read(256), expected)
+
     def test_aes_cbc_decrypt(self):
         self.assertEqual(aes_cbc_decrypt(b'datamustbe16byte', sha256(b'b'),
                                           b'ivmustbe16bytesl'),
@@ -125,6 +249,21 @@ class TestModule(unittest.TestCase):
         with assertRaisesRegex(self, IOError, "Unknown base signature."):
             libkeepass.get_kdb_reader([0x9AA2D900, 0xB54BFB60, 3, 0])
 
+    def test_open_stream_reads_header_once(self):
+        class Stream(io.BytesIO):
+            def read(self, n=-1):
+                reads.append(self.tell())
+                return io.BytesIO.read(self, n)
+
+        for path, password in ((absfile1, 'asdf'), (absfile2, 'asdf')):
+            reads = []
+            with io.open(path, 'rb') as f:
+                stream = Stream(f.read())
+            with libkeepass.open_stream(stream, password=password) as kdb:
+                self.assertTrue(kdb.opened)
+            # the signature and header are parsed from one read at 0
+            self.assertEqual(reads.count(0), 1, path)
+
 
 class TestCommon(unittest.TestCase):
     def test_header_dict(self):
@@ -214,6 +353,45 @@ class TestCommon(unittest.TestCase):
         self.assertEqual(h.b.hash, b'\x91.\xc8\x03\xb2\xceI\xe4\xa5A\x06\x8dIZ')
         # assert False
 
+    def test_header_record(self):
+        h = libkeepass.kdb4.KDB4Header()
+        self.assertFalse(hasattr(h, '__dict__'))
+        self.assertRaises(AttributeError, lambda: h.TransformRounds)
+        self.assertNotIn('TransformRounds', h)
+        h.TransformRounds = 6000
+        self.assertEqual(h[6], 6000)
+        self.assertEqual(h.b.TransformRounds, b'\x70\x17\x00\x00\x00\x00\x00\x00')
+        h.b[6] = b'\x71\x17\x00\x00\x00\x00\x00\x00'
+        self.assertEqual(h['TransformRounds'], 6001)
+        h.b.MasterSeed = b'seed'
+        self.assertEqual(h.MasterSeed, b'seed')
+        self.assertEqual(sorted(h.keys()), [4, 6])
+        self.assertRaises(KeyError, lambda: h['Unknown'])
+
+        copied = libkeepass.kdb4.KDB4Header(h)
+        self.assertEqual(copied, h)
+        copied.MasterSeed = b'other'
+        self.assertNotEqual(copied, h)
+        self.assertEqual(h.MasterSeed, b'seed')
+
+    def test_header_record_copy(self):
+        h = libkeepass.kdb4.KDB4Header()
+        h.TransformRounds = 6000
+        h.MasterSeed = b'seed'
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(h, protocol))
+            self.assertEqual(loaded, h)
+            self.assertEqual(loaded.TransformRounds, 6000)
+        copied = copy.deepcopy(h)
+        self.assertEqual(copied, h)
+        copied.MasterSeed = b'other'
+        self.assertEqual(h.MasterSeed, b'seed')
+        self.assertEqual(copy.copy(h), h)
+        with libkeepass.open(absfile2, password='asdf') as kdb:
+            self.assertEqual(pickle.loads(pickle.dumps(kdb.header)),
+                             kdb.header)
+            self.assertEqual(copy.deepcopy(kdb.header), kdb.header)
+
 # created with KeePassX 0.4.3
 absfile2 = get_datafile('sample7_kpx.kdb')
 # created with KeePass 2.19 on linux
@@ -231,6 +409,9 @@ absfile7 = get_datafile('sample9_chacha20.kdbx')
 # db with 64 byte hex key
 absfile8 = get_datafile('sample_hex.kdbx')
 keyfile8 = get_datafile('sample_hex.key')
+# KDBX 4 files, AES-KDF and AES, Argon2d and ChaCha20
+absfile9 = get_datafile('sample10_kdbx4_aeskdf.kdbx')
+absfile10 = get_datafile('sample11_kdbx4_argon2.kdbx')
 
 output1 = get_datafile('output1.kdbx')
 output4 = get_datafile('output4.kdbx')
@@ -273,6 +454,93 @@ class TestKDB4(unittest.TestCase):
         with libkeepass.open(output4, password="qwer", keyfile=keyfile4) as kdb:
             self.assertEqual(kdb.read(32), b"<?xml version='1.0' encoding='ut")
 
+        # twofish and chacha20 encryption
+        for filename in (absfile6, absfile7):
+            with libkeepass.open(filename, password="qwerty") as kdb:
+                out = io.BytesIO()
+                kdb.write_to(out)
+                name = kdb.obj_root.Root.Group.Name.text
+            out.seek(0)
+            kdb = libkeepass.kdb4.KDB4Reader(out, password="qwerty")
+            self.assertEqual(kdb.obj_root.Root.Group.Name.text, name)
+            self.assertEqual(kdb.read(32), b"<?xml version='1.0' encoding='ut")
+
+    def test_write_compact(self):
+        with libkeepass.open(absfile4, password="qwer", keyfile=keyfile4) as kdb:
+            pretty, compact = io.BytesIO(), io.BytesIO()
+            kdb.write_to(pretty)
+            kdb.write_to(compact, compact=True)
+            xml = kdb.pretty_print()
+        self.assertLess(len(compact.getvalue()), len(pretty.getvalue()))
+        compact.seek(0)
+        kdb = libkeepass.kdb4.KDB4Reader(compact, password="qwer",
+                                         keyfile=keyfile4)
+        self.assertNotIn(b'\n  <', kdb.read())
+        # blank text is dropped on load, the trees are the same
+        self.assertEqual(kdb.pretty_print(), xml)
+
+    def test_long_header(self):
+        # headers longer than the first read of the file
+        comment = b'x' * (libkeepass.common.HEADER_READ_SIZE + 100)
+        with libkeepass.open(absfile1, password="asdf") as kdb:
+            kdb.header.Comment = comment
+            header_length = len(kdb._header())
+            out = io.BytesIO()
+            kdb.write_to(out)
+        out.seek(0)
+        kdb = libkeepass.kdb4.KDB4Reader(out, password="asdf")
+        self.assertEqual(kdb.header.Comment, comment)
+        self.assertEqual(kdb.header_length, header_length)
+        self.assertEqual(kdb.read(32), b"<?xml version='1.0' encoding='ut")
+
+    def test_save_async(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'saved.kdbx')
+
+        def title(filename):
+            with libkeepass.open(filename, password="qwer",
+                                 keyfile=keyfile4) as kdb:
+                return kdb.obj_root.Root.Group.Entry.String[0].Value.text
+
+        with libkeepass.open(absfile4, password="qwer", keyfile=keyfile4) as kdb:
+            value = kdb.obj_root.Root.Group.Entry.String[0].Value
+            original = value.text
+            kdb._saver = AsyncSaver()
+            # hold the worker until both saves are requested
+            with kdb._saver._cond:
+                future = kdb.save_async(path)
+                value._setText('changed')
+                # coalesced with the waiting save
+                self.assertIs(kdb.save_async(path), future)
+            self.assertEqual(future.result(timeout=30), path)
+            self.assertEqual(title(path), 'changed')
+
+            # later changes do not affect the snapshot of a running save
+            with kdb._saver._cond:
+                future = kdb.save_async(path, compact=True)
+                value._setText(original)
+            future.result(timeout=30)
+            self.assertEqual(title(path), 'changed')
+            kdb.save_async(path)
+        # close waits for saves
+        self.assertEqual(title(path), original)
+        self.assertEqual(os.listdir(tmpdir), ['saved.kdbx'])
+
+    def test_save_atomic_mode(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'saved.kdbx')
+        with libkeepass.open(absfile1, password="asdf") as kdb:
+            save_atomic(kdb, path)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            os.chmod(path, 0o640)
+            save_atomic(kdb, path, compact=True)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+            kdb.save_async(path).result(timeout=30)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(tmpdir), ['saved.kdbx'])
+
     def test_open_file(self):
         # file not found, proper exception gets re-raised
         with assertRaisesRegex(self, IOError, "No such file or directory"):
@@ -375,6 +643,525 @@ class TestKDB4(unittest.TestCase):
             self.assertEqual(kdb.opened, True)
 
 
+    def test_bulk_protection(self):
+        """Bulk (un)protection gives the results of the per value loop"""
+        with libkeepass.open(absfile4, password="qwer", keyfile=keyfile4,
+                             unprotect=False) as kdb:
+            values = kdb.obj_root.findall('.//Value[@Protected="True"]')
+            texts = [v.text for v in values]
+            kdb._reset_salsa()
+            expected = [kdb._unprotect(t) for t in texts]
+            kdb.unprotect()
+            self.assertEqual([v.text for v in values], expected)
+
+            values[0]._setText(u'p\xe4ssw\xf6rd')
+            kdb._reset_salsa()
+            expected = [kdb._protect(v.text) for v in values]
+            kdb.protect()
+            self.assertEqual([v.text for v in values], expected)
+
+    def test_serialize(self):
+        """Serializing protects values on the fly without changing the tree"""
+        for unprotect in (True, False):
+            with libkeepass.open(absfile4, password="qwer", keyfile=keyfile4,
+                                 unprotect=unprotect) as kdb:
+                xml = kdb.pretty_print()
+                serialized = b''.join(kdb.serialize())
+                compact = b''.join(kdb.serialize(pretty_print=False))
+                self.assertEqual(kdb.pretty_print(), xml)
+                self.assertEqual(kdb.is_protected(), not unprotect)
+                kdb.protect()
+                self.assertEqual(serialized, kdb.pretty_print())
+                self.assertEqual(compact, etree.tostring(
+                    kdb.obj_root, encoding='utf-8', standalone=True))
+
+        with libkeepass.open(absfile4, password="qwer", keyfile=keyfile4) as kdb:
+            with open(output4, 'wb') as outfile:
+                kdb.write_to(outfile)
+            self.assertFalse(kdb.is_protected())
+            self.assertIsNone(kdb.obj_root.find('.//Value[@Protected="True"]'))
+
+    def test_lazy_unprotect(self):
+        """Protected values are decrypted when read with unprotect=False"""
+        with libkeepass.open(absfile4, password="qwer", keyfile=keyfile4) as kdb:
+            expected = [v.text for v in
+                        kdb.obj_root.findall('.//Value[@ProtectedValue]')]
+        with libkeepass.open(absfile4, password="qwer", keyfile=keyfile4,
+                             unprotect=False) as kdb:
+            xml = kdb.pretty_print()
+            values = kdb.obj_root.findall('.//Value[@Protected="True"]')
+            self.assertEqual(kdb.value_text(values[-1]), expected[-1])
+            self.assertEqual([kdb.value_text(v) for v in values], expected)
+            self.assertEqual(kdb.pretty_print(), xml)
+            unprotected = kdb.obj_root.find('.//Value')
+            self.assertEqual(kdb.value_text(unprotected), unprotected.text)
+
+            # changing one value reencrypts the others in document order
+            values[0].set('Protected', 'False')
+            values[0]._setText(u'p\xe4ssw\xf6rd')
+            kdb.protect()
+            self.assertEqual([kdb.value_text(v) for v in values],
+                             [u'p\xe4ssw\xf6rd'] + expected[1:])
+            kdb.unprotect()
+            self.assertEqual([v.text for v in values],
+                             [u'p\xe4ssw\xf6rd'] + expected[1:])
+
+
+class TestProbe(unittest.TestCase):
+    def test_probe(self):
+        info = libkeepass.probe(absfile6)
+        self.assertEqual((info.format, info.version, info.cipher, info.rounds,
+                          info.compression, info.inner_stream),
+                         ('KDB4', '3.1', 'Twofish', 10000, 'gzip', 'Salsa20'))
+        self.assertEqual(info.header_size, 222)
+        self.assertEqual(info.file_size, os.path.getsize(absfile6))
+        self.assertEqual(info.path, absfile6)
+        self.assertIsNone(info.error)
+
+        with open(absfile2, 'rb') as stream:
+            info = libkeepass.probe(io.BytesIO(stream.read()))
+        self.assertEqual((info.format, info.version, info.cipher, info.rounds,
+                          info.compression), ('KDB3', '3.2', 'AES', 50000, None))
+        self.assertIsNone(info.path)
+
+        with assertRaisesRegex(self, IOError, "Unknown base signature."):
+            libkeepass.probe(keyfile3)
+
+    def test_scan(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmpdir, 'sub'))
+            for name, src in (('a.kdbx', absfile1), ('b.KDB', absfile2),
+                              ('sub/c.kdbx', absfile7),
+                              ('sub/broken.kdbx', keyfile3),
+                              ('sub/other.key', keyfile3)):
+                shutil.copy(src, os.path.join(tmpdir, name))
+            results = list(libkeepass.scan(tmpdir, workers=2))
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual([os.path.relpath(r.path, tmpdir) for r in results],
+                         ['a.kdbx', 'b.KDB', os.path.join('sub', 'broken.kdbx'),
+                          os.path.join('sub', 'c.kdbx')])
+        self.assertEqual([r.format for r in results],
+                         ['KDB4', 'KDB3', None, 'KDB4'])
+        self.assertIsInstance(results[2].error, libkeepass.UnknownKDBError)
+        self.assertEqual(results[3].cipher, 'Chacha20')
+
+
+def make_kdbx4(kdb, password, cipher='AES', compress=True, binaries=(),
+               block_length=1024, kdf='AES-KDF'):
+    """
+    Return the element tree of `kdb` as KDBX 4 file encrypted with `cipher`,
+    the key derivation function `kdf` and a ChaCha20 inner random stream,
+    built from scratch.
+    """
+    from libkeepass.kdb4 import (KDB4Header, KDB4InnerHeader,
+        VariantDictionary, FIELD_HEAD_4, INNER_FIELD_HEAD)
+    cipher_id = dict((v, k) for k, v in KDB4Header.ciphers.items())[cipher]
+    master_seed = os.urandom(32)
+    iv = os.urandom(12 if cipher == 'Chacha20' else 16)
+    params = VariantDictionary()
+    params['$UUID'] = [k for k, v in KDB4Header.kdfs.items() if v == kdf][0]
+    if kdf == 'AES-KDF':
+        params['R'] = 1000
+    else:
+        params.set('P', 2, VariantDictionary.UINT32)
+        params['M'] = 64 * 1024
+        params['I'] = 2
+        params.set('V', 0x13, VariantDictionary.UINT32)
+    params['S'] = os.urandom(32)
+
+    header = bytearray(struct.pack('<III', 0x9AA2D903, 0xB54BFB67, 0x00040000))
+    for field_id, data in ((2, cipher_id),
+                           (3, struct.pack('<I', 1 if compress else 0)),
+                           (4, master_seed), (7, iv), (11, params.dump()),
+                           (0, b'\r\n\r\n')):
+        header.extend(FIELD_HEAD_4.pack(field_id, len(data)) + data)
+    header = bytes(header)
+
+    composite = sha256(sha256(password.encode('utf-8')))
+    if kdf == 'AES-KDF':
+        tkey = transform_key(composite, params['S'], params['R'])
+    else:
+        tkey = argon2_hash(composite, params['S'], 2, 64, 2, 32,
+                           ARGON2D if kdf == 'Argon2d' else ARGON2ID)
+    master_key = sha256(master_seed + tkey)
+    hmac_key = sha512(master_seed + tkey + b'\x01')
+    out = io.BytesIO()
+    out.write(header)
+    out.write(sha256(header))
+    out.write(hmac.new(hmac_block_key(hmac_key, 2 ** 64 - 1), header,
+                       hashlib.sha256).digest())
+
+    # protect values with a ChaCha20 inner stream
+    kdb.file_version = 0x00040000
+    kdb.inner_header = KDB4InnerHeader()
+    kdb.inner_header.InnerRandomStreamID = 3
+    kdb.inner_header.InnerRandomStreamKey = os.urandom(64)
+    payload = io.BytesIO()
+    for field_id, data in ((1, struct.pack('<I', 3)),
+                           (2, kdb.inner_header.InnerRandomStreamKey)) + \
+            tuple((3, b'\x01' + b) for b in binaries) + ((0, b''),):
+        payload.write(INNER_FIELD_HEAD.pack(field_id, len(data)) + data)
+    payload.write(b''.join(kdb.serialize()))
+    payload = payload.getvalue()
+    if compress:
+        payload = gzip.compress(payload)
+
+    blocks = HmacBlockWriter(out, hmac_key, block_length)
+    if cipher == 'Chacha20':
+        blocks.write(chacha20_cipher(master_key, iv).encrypt(payload))
+    else:
+        new_cipher = aes_cbc_cipher if cipher == 'AES' else twofish_cbc_cipher
+        encrypted = CipherWriter(blocks, new_cipher(master_key, iv))
+        encrypted.write(payload)
+        encrypted.close()
+    blocks.close()
+    return out.getvalue()
+
+
+class TestKDBX4(unittest.TestCase):
+    def setUp(self):
+        with libkeepass.open(absfile1, password="asdf") as kdb:
+            self.xml = self.clear_xml(kdb)
+            self.data = make_kdbx4(kdb, "asdf", binaries=[b'attached'])
+
+    @staticmethod
+    def clear_xml(kdb):
+        "The unprotected XML without the original protected values."
+        root = copy.deepcopy(kdb.obj_root)
+        for value in root.iterfind('.//Value[@ProtectedValue]'):
+            del value.attrib['ProtectedValue']
+        return etree.tostring(root)
+
+    def test_read(self):
+        for cipher, compress in (('AES', True), ('Twofish', False),
+                                 ('Chacha20', True)):
+            with libkeepass.open(absfile1, password="asdf") as kdb:
+                data = make_kdbx4(kdb, "asdf", cipher, compress)
+            kdb = libkeepass.open_stream(io.BytesIO(data), password="asdf")
+            self.assertIsInstance(kdb, libkeepass.kdb4.KDB4Reader)
+            self.assertEqual(kdb.file_version, 0x00040000)
+            self.assertEqual(kdb.header.ciphers[kdb.header.CipherID], cipher)
+            self.assertEqual(self.clear_xml(kdb), self.xml)
+            kdb.close()
+
+    def test_read_fixtures(self):
+        # written from the format description, see tests/data/kdbx4_fixtures.py
+        for path, cipher, kdf, rounds in (
+                (absfile9, 'AES', 'AES-KDF', 6000),
+                (absfile10, 'Chacha20', 'Argon2d', 2)):
+            info = libkeepass.probe(path)
+            self.assertEqual((info.version, info.cipher, info.kdf, info.rounds),
+                             ('4.0', cipher, kdf, rounds))
+            with libkeepass.open(path, password="asdf", unprotect=False) as kdb:
+                self.assertEqual(kdb.file_version, 0x00040000)
+                self.assertEqual(kdb.inner_header.InnerRandomStreamID, 3)
+                self.assertEqual(kdb.binaries.read(0), b'attached file\n')
+                self.assertTrue(kdb.binaries.protected(0))
+                entry = kdb.query(Title='Sample Entry').first()
+                values = dict((s.Key.text, kdb.value_text(s.Value))
+                              for s in entry.String)
+                self.assertEqual(values, {
+                    'Title': 'Sample Entry', 'UserName': 'User Name',
+                    'Password': u'p\xe4ssword', 'URL': 'https://keepass.info/',
+                    'Notes': u'n\xf6tes', 'PIN': '1234'})
+                # times are base64 encoded seconds since 0001-01-01
+                self.assertEqual(kdb.query(expired=True).first(), entry)
+                output = io.BytesIO()
+                kdb.write_to(output)
+            with libkeepass.open_stream(io.BytesIO(output.getvalue()),
+                                        password="asdf") as kdb:
+                entry = kdb.obj_root.find('.//Entry')
+                self.assertEqual(entry.findtext("String[Key='PIN']/Value"), '1234')
+                self.assertEqual(kdb.binaries.read(0), b'attached file\n')
+
+    def test_inner_header(self):
+        kdb = libkeepass.kdb4.KDB4Reader(io.BytesIO(self.data), password="asdf",
+                                         unprotect=False)
+        self.assertEqual(kdb.inner_header.InnerRandomStreamID, 3)
+        self.assertEqual(len(kdb.inner_header.InnerRandomStreamKey), 64)
+        self.assertEqual(len(kdb.binaries), 1)
+        self.assertEqual(kdb.binaries.read(0), b'attached')
+        self.assertTrue(kdb.binaries.protected(0))
+        self.assertEqual(kdb.kdf_parameters['R'], 1000)
+        kdb.unprotect()
+        self.assertEqual(self.clear_xml(kdb), self.xml)
+
+        # the inner stream is encrypted in KDBX 4 files
+        info = libkeepass.probe(io.BytesIO(self.data))
+        self.assertEqual((info.version, info.kdf, info.rounds, info.inner_stream),
+                         ('4.0', 'AES-KDF', 1000, None))
+
+    def test_integrity(self):
+        with assertRaisesRegex(self, IOError, "Master key invalid."):
+            libkeepass.kdb4.KDB4Reader(io.BytesIO(self.data), password="wrong")
+        data = bytearray(self.data)
+        data[20] ^= 1
+        with assertRaisesRegex(self, IOError, "Header hash mismatch."):
+            libkeepass.kdb4.KDB4Reader(io.BytesIO(bytes(data)), password="asdf")
+        data = bytearray(self.data)
+        data[-100] ^= 1
+        with assertRaisesRegex(self, IOError, "Block HMAC mismatch error."):
+            libkeepass.kdb4.KDB4Reader(io.BytesIO(bytes(data)), password="asdf")
+
+    def test_write(self):
+        large = os.urandom(3000)
+        for cipher, compress in (('AES', True), ('Twofish', False),
+                                 ('Chacha20', True)):
+            with libkeepass.open(absfile1, password="asdf") as kdb:
+                data = make_kdbx4(kdb, "asdf", cipher, compress,
+                                  binaries=[b'attached', large])
+            kdb = libkeepass.open_stream(io.BytesIO(data), password="asdf")
+            kdb.binaries.replace(0, b'replaced', protected=False)
+            out = io.BytesIO()
+            kdb.write_to(out)
+            kdb.close()
+            with libkeepass.open_stream(io.BytesIO(out.getvalue()),
+                                        password="asdf") as kdb:
+                self.assertEqual(kdb.file_version, 0x00040000)
+                self.assertEqual(kdb.header.ciphers[kdb.header.CipherID], cipher)
+                self.assertEqual(kdb.header.CompressionFlags, int(compress))
+                self.assertEqual(self.clear_xml(kdb), self.xml)
+                self.assertEqual(kdb.binaries.read(0), b'replaced')
+                self.assertFalse(kdb.binaries.protected(0))
+                self.assertEqual(kdb.binaries.read(1), large)
+
+    def test_spilled_binaries(self):
+        from libkeepass.utils import binaries
+        large = os.urandom(200000)
+        threshold, binaries.SPILL_THRESHOLD = binaries.SPILL_THRESHOLD, 1000
+        try:
+            kdb = libkeepass.open_stream(io.BytesIO(self.data), password="asdf")
+            index = kdb.binaries.add(io.BytesIO(large))
+            self.assertTrue(kdb.binaries.spilled(index))
+            self.assertFalse(kdb.binaries.spilled(0))
+            snapshot = kdb.snapshot()
+            kdb.binaries.replace(index, b'small')
+            kdb.close()
+            out = io.BytesIO()
+            snapshot.write_to(out)
+            snapshot.close()
+        finally:
+            binaries.SPILL_THRESHOLD = threshold
+        kdb = libkeepass.open_stream(io.BytesIO(out.getvalue()),
+                                     password="asdf")
+        self.assertEqual(kdb.binaries.read(1), large)
+        self.assertFalse(kdb.binaries.spilled(1))
+        kdb.close()
+
+    def test_binary_pool(self):
+        from libkeepass.utils.binaries import BinaryPool
+        pool = BinaryPool(spill_threshold=100)
+        data = os.urandom(1000)
+        self.assertEqual(pool.load(io.BytesIO(b'\x01' + data[:50]), 51), 0)
+        self.assertEqual(pool.load(io.BytesIO(b'\x00' + data), 1001), 1)
+        self.assertEqual((pool.spilled(0), pool.spilled(1)), (False, True))
+        self.assertEqual(pool.view(0), data[:50])
+        with pool.open(1) as f:
+            self.assertEqual(f.read(10), data[:10])
+            self.assertEqual(f.read(), data[10:])
+        out = io.BytesIO()
+        pool.copy_to(1, out)
+        self.assertEqual(out.getvalue(), data)
+
+        copied = pool.copy()
+        pool.replace(1, data[:10], protected=True)
+        self.assertEqual((pool.read(1), pool.flags(1)), (data[:10], 1))
+        self.assertEqual((copied.read(1), copied.flags(1)), (data, 0))
+        pool.remove(0)
+        self.assertEqual(len(pool), 1)
+        with assertRaisesRegex(self, IOError, "Unexpected end of attachment."):
+            pool.load(io.BytesIO(b'\x00abc'), 10)
+
+        # the temporary file is closed with the last pool sharing it
+        spill = pool._spill
+        pool.close()
+        self.assertFalse(spill._file.closed)
+        self.assertEqual(copied.read(1), data)
+        copied.close()
+        self.assertTrue(spill._file.closed)
+
+    def test_variant_dictionary(self):
+        from libkeepass.kdb4 import VariantDictionary
+        params = VariantDictionary()
+        params['$UUID'] = b'\x00' * 16
+        params.set('P', 2, VariantDictionary.UINT32)
+        params['M'] = 64 * 1024 * 1024
+        params['flag'] = True
+        params['name'] = u'n\xe4me'
+        params['neg'] = -5
+        parsed = VariantDictionary.parse(params.dump())
+        self.assertEqual(parsed, params)
+        self.assertEqual(list(parsed), list(params))
+        self.assertEqual(parsed.types, params.types)
+        self.assertEqual(parsed.types['M'], VariantDictionary.UINT64)
+        self.assertEqual(parsed.dump(), params.dump())
+        with assertRaisesRegex(self, IOError, "Unexpected end"):
+            VariantDictionary.parse(params.dump()[:-5])
+
+
+class TestArgon2(unittest.TestCase):
+    # RFC 9106 test vectors
+    vectors = {
+        ARGON2D: '512b391b6f1162975371d30919734294f868e3be3984f3c1a13a4db9fabe4acb',
+        ARGON2I: 'c814d9d1dc7f37aa13f0d77f2494bda1c8de6b016dd388d29952a4c4672b6ce8',
+        ARGON2ID: '0d640df58d78766c08c037a34a8b53c9d01ef0452d75b65eb52520e96b01e659',
+    }
+
+    def test_vectors(self):
+        for backend in BACKENDS:
+            if backend == 'native':
+                # no secret and associated data support
+                continue
+            for type, expected in self.vectors.items():
+                tag = argon2_hash(b'\x01' * 32, b'\x02' * 16, 3, 32, 4, 32, type,
+                                  secret=b'\x03' * 8,
+                                  associated_data=b'\x04' * 12,
+                                  backend=backend)
+                self.assertEqual(binascii.hexlify(tag).decode(), expected)
+
+    def test_backends(self):
+        for type in (ARGON2D, ARGON2ID):
+            for version in (0x10, 0x13):
+                tags = set(argon2_hash(b'password', b'somesalt', 2, 64, 3, 32,
+                                       type, version, backend=backend)
+                           for backend in BACKENDS)
+                self.assertEqual(len(tags), 1)
+
+    def test_memory_budget(self):
+        budget = MemoryBudget(4096)
+        with budget.reserve(3000):
+            self.assertEqual(budget.in_use, 3000)
+        with budget.reserve(4096):
+            pass
+        self.assertEqual((budget.in_use, budget.peak), (0, 4096))
+        with assertRaisesRegex(self, IOError, "more than the limit"):
+            with budget.reserve(4097):
+                pass
+
+    def test_kdbx4(self):
+        with libkeepass.open(absfile1, password="asdf") as kdb:
+            xml = TestKDBX4.clear_xml(kdb)
+            data = make_kdbx4(kdb, "asdf", kdf='Argon2d')
+            data_id = make_kdbx4(kdb, "asdf", kdf='Argon2id')
+        with libkeepass.open_stream(io.BytesIO(data_id), password="asdf") as kdb:
+            self.assertEqual(TestKDBX4.clear_xml(kdb), xml)
+        with assertRaisesRegex(self, IOError, "Master key invalid."):
+            libkeepass.open_stream(io.BytesIO(data), password="wrong")
+
+        kdb = libkeepass.open_stream(io.BytesIO(data), password="asdf")
+        self.assertEqual(TestKDBX4.clear_xml(kdb), xml)
+        self.assertEqual(kdb.kdf_parameters['M'], 64 * 1024)
+        info = libkeepass.probe(io.BytesIO(data))
+        self.assertEqual((info.kdf, info.rounds), ('Argon2d', 2))
+
+        # the transformed key is cached for the credentials and settings
+        tkey = kdb._transformed_key[1]
+        kdb._make_master_key()
+        self.assertIs(kdb._transformed_key[1], tkey)
+        self.assertIs(kdb.snapshot()._transformed_key[1], tkey)
+        kdb.add_credentials(password="other")
+        kdb._make_master_key()
+        self.assertNotEqual(kdb._transformed_key[1], tkey)
+        kdb.close()
+
+        # memory settings above the limit are refused
+        budget = libkeepass.kdf.memory_budget
+        limit, budget.limit = budget.limit, 32 * 1024
+        try:
+            with assertRaisesRegex(self, IOError, "more than the limit"):
+                libkeepass.open_stream(io.BytesIO(data), password="asdf")
+        finally:
+            budget.limit = limit
+
+
+NEVER = datetime.datetime(2999, 12, 28, 23, 59, 59)
+
+
+def pack_kdb3_date(d):
+    return struct.pack('<5B', d.year >> 6,
+                       ((d.year & 0x3f) << 2) | (d.month >> 2),
+                       ((d.month & 3) << 6) | (d.day << 1) | (d.hour >> 4),
+                       ((d.hour & 0xf) << 4) | (d.minute >> 2),
+                       ((d.minute & 3) << 6) | d.second)
+
+
+def kdb3_body(groups, entries):
+    """
+    Encode `groups` and `entries`, dicts like those of `KDB3Reader`, as body
+    of a KDB3 file.
+    """
+    from libkeepass.kdb3 import FIELD_HEAD, END_OF_RECORD
+    body = []
+
+    def field(field_type, data):
+        body.append(FIELD_HEAD.pack(field_type, len(data)))
+        body.append(data)
+
+    def text(value):
+        return value.encode('utf-8') + b'\x00'
+
+    for group in groups:
+        field(1, struct.pack('<I', group['group_id']))
+        field(2, text(group['title']))
+        for field_type, key in ((3, 'created'), (4, 'modified'),
+                                (5, 'accessed'), (6, 'expires')):
+            field(field_type, pack_kdb3_date(group.get(key, NEVER)))
+        field(7, struct.pack('<I', group.get('icon', 0)))
+        field(8, struct.pack('<H', group.get('level', 0)))
+        field(9, struct.pack('<I', 0))
+        field(END_OF_RECORD, b'')
+    for entry in entries:
+        field(1, binascii.unhexlify(entry['id']))
+        field(2, struct.pack('<I', entry['group_id']))
+        field(3, struct.pack('<I', entry.get('icon', 0)))
+        for field_type, key in ((4, 'title'), (5, 'url'), (6, 'username'),
+                                (7, 'password'), (8, 'notes')):
+            field(field_type, text(entry.get(key, u'')))
+        for field_type, key in ((9, 'created'), (0xA, 'modified'),
+                                (0xB, 'accessed'), (0xC, 'expires')):
+            field(field_type, pack_kdb3_date(entry.get(key, NEVER)))
+        field(0xD, text(entry.get('bin_desc', u'')))
+        field(0xE, entry.get('binary', b''))
+        field(END_OF_RECORD, b'')
+    return b''.join(body)
+
+
+def make_kdb3(groups, entries, password, rounds=10):
+    "Return a AES encrypted KDB3 file of `groups` and `entries`."
+    from libkeepass.kdb3 import KDB3_HEADER, KDB3_SIGNATURE
+    body = kdb3_body(groups, entries)
+    master_seed, iv, seed2 = os.urandom(16), os.urandom(16), os.urandom(32)
+    tkey = transform_key(sha256(password.encode('utf-8')), seed2, rounds)
+    header = KDB3_HEADER.pack(
+        KDB3_SIGNATURE[0], KDB3_SIGNATURE[1], 3, b'\x03\x00\x03\x00',
+        master_seed, iv, len(groups), len(entries), sha256(body), seed2,
+        rounds)
+    return header + aes_cbc_encrypt(pad(body), sha256(master_seed + tkey), iv)
+
+
+def kdb3_records(n_entries, n_groups, depth=4):
+    """
+    Return groups and entries for a KDB3 file, the groups nested up to
+    `depth` levels.
+    """
+    created = datetime.datetime(2012, 7, 20, 17, 15, 50)
+    groups = [dict(group_id=i + 1, title=u'Group %d' % i, level=i % depth,
+                   icon=i % 60, created=created, modified=created,
+                   accessed=created, expires=NEVER)
+              for i in range(n_groups)]
+    entries = [dict(id='%032x' % (i + 1), group_id=i % n_groups + 1,
+                    icon=i % 60, title=u'Entry %d' % i,
+                    url=u'https://host%d.example.com/' % (i % 100),
+                    username=u'user%d' % (i % 1000), password=u'pw\xe4%d' % i,
+                    notes=u'', created=created, modified=created,
+                    accessed=created, expires=NEVER, bin_desc=u'',
+                    binary=b'')
+               for i in range(n_entries)]
+    return groups, entries
+
+
 class TestKDB3(unittest.TestCase):
     def test_open_file(self):
         # old kdb file
@@ -409,6 +1196,303 @@ class TestKDB3(unittest.TestCase):
             })
             self.assertEqual(kdb.entries[0], verify_entry)
 
+    def test_group_references(self):
+        groups, entries = kdb3_records(9, 6, depth=3)
+        # an orphaned entry and the tree state of two groups
+        entries[1]['group_id'] = 99
+        entries.append(dict(id='%032x' % 100, group_id=1, title=u'Meta-Info',
+                            username=u'SYSTEM', url=u'$',
+                            notes=u'KPX_GROUP_TREE_STATE', bin_desc=u'bin-stream',
+                            binary=struct.pack('<IIBIB', 2, 2, 1, 5, 0)))
+        data = make_kdb3(groups, entries, 'asdf')
+        with libkeepass.open_stream(io.BytesIO(data), password='asdf') as kdb:
+            self.assertEqual(len(kdb.entries), 9)
+            orphan = kdb.entries_by_id['%032x' % 2]
+            self.assertEqual((orphan['group_id'], orphan['group']),
+                             (-1, '*Orphaned*'))
+            self.assertEqual(kdb.groups[-1]['group_id'], -1)
+            self.assertEqual([g.get('expanded') for g in kdb.groups],
+                             [None, 1, None, None, 0, None, None])
+            self.assertEqual(kdb._get_group_path(6), 'Group 3\\Group 4\\Group 5')
+            self.assertEqual(kdb.groups_by_id[5]['path'], 'Group 3\\Group 4')
+            self.assertIn(b'<group tree="Group 3\\Group 4">Group 5</group>',
+                          kdb.pretty_print())
+            self.assertIn(b'<group>*Orphaned*</group>', kdb.pretty_print())
+
+    def test_parse_body(self):
+        groups, entries = kdb3_records(20, 6, depth=3)
+        entries[3]['binary'] = b'\x00\x01attached'
+        entries[3]['bin_desc'] = u'file.bin'
+        data = make_kdb3(groups, entries, 'asdf')
+        with libkeepass.open_stream(io.BytesIO(data), password='asdf') as kdb:
+            self.assertEqual(len(kdb.groups), 6)
+            self.assertEqual([g.get('groups') for g in kdb.groups],
+                             [None, 1, 2, None, 4, 5])
+            self.assertEqual(len(kdb.entries), 20)
+            entry = kdb.entries_by_id['%032x' % 4]
+            self.assertEqual(entry['group'], u'Group 3')
+            self.assertEqual(entry['password'], u'pw\xe43')
+            self.assertEqual(entry['binary'], b'\x00\x01attached')
+            self.assertEqual(entry['created'], groups[0]['created'])
+            self.assertEqual(entry['expires'], NEVER)
+
+        body = bytearray(kdb3_body(groups, entries))
+        # unknown fields are kept
+        body[:0] = struct.pack('<HI', 0x20, 3) + b'abc'
+        kdb = libkeepass.kdb3.KDB3Reader()
+        kdb.header.Groups, kdb.header.Entries = len(groups), len(entries)
+        kdb.in_buffer = io.BytesIO(bytes(body))
+        libkeepass.kdb3.KDBExtension.__init__(kdb)
+        self.assertEqual(kdb.groups[0]['unknown_20'], b'abc')
+        kdb.in_buffer = io.BytesIO(bytes(body[:-10]))
+        # entries are decoded on first use
+        libkeepass.kdb3.KDBExtension.__init__(kdb)
+        with assertRaisesRegex(self, ValueError, "Entry header offset is out of range."):
+            kdb.entries
+
+    def test_records(self):
+        groups, entries = kdb3_records(20, 4)
+        entries[5]['username'] = u'user1'
+        modified = datetime.datetime(2013, 1, 2, 3, 4, 5)
+        data = make_kdb3(groups, entries, 'asdf')
+        with libkeepass.open_stream(io.BytesIO(data), password='asdf') as kdb:
+            entry = kdb.entries[1]
+            self.assertIsInstance(entry, libkeepass.kdb3.KDB3Entry)
+            self.assertIsInstance(kdb.groups[0], libkeepass.kdb3.KDB3Group)
+            # dates are decoded when read, repeated text is shared
+            self.assertIsInstance(entry._created, int)
+            self.assertEqual(entry['created'], entries[1]['created'])
+            self.assertEqual(entry.expires, NEVER)
+            self.assertIs(entry['username'], kdb.entries[5]['username'])
+            self.assertIs(entry['group'], kdb.groups_by_id[2]['title'])
+            # dict style access
+            self.assertEqual(sorted(entry), sorted(list(entries[1]) + ['group']))
+            self.assertEqual(len(entry), 15)
+            self.assertNotIn('expanded', kdb.groups[0])
+            self.assertRaises(KeyError, lambda: kdb.groups[0]['expanded'])
+            self.assertEqual(entry.get('uuid', 1), 1)
+            copy = entry.copy()
+            self.assertIs(type(copy), dict)
+            self.assertEqual(entry, copy)
+            entry['uuid'] = u'x'
+            entry['modified'] = modified
+            self.assertEqual((entry['uuid'], entry.modified), (u'x', modified))
+            self.assertNotEqual(entry, copy)
+            del entry['uuid']
+            self.assertNotIn('uuid', entry)
+            self.assertEqual(u'{title} {modified:%Y}'.format(**entry),
+                             u'Entry 1 2013')
+
+    def test_write_xml(self):
+        groups, entries = kdb3_records(30, 6, depth=3)
+        entries[2]['notes'] = u'a\r\nb <c> & "d"'
+        entries[3]['title'] = u''
+        data = make_kdb3(groups, entries, 'asdf')
+        with libkeepass.open_stream(io.BytesIO(data), password='asdf') as kdb:
+            out = io.BytesIO()
+            kdb.write_xml(out)
+            # entries are streamed, not kept
+            self.assertIsNone(kdb._entries)
+            self.assertEqual(out.getvalue(), kdb.pretty_print())
+            root = etree.fromstring(out.getvalue())
+            self.assertEqual(root.tag, 'pwlist')
+            self.assertEqual(len(root), 30)
+            self.assertEqual(root[2].findtext('notes'), u'a\nb <c> & "d"')
+            self.assertIsNone(root[3].find('title').text)
+            group = root[5].find('group')
+            self.assertEqual((group.text, group.get('tree')),
+                             ('Group 5', 'Group 3\\Group 4'))
+            self.assertEqual(root[0].find('expiretime').get('expires'), 'False')
+            self.assertEqual(root[0].findtext('creationtime'), '2012-07-20T17:15:50')
+
+    def test_iter_entries(self):
+        groups, entries = kdb3_records(50, 5)
+        entries[7]['group_id'] = 99
+        icons = struct.pack('<LLL', 1, 1, 1) + struct.pack('<L', 3) + b'png' + \
+            binascii.unhexlify(entries[3]['id']) + struct.pack('<L', 0) + \
+            struct.pack('<LL', 2, 0)
+        entries.insert(10, dict(id='%032x' % 999, group_id=1, title=u'Meta-Info',
+                                username=u'SYSTEM', url=u'$',
+                                notes=u'KPX_CUSTOM_ICONS_4', bin_desc=u'bin-stream',
+                                binary=icons))
+        data = make_kdb3(groups, entries, 'asdf')
+        with libkeepass.open_stream(io.BytesIO(data), password='asdf') as kdb:
+            it = kdb.iter_entries()
+            first = next(it)
+            self.assertEqual((first['title'], first['group']), (u'Entry 0', u'Group 0'))
+            # nothing is kept
+            self.assertIsNone(kdb._entries)
+            streamed = [first] + list(it)
+            self.assertEqual(len(streamed), 50)
+            self.assertEqual(streamed[7]['group'], '*Orphaned*')
+            self.assertEqual(streamed[3]['icon'], 0)
+            self.assertEqual(kdb.groups_by_id[2]['icon'], 0)
+            self.assertEqual(kdb.icons[0]['data'], b'png')
+            self.assertEqual([g['title'] for g in kdb.iter_groups()][-1], '*Orphaned*')
+            self.assertEqual(kdb.entries, streamed)
+            self.assertIs(next(kdb.iter_entries()), kdb.entries[0])
+
+class TestConvert(unittest.TestCase):
+    def test_convert_kdb3_to_kxml4(self):
+        from libkeepass.utils.convert import convert_kdb3_to_kxml4
+        groups, entries = kdb3_records(40, 8, depth=3)
+        groups[7]['title'] = u'Backup'
+        entries[4]['notes'] = u'a\r\nb <&>'
+        entries[5]['group_id'] = 99
+        data = make_kdb3(groups, entries, 'asdf')
+        with libkeepass.open_stream(io.BytesIO(data), password='asdf') as kdb:
+            kdb.groups_by_id[2]['expanded'] = 1
+            doc = convert_kdb3_to_kxml4(kdb)
+        root_group = doc.find('Root/Group')
+        self.assertEqual(root_group.findtext('Name'), 'Root')
+        # levels 0, 1, 2, 0, 1, 2, 0, 1 and the orphaned group
+        self.assertEqual([g.findtext('Name') for g in root_group.findall('Group')],
+                         ['Group 0', 'Group 3', 'Group 6', '*Orphaned*'])
+        group = root_group.find("Group[Name='Group 0']/Group[Name='Group 1']")
+        self.assertEqual(group.findtext('IsExpanded'), 'True')
+        self.assertEqual(group.findtext('Group/Name'), 'Group 2')
+        self.assertEqual(len(group.findall('Entry')), 5)
+        backup = root_group.find(".//Group[Name='Backup']")
+        self.assertEqual(backup.findtext('EnableSearching'), 'False')
+        self.assertEqual(backup.findtext('IsExpanded'), 'False')
+        entries4 = doc.findall('.//Entry')
+        self.assertEqual(len(entries4), 40)
+        entry = doc.find(".//Entry[UUID='%s']" % base64.b64encode(
+            binascii.unhexlify(entries[4]['id'])).decode('ascii'))
+        self.assertEqual(entry.findtext("String[Key='Notes']/Value"), u'a\nb <&>')
+        self.assertEqual(entry.findtext('Times/CreationTime'), '2012-07-20T17:15:50Z')
+        self.assertEqual(entry.findtext('Times/Expires'), 'False')
+        orphan = root_group.find("Group[Name='*Orphaned*']")
+        self.assertEqual(len(orphan.findall('Entry')), 1)
+
+    def test_convert_kdb3_to_kdb4(self):
+        from libkeepass.utils.convert import convert_kdb3_to_kdb4
+        with libkeepass.open(absfile2, password='asdf') as kdb3:
+            kdb4 = convert_kdb3_to_kdb4(kdb3)
+        output = io.BytesIO()
+        kdb4.write_to(output)
+        with libkeepass.open_stream(io.BytesIO(output.getvalue()),
+                                    password='asdf') as kdb:
+            entry = kdb.obj_root.find('.//Entry')
+            self.assertEqual(entry.find("String[Key='Title']").Value, 'asdf')
+            self.assertEqual(entry.getparent().Name, 'Internet')
+
+    def test_write_kdb3_as_kdb4(self):
+        from libkeepass.utils.convert import convert_kdb3_to_kdb4, write_kdb3_as_kdb4
+        groups, entries = kdb3_records(40, 8, depth=3)
+        entries[3]['password'] = u''
+        entries[5]['group_id'] = 99
+        data = make_kdb3(groups, entries, 'asdf')
+        with libkeepass.open_stream(io.BytesIO(data), password='asdf') as kdb3:
+            expected = convert_kdb3_to_kdb4(kdb3).obj_root
+            output = io.BytesIO()
+            write_kdb3_as_kdb4(kdb3, output)
+            compact = io.BytesIO()
+            stats = {}
+            write_kdb3_as_kdb4(kdb3, compact, compact=True, stats=stats)
+        # the root group, 8 groups and the *Orphaned* group
+        self.assertEqual(stats, {'groups': 10, 'entries': 40})
+        self.assertLess(len(compact.getvalue()), len(output.getvalue()))
+
+        def contents(root):
+            # entries are written before the sub-groups of their group
+            return sorted((e.getparent().findtext('Name'), e.findtext('UUID'),
+                           [s.findtext('Value') for s in e.findall('String')])
+                          for e in root.iter('Entry'))
+        for stream in (output, compact):
+            with libkeepass.open_stream(io.BytesIO(stream.getvalue()),
+                                        password='asdf') as kdb:
+                root = kdb.obj_root
+                self.assertEqual([g.findtext('Name') for g in root.iter('Group')],
+                                 [g.findtext('Name') for g in expected.iter('Group')])
+                self.assertEqual(contents(root), contents(expected))
+
+    def test_convert_linear(self):
+        from unittest import mock
+        from libkeepass.utils import convert
+        converts = (convert.convert_kdb3_to_kxml4,
+                    lambda kdb: convert.write_kdb3_as_kdb4(kdb, io.BytesIO()))
+        data = make_kdb3(*kdb3_records(500, 50, depth=8),
+                         password='asdf', rounds=1)
+        iter_records = libkeepass.kdb3.iter_records
+        decoded = []
+
+        def counting_iter_records(*args):
+            for record in iter_records(*args):
+                decoded.append(record)
+                yield record
+
+        # every group and entry is decoded, looked up and converted once, the
+        # conversion time grows linearly with the size of the file (see the
+        # convert_scaling benchmark)
+        for convert_kdb in converts:
+            del decoded[:]
+            with libkeepass.open_stream(io.BytesIO(data),
+                                        password='asdf') as kdb:
+                with mock.patch.object(libkeepass.kdb3, 'iter_records',
+                                       counting_iter_records), \
+                        mock.patch.object(convert, '_group_element',
+                                          wraps=convert._group_element) as groups, \
+                        mock.patch.object(convert, '_entry_element',
+                                          wraps=convert._entry_element) as entries, \
+                        mock.patch.object(kdb, '_resolve_group',
+                                          wraps=kdb._resolve_group) as resolve:
+                    convert_kdb(kdb)
+            self.assertEqual(len(decoded), 500)
+            self.assertEqual(groups.call_count, 51)
+            self.assertEqual(entries.call_count, 500)
+            self.assertEqual(resolve.call_count, 500)
+
+    def test_convert_batch(self):
+        from libkeepass.utils.batch import convert_batch, format_report, \
+            read_manifest
+        jobs = read_manifest(io.StringIO(
+            u'# KeePass 1.x files\n'
+            u'a.kdb\n'
+            u'\n'
+            u'b.kdb\tout/b.kdbx\n'
+            u'missing.kdb\n'
+            u'c.kdb\n'))
+        self.assertEqual(jobs, [('a.kdb', 'a.kdbx'), ('b.kdb', 'out/b.kdbx'),
+                                ('missing.kdb', 'missing.kdbx'),
+                                ('c.kdb', 'c.kdbx')])
+        self.assertRaises(ValueError, read_manifest, io.StringIO(u'a\tb\tc\n'))
+        # KDB3 keyfiles are not supported
+        with assertRaisesRegex(self, ValueError, "only be converted with a password"):
+            list(convert_batch(jobs, keyfile=keyfile3))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmpdir, 'out'))
+            for name, src in (('a.kdb', absfile2), ('b.kdb', absfile2),
+                              ('c.kdb', absfile1)):
+                shutil.copy(src, os.path.join(tmpdir, name))
+            jobs = [(os.path.join(tmpdir, input), os.path.join(tmpdir, output))
+                    for input, output in jobs]
+            results = sorted(convert_batch(jobs, workers=2, password='asdf'),
+                             key=lambda result: result.input)
+            self.assertEqual([r.error is None for r in results],
+                             [True, True, False, False])
+            self.assertEqual(list(results[0].times),
+                             ['read', 'decrypt', 'convert', 'sync'])
+            self.assertEqual(results[1].entries, 1)
+            # a KeePass 2 file
+            self.assertIn('Not a KeePass 1.x file', results[2].error)
+            self.assertEqual(list(results[3].times), ['read'])
+            with libkeepass.open(os.path.join(tmpdir, 'out', 'b.kdbx'),
+                                 password='asdf') as kdb:
+                self.assertEqual(kdb.obj_root.find('.//Entry/String/Value'),
+                                 'asdf')
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ['a.kdb', 'a.kdbx', 'b.kdb', 'c.kdb', 'out'])
+        finally:
+            shutil.rmtree(tmpdir)
+        report = format_report(results).splitlines()
+        self.assertEqual(report[0], '2 converted, 2 failed, 2 entries')
+        self.assertEqual([line.split()[:2] for line in report[2:]],
+                         [['read', '4'], ['decrypt', '3'], ['convert', '2'],
+                          ['sync', '2'], ['all', '4']])
+
+
 # # valid password and plain keyfile, uncompressed kdb
 # with libkeepass.open(absfile5, password="qwer", keyfile=keyfile5) as kdb:
 # self.assertIsNotNone(kdb)
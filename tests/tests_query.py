@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+import io
+import copy
+import unittest
+
+import libkeepass
+import libkeepass.kdb4
+from libkeepass.utils.query import prefix, regex, contains
+from libkeepass.utils.urls import url_host, MATCH_EXACT, MATCH_PARENT
+
+from . import get_datafile
+
+
+kdbf_t1 = get_datafile('sample_merge-t0-t1.kdbx')
+
+
+class TestKDB4Query(unittest.TestCase):
+    def setUp(self):
+        self.kdb = libkeepass.open(kdbf_t1, password="qwerty")
+
+    def tearDown(self):
+        self.kdb.close()
+
+    def uuids(self, result):
+        return [e.UUID.text for e in result]
+
+    def test_exact(self):
+        res = self.kdb.query(Title='Sample Entry #3')
+        self.assertEqual(self.uuids(res), ['Wi5/5yOMVUya/O4RXGbfVg=='])
+        self.assertTrue(res.explain().startswith("plan: index exact Title="))
+        self.assertEqual(self.kdb.query(Title='Sample Entry').count(), 0)
+
+    def test_prefix_and_group(self):
+        res = self.kdb.query(Title=prefix('Sample Entry #'),
+                             group='/sample_merge/General')
+        self.assertEqual(self.uuids(res), ['lG18b6Y1DUyp9bKzoFTBfA==',
+                                           'Wi5/5yOMVUya/O4RXGbfVg=='])
+        res = self.kdb.query(group='sample_merge/General/Samples/')
+        self.assertEqual(self.uuids(res), ['Wi5/5yOMVUya/O4RXGbfVg=='])
+        # group name prefix is not a subgroup
+        self.assertEqual(self.kdb.query(group='/sample_merge/Gen').count(), 0)
+
+    def test_root_group(self):
+        for group in ('/', '//', ''):
+            res = self.kdb.query(group=group)
+            self.assertEqual(res.count(), self.kdb.query().count())
+            self.assertNotIn('group', res.explain())
+
+    def test_scans(self):
+        res = self.kdb.query(URL=regex('keepass'))
+        self.assertTrue(res.explain().startswith("plan: full scan"))
+        self.assertEqual(res.count(), 2)
+        res = self.kdb.query(UserName=contains('USER', ignore_case=True))
+        self.assertTrue(res.explain().startswith("plan: value scan"))
+        self.assertEqual(len(self.uuids(res)), 3)
+
+    def test_protected_fields_are_filtered(self):
+        self.assertIn('Password', self.kdb.entry_index.protected_keys)
+        res = self.kdb.query(Password='12345')
+        self.assertEqual(self.uuids(res), ['lG18b6Y1DUyp9bKzoFTBfA=='])
+        self.assertTrue(res.explain().startswith("plan: full scan"))
+
+    def test_pages(self):
+        res = self.kdb.query()
+        self.assertEqual(len(res.page(0, size=3)), 3)
+        self.assertEqual(len(res.page(1, size=3)), 1)
+        self.assertEqual(res.page(2, size=3), [])
+        self.assertEqual(res.first().UUID.text, 'lG18b6Y1DUyp9bKzoFTBfA==')
+
+    def test_expired_tags_deleted(self):
+        entry = self.kdb.query(Title='Sample Entry #5').first()
+        entry.Times.Expires._setText('True')
+        entry.Tags._setText('work; bank')
+        self.kdb.invalidate(entry)
+        self.assertEqual(self.uuids(self.kdb.query(expired=True)),
+                         [entry.UUID.text])
+        self.assertEqual(self.kdb.query(expired=False).count(), 3)
+        self.assertEqual(self.uuids(self.kdb.query(tags=['bank', 'work'])),
+                         [entry.UUID.text])
+        self.assertEqual(self.kdb.query(tags='work;home').count(), 0)
+
+        deleted = self.kdb.obj_root.Root.DeletedObjects
+        deleted_object = copy.deepcopy(deleted.DeletedObject)
+        deleted_object.UUID._setText(entry.UUID.text)
+        deleted.append(deleted_object)
+        self.kdb.invalidate(deleted)
+        self.assertEqual(self.kdb.query().count(), 3)
+        self.assertEqual(self.kdb.query(include_deleted=True).count(), 4)
+
+    def test_invalidate(self):
+        entry = self.kdb.query(Title='Sample Entry #3').first()
+        entry.find("String[Key='Title']").Value._setText('Renamed')
+        self.assertIsNotNone(self.kdb.query(Title='Sample Entry #3').first())
+        self.kdb.invalidate(entry)
+        self.assertIsNone(self.kdb.query(Title='Sample Entry #3').first())
+        self.assertEqual(self.uuids(self.kdb.query(Title='Renamed')),
+                         [entry.UUID.text])
+
+        # rename a group, moves all entries in its subtree
+        group = entry.getparent().getparent()
+        group.Name._setText('Misc')
+        self.kdb.invalidate(group)
+        self.assertEqual(self.uuids(self.kdb.query(group='/sample_merge/Misc/Samples')),
+                         [entry.UUID.text])
+
+        # remove the entry
+        entry.getparent().remove(entry)
+        self.kdb.invalidate(entry)
+        self.assertEqual(self.kdb.query(Title='Renamed').count(), 0)
+        self.assertEqual(len(self.kdb.entry_index), 3)
+
+
+class TestKDB4Search(unittest.TestCase):
+    def setUp(self):
+        self.kdb = libkeepass.open(kdbf_t1, password="qwerty")
+
+    def tearDown(self):
+        self.kdb.close()
+
+    def titles(self, results):
+        return [e.find("String[Key='Title']").Value.text for s, e in results]
+
+    def test_ranking(self):
+        # title matches rank before url matches
+        self.assertEqual(self.titles(self.kdb.search('sample com'))[:2],
+                         ['Sample Entry #3', 'Sample Entry #5'])
+        self.assertEqual(self.titles(self.kdb.search('user5')),
+                         ['Sample Entry #5'])
+        # prefix match of the last word, all words must match
+        self.assertEqual(self.titles(self.kdb.search('entry hist')),
+                         ['Sample Entry (History)'])
+        self.assertEqual(self.kdb.search('entry nothing'), [])
+        self.assertEqual(len(self.kdb.search('sample', limit=2)), 2)
+
+    def test_protected(self):
+        self.assertEqual(self.kdb.search('qwerty'), [])
+        self.assertEqual(self.titles(self.kdb.search('qwerty', include_protected=True)),
+                         ['Sample Entry (History)'])
+
+    def test_update(self):
+        entry = self.kdb.query(Title='Sample Entry #5').first()
+        self.assertEqual(len(self.kdb.search('sample')), 4)
+        entry.find("String[Key='Notes']").Value._setText('Backup tapes')
+        self.kdb.invalidate(entry)
+        self.assertEqual(self.titles(self.kdb.search('tapes')),
+                         ['Sample Entry #5'])
+
+        # searching is disabled in the recycle bin
+        recycle_bin = self.kdb.obj_root.find(".//Group[Name='Recycle Bin']")
+        recycle_bin.append(entry)
+        self.kdb.invalidate(entry)
+        self.assertEqual(self.kdb.search('tapes'), [])
+        self.assertEqual(len(self.kdb.search('sample')), 3)
+
+
+class TestKDB4URLs(unittest.TestCase):
+    def setUp(self):
+        self.kdb = libkeepass.open(kdbf_t1, password="qwerty")
+        self.entries = {}
+        for title, url in (('Sample Entry #2', 'https://login.example.co.uk:8443/a'),
+                           ('Sample Entry #3', 'example.co.uk'),
+                           ('Sample Entry #5', 'http://www.mail.example.co.uk/')):
+            entry = self.kdb.query(Title=title).first()
+            entry.find("String[Key='URL']").Value._setText(url)
+            self.entries[title[-2:]] = entry
+        self.kdb.invalidate()
+
+    def tearDown(self):
+        self.kdb.close()
+
+    def test_url_host(self):
+        self.assertEqual(url_host('HTTPS://user:pw@WWW.Example.com:80/x?y'), 'example.com')
+        self.assertEqual(url_host('example.com/path'), 'example.com')
+        self.assertIsNone(url_host('cmd://putty.exe'))
+        self.assertIsNone(url_host('{REF:U@I:46C9B1FFBD4ABC4BBB260C6190BAD20C}'))
+        self.assertIsNone(url_host(None))
+
+    def test_lookup(self):
+        e = self.entries
+        self.assertEqual(self.kdb.entries_for_url('https://login.example.co.uk/x', MATCH_EXACT),
+                         [e['#2']])
+        self.assertEqual(self.kdb.entries_for_url('https://login.example.co.uk/x', MATCH_PARENT),
+                         [e['#2'], e['#3']])
+        self.assertEqual(self.kdb.entries_for_url('https://login.example.co.uk/x'),
+                         [e['#2'], e['#3'], e['#5']])
+        self.assertEqual(self.kdb.entries_for_url('https://deep.mail.example.co.uk'),
+                         [e['#5'], e['#3'], e['#2']])
+        # public suffixes are never matched as parent domain
+        self.assertEqual(self.kdb.entries_for_url('https://other.co.uk'), [])
+
+    def test_public_suffix_hosts(self):
+        e = self.entries
+        for entry, url in ((e['#2'], 'https://alice.github.io'),
+                           (e['#3'], 'https://bob.github.io'),
+                           (e['#5'], 'https://example.com')):
+            entry.OverrideURL._setText(url)
+            self.kdb.invalidate(entry)
+        self.assertEqual(self.kdb.entries_for_url('https://alice.github.io'),
+                         [e['#2']])
+        # hosts that are a public suffix only match exactly
+        self.assertEqual(self.kdb.entries_for_url('https://github.io'), [])
+        self.assertEqual(self.kdb.entries_for_url('https://co.uk'), [])
+        self.assertEqual(self.kdb.entries_for_url('com'), [])
+        e['#3'].OverrideURL._setText('https://github.io')
+        self.kdb.invalidate(e['#3'])
+        self.assertEqual(self.kdb.entries_for_url('https://github.io'),
+                         [e['#3']])
+
+    def test_override_url_and_update(self):
+        entry = self.entries['#5']
+        self.assertEqual(self.kdb.entries_for_url('example.org'), [])
+        entry.OverrideURL._setText('https://accounts.example.org')
+        # not noticed without invalidate
+        self.assertEqual(self.kdb.entries_for_url('example.org'), [])
+        self.kdb.invalidate(entry)
+        self.assertEqual(self.kdb.entries_for_url('example.org'), [entry])
+        entry.getparent().remove(entry)
+        self.kdb.invalidate(entry)
+        self.assertEqual(self.kdb.entries_for_url('example.org'), [])
+        self.assertEqual(len(self.kdb.entries_for_url('example.co.uk')), 2)
+
+
+class TestKDB4FragmentCache(unittest.TestCase):
+    def setUp(self):
+        self.kdb = libkeepass.open(kdbf_t1, password="qwerty")
+        self.kdb.enable_fragment_cache()
+
+    def tearDown(self):
+        self.kdb.close()
+
+    def assertSerialized(self):
+        cached = b''.join(self.kdb.serialize())
+        fragments = self.kdb._fragments
+        self.kdb._fragments = None
+        try:
+            self.assertEqual(cached, b''.join(self.kdb.serialize()))
+        finally:
+            self.kdb._fragments = fragments
+
+    def test_cached_fragments(self):
+        kdb = self.kdb
+        self.assertSerialized()
+        entry = kdb.query(Title='Sample Entry #3').first()
+        internet = kdb.obj_root.find(".//Group[Name='Internet']")
+        fragment = kdb._fragments[id(internet)]
+
+        # protected values are read from the tree on each save
+        entry.find("String[Key='Password']").Value._setText(u'n\xe9w')
+        self.assertSerialized()
+        entry.find("String[Key='Title']").Value._setText('Renamed')
+        kdb.invalidate(entry)
+        self.assertNotIn(id(entry.getparent()), kdb._fragments)
+        self.assertSerialized()
+        self.assertIn(b'Renamed', b''.join(kdb.serialize()))
+        # untouched groups are reused
+        self.assertIs(kdb._fragments[id(internet)], fragment)
+
+        # moved and removed entries invalidate their old group
+        internet.append(entry)
+        kdb.invalidate(entry)
+        self.assertSerialized()
+        internet.remove(entry)
+        kdb.invalidate(entry)
+        self.assertSerialized()
+        self.assertNotIn(b'Renamed', b''.join(kdb.serialize()))
+
+    def test_lazy_values(self):
+        expected = b''.join(self.kdb.serialize())
+        with libkeepass.open(kdbf_t1, password="qwerty",
+                             unprotect=False) as kdb:
+            kdb.enable_fragment_cache()
+            self.assertEqual(b''.join(kdb.serialize()), expected)
+            kdb.unprotect()
+            self.assertEqual(b''.join(kdb.serialize()), expected)
+
+
+class TestKDB4BulkInsert(unittest.TestCase):
+    def setUp(self):
+        self.kdb = libkeepass.open(kdbf_t1, password="qwerty")
+
+    def tearDown(self):
+        self.kdb.close()
+
+    def reopen(self):
+        output = io.BytesIO()
+        self.kdb.write_to(output)
+        return libkeepass.open_stream(io.BytesIO(output.getvalue()),
+                                      password="qwerty")
+
+    def test_bulk_insert(self):
+        kdb = self.kdb
+        self.assertEqual(len(kdb.entry_index), 4)
+        kdb.enable_fragment_cache()
+        b''.join(kdb.serialize())
+        records = [{'Title': 'db%d' % i, 'UserName': 'admin',
+                    'Password': u'p\r\n<&\xe9%d' % i, 'Rack': 'B4',
+                    'Tags': ['cmdb', 'db']} for i in range(2500)]
+        self.assertEqual(kdb.bulk_insert('/sample_merge/Servers/DB', records), 2500)
+        self.assertEqual(kdb.bulk_insert('', [{'Title': 'top'}]), 1)
+        self.assertRaises(ValueError, kdb.bulk_insert, '/Other', records)
+
+        # the index is updated
+        self.assertEqual(kdb.query(group='/sample_merge/Servers').count(), 2500)
+        self.assertEqual(kdb.query(tags='cmdb').count(), 2500)
+        self.assertEqual(self.uuids(kdb.query(group='/sample_merge', Title='top')),
+                         self.uuids(kdb.obj_root.xpath(".//Entry[String/Value='top']")))
+        entry = kdb.query(Title='db7').first()
+        self.assertEqual(entry.findtext("String[Key='Rack']/Value"), 'B4')
+        self.assertEqual(entry.findtext("String[Key='URL']/Value"), '')
+        self.assertEqual(kdb.search('db7')[0][1], entry)
+        self.assertEqual(len(set(self.uuids(kdb.query(group='/sample_merge')))),
+                         2505)
+        # so are the fragments of the changed groups
+        cached = b''.join(kdb.serialize())
+        kdb.enable_fragment_cache(False)
+        self.assertEqual(cached, b''.join(kdb.serialize()))
+
+        with self.reopen() as saved:
+            entry = saved.query(Title='db7').first()
+            self.assertEqual(entry.find("String[Key='Password']/Value").text,
+                             u'p\r\n<&\xe97')
+            self.assertEqual(entry.getparent().Name, 'DB')
+            self.assertEqual(len(saved.entry_index), 2505)
+
+    def test_bulk_insert_protected(self):
+        with libkeepass.open(kdbf_t1, password="qwerty", unprotect=False) as kdb:
+            self.assertTrue(kdb.is_protected())
+            records = [{'Title': 'db%d' % i, 'Password': u'pw\xe9%d' % i}
+                       for i in range(3)] + [{'Title': 'empty'}]
+            self.assertEqual(kdb.bulk_insert('/sample_merge/Servers', records), 4)
+            self.assertTrue(kdb.is_protected())
+            value = kdb.query(Title='db1').first().find(
+                "String[Key='Password']/Value")
+            self.assertEqual(value.get('Protected'), 'True')
+            self.assertEqual(kdb.value_text(value), u'pw\xe91')
+            output = io.BytesIO()
+            kdb.write_to(output)
+            kdb.unprotect()
+            self.assertEqual(value.text, u'pw\xe91')
+        with libkeepass.open_stream(io.BytesIO(output.getvalue()),
+                                    password="qwerty") as saved:
+            for i in range(3):
+                entry = saved.query(Title='db%d' % i).first()
+                self.assertEqual(entry.findtext("String[Key='Password']/Value"),
+                                 u'pw\xe9%d' % i)
+            self.assertEqual(len(saved.entry_index), 8)
+
+    def test_bulk_insert_invalid_xml(self):
+        kdb = self.kdb
+        records = [{'Title': 'db%d' % i, 'Password': 'pw'} for i in range(10)]
+        records[5]['Notes'] = u'bad\x01'
+        with self.assertRaises(ValueError) as cm:
+            kdb.bulk_insert('/sample_merge/Servers', records)
+        self.assertIn("'db5'", str(cm.exception))
+        self.assertIn("'Notes'", str(cm.exception))
+        self.assertRaises(ValueError, kdb.bulk_insert,
+                          '/sample_merge/Servers', [{'Tags': [u'\x1b']}])
+        self.assertRaises(ValueError, kdb.bulk_insert,
+                          u'/sample_merge/Bad\x00/Sub', [{'Title': 'ok'}])
+        # nothing was added, no group was created
+        self.assertEqual(len(kdb.entry_index), 4)
+        self.assertEqual(kdb.obj_root.xpath(
+            "//Group[Name='Servers' or Name='Sub']"), [])
+
+    def test_import_csv(self):
+        data = (u'Group,Title,Login Name,Password,Web Site,Comments,Tags,Rack\n'
+                u'Web/Mail,mail,me,pw,https://mail.example.com,"a\nb",x;y,B4\n'
+                u',plain,you,pw2,,,,\n')
+        self.assertEqual(self.kdb.import_csv('/sample_merge/CSV', io.StringIO(data)), 2)
+        self.assertEqual(self.kdb.query(group='/sample_merge/CSV').count(), 2)
+        mail = self.kdb.query(Title='mail').first()
+        plain = self.kdb.query(Title='plain').first()
+        self.assertEqual(mail.getparent().Name, 'Mail')
+        self.assertEqual(mail.findtext("String[Key='URL']/Value"),
+                         'https://mail.example.com')
+        self.assertEqual(mail.findtext("String[Key='Notes']/Value"), 'a\nb')
+        self.assertEqual(mail.findtext("String[Key='Rack']/Value"), 'B4')
+        self.assertEqual(mail.findtext('Tags'), 'x;y')
+        self.assertEqual(plain.getparent().Name, 'CSV')
+        self.assertIsNone(plain.find("String[Key='Rack']"))
+
+    def test_import_xml(self):
+        self.kdb.bulk_insert('/sample_merge/Servers', [{'Title': 'db'}])
+        with self.reopen() as saved:
+            xml = io.BytesIO(saved.pretty_print())
+        with libkeepass.open(kdbf_t1, password="qwerty") as kdb:
+            self.assertEqual(kdb.import_xml('/sample_merge/Copy', xml), 5)
+            self.assertEqual(kdb.query(group='/sample_merge/Copy/General/Samples',
+                                       Title='Sample Entry #3').count(), 1)
+            self.assertEqual(kdb.query(group='/sample_merge/Copy/Servers').count(), 1)
+        with libkeepass.open(get_datafile('sample7_kpx.kdb'), password='asdf') as kdb3:
+            xml = io.BytesIO()
+            kdb3.write_xml(xml)
+        xml.seek(0)
+        self.assertEqual(self.kdb.import_xml('/sample_merge/KeePassX', xml), 1)
+        entry = self.kdb.query(group='/sample_merge/KeePassX/Internet').first()
+        self.assertEqual(entry.findtext("String[Key='Password']/Value"), 'asdf')
+
+    def uuids(self, entries):
+        return [e.UUID.text for e in entries]
+
+
+if __name__ == '__main__':
+    unittest.main()